@@ -28,7 +28,7 @@ from watchdog.observers import Observer
 from ws4py.client.threadedclient import WebSocketClient
 
 # Import internal modules
-from fabtotum.os.paths                  import TEMP_PATH
+from fabtotum.os.paths                  import TEMP_PATH, LATENCY_JSON, RECOVERY_JSON, ANALYSIS_CACHE_PATH
 from fabtotum.fabui.config              import ConfigService
 from fabtotum.totumduino.gcode          import GCodeService
 from fabtotum.utils.pyro.gcodeserver    import GCodeServiceServer
@@ -69,8 +69,15 @@ SERIAL_PORT = config.get('serial', 'PORT')
 SERIAL_BAUD = config.get('serial', 'BAUD')
 GPIO_PIN    = config.get('gpio', 'pin')
 
+# Extruder steps per mm, resolution of compacted file pushes
+try:
+    STEPS_PER_MM = {'E' : float(config.get('units', 'e'))}
+except (KeyError, ValueError):
+    STEPS_PER_MM = None
+
 # Start gcode service
-gcservice = GCodeService(SERIAL_PORT, SERIAL_BAUD)
+gcservice = GCodeService(SERIAL_PORT, SERIAL_BAUD, latency_file=LATENCY_JSON, recovery_file=RECOVERY_JSON,
+                         steps_per_mm=STEPS_PER_MM, analysis_cache=ANALYSIS_CACHE_PATH)
 gcservice.start()
 
 # Pyro GCodeService wrapper
@@ -0,0 +1,185 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Allocation and garbage collector pressure of a file push.
+
+Pushes the file with GCodeService to the Totumduino emulator (forked
+process) and counts the command records and threading primitives created
+for it, and the objects tracked by the garbage collector per record. The garbage collector runs with DEBUG_STATS and its
+output is parsed to count collections per generation and the time spent
+in them.
+"""
+
+# Import standard python module
+import os
+import gc
+import re
+import sys
+import json
+import time
+import signal
+import argparse
+import resource
+import tempfile
+import threading
+
+# Import external modules
+
+# Import internal modules
+from fabtotum.totumduino.emulator import TotumduinoEmulator
+
+def count_instances(cls, counters, name):
+    """
+    Count the instances of **cls** created from now on.
+    """
+    init = cls.__init__
+
+    def counted_init(self, *args, **kwargs):
+        counters[name] += 1
+        init(self, *args, **kwargs)
+
+    cls.__init__ = counted_init
+
+def tracked_objects(factory, count = 1000):
+    """
+    Return the number of objects tracked by the garbage collector for
+    every record created by **factory**.
+    """
+    gc.collect()
+    before = len(gc.get_objects())
+    records = [factory() for i in xrange(count)]
+    tracked = len(gc.get_objects()) - before - 1
+    del records
+    return tracked / float(count)
+
+def start_emulator(speed):
+    rd, wr = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rd)
+        emulator = TotumduinoEmulator(speed=speed)
+        port = emulator.start()
+        os.write(wr, port + '\n')
+        os.close(wr)
+        while True:
+            time.sleep(1)
+
+    os.close(wr)
+    port = os.read(rd, 256).strip()
+    os.close(rd)
+    return pid, port
+
+def parse_gc_stats(output):
+    collections = [0, 0, 0]
+    elapsed = 0.0
+    for generation in re.findall(r'gc: collecting generation (\d)', output):
+        collections[int(generation)] += 1
+    for seconds in re.findall(r'gc: done.*?([0-9.]+)s elapsed', output):
+        elapsed += float(seconds)
+    return collections, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file",             help="GCode file to push")
+    parser.add_argument("-o", "--output",   help="JSON result file", default=None)
+    parser.add_argument("--speed",          help="Emulator speed factor", type=float, default=1000.0)
+    parser.add_argument("--timeout",        help="Maximum duration of the file push in seconds", type=float, default=600.0)
+    args = parser.parse_args()
+
+    from fabtotum.totumduino import gcode
+
+    footprint = {'Command' : tracked_objects(lambda: gcode.Command.gcode('G1 X1', group='file'))}
+    if hasattr(gcode, 'FileLine'):
+        footprint['FileLine'] = tracked_objects(lambda: gcode.FileLine('G1 X1', 1))
+
+    counters = {'Command' : 0, 'FileLine' : 0, 'Event' : 0, 'Condition' : 0}
+    count_instances(gcode.Command, counters, 'Command')
+    if hasattr(gcode, 'FileLine'):
+        count_instances(gcode.FileLine, counters, 'FileLine')
+    count_instances(threading._Event, counters, 'Event')
+    count_instances(threading._Condition, counters, 'Condition')
+
+    pid, port = start_emulator(args.speed)
+    try:
+        gcs = gcode.GCodeService(port, 115200)
+
+        done = threading.Event()
+        def callback(action, data):
+            if action == 'file_done':
+                done.set()
+
+        gcs.start()
+        gcs.register_callback('bench', callback)
+
+        # Garbage collector statistics are written to sys.stderr
+        stats_file = tempfile.TemporaryFile()
+        stderr = sys.stderr
+        sys.stderr = stats_file
+
+        for name in counters:
+            counters[name] = 0
+        gc.collect()
+        objects0 = len(gc.get_objects())
+        gc.set_debug(gc.DEBUG_STATS)
+
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.time()
+        gcs.send_file(args.file)
+        done.wait(args.timeout)
+        elapsed = time.time() - t0
+        usage1 = resource.getrusage(resource.RUSAGE_SELF)
+
+        gc.set_debug(0)
+        objects1 = len(gc.get_objects())
+        sys.stderr = stderr
+
+        stats_file.seek(0)
+        collections, gc_time = parse_gc_stats(stats_file.read())
+
+        lines = gcs.get_stream_stats().get('lines', 0)
+        gcs.stop()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    result = {
+        'file'              : os.path.basename(args.file),
+        'completed'         : done.is_set(),
+        'lines'             : lines,
+        'elapsed'           : elapsed,
+        'cpu'               : (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime),
+        'instances'         : counters,
+        'tracked_per_record': footprint,
+        'gc_collections'    : collections,
+        'gc_time'           : gc_time,
+        'gc_objects_growth' : objects1 - objects0
+    }
+
+    print json.dumps(result, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
+
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
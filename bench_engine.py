@@ -0,0 +1,156 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the threaded GCodeService with the event loop GCodeLoopService.
+
+Each engine pushes the same file to a responder answering 'ok' to every
+line over a pseudo terminal. The responder runs in a forked process so
+only the engine is measured. Every engine runs in its own process and
+reports lines per second, CPU time, context switches and thread count.
+"""
+
+# Import standard python module
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import argparse
+import resource
+import signal
+import threading
+import subprocess
+
+# Import external modules
+
+# Import internal modules
+
+def responder(master, delay):
+    """ Reply 'ok' to every received line. """
+    buf = b''
+    while True:
+        try:
+            data = os.read(master, 4096)
+        except OSError:
+            return
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            if line.strip():
+                if delay:
+                    time.sleep(delay)
+                if line.startswith(b'M105'):
+                    os.write(master, b'ok T:210.0 /210.0 B:60.0 /60.0 @:64 B@:0\n')
+                else:
+                    os.write(master, b'ok\n')
+
+def run_engine(engine, filename, delay, timeout):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(slave)
+        responder(master, delay)
+        os._exit(0)
+
+    os.close(master)
+    port = os.ttyname(slave)
+
+    try:
+        if engine == 'loop':
+            from fabtotum.totumduino.gcode_loop import GCodeLoopService
+            gcs = GCodeLoopService(port, 115200)
+        else:
+            from fabtotum.totumduino.gcode import GCodeService
+            gcs = GCodeService(port, 115200)
+
+        done = threading.Event()
+        threads = [0]
+        def callback(action, data):
+            threads[0] = max(threads[0], threading.active_count())
+            if action == 'file_done':
+                done.set()
+
+        gcs.start()
+        gcs.register_callback('bench', callback)
+
+        usage0 = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.time()
+        gcs.send_file(filename)
+        done.wait(timeout)
+        elapsed = time.time() - t0
+        usage1 = resource.getrusage(resource.RUSAGE_SELF)
+
+        stats = gcs.get_stream_stats()
+        cpu = (usage1.ru_utime - usage0.ru_utime) + (usage1.ru_stime - usage0.ru_stime)
+        lines = stats.get('lines', 0)
+
+        result = {
+            'engine'                : engine,
+            'completed'             : done.is_set(),
+            'lines'                 : lines,
+            'elapsed'               : elapsed,
+            'lines_per_second'      : lines / elapsed if elapsed else 0.0,
+            'cpu'                   : cpu,
+            'cpu_per_1k_lines'      : 1000.0 * cpu / lines if lines else 0.0,
+            'voluntary_switches'    : usage1.ru_nvcsw - usage0.ru_nvcsw,
+            'involuntary_switches'  : usage1.ru_nivcsw - usage0.ru_nivcsw,
+            'max_threads'           : threads[0]
+        }
+
+        gcs.stop()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file",         help="GCode file to push")
+    parser.add_argument("--engine",     help="Run only one engine", choices=['threaded', 'loop'], default=None)
+    parser.add_argument("--delay",      help="Responder delay per line in seconds", type=float, default=0.0)
+    parser.add_argument("--timeout",    help="Maximum duration of a file push in seconds", type=float, default=600.0)
+    args = parser.parse_args()
+
+    if args.engine:
+        result = run_engine(args.engine, args.file, args.delay, args.timeout)
+        # Service threads print to stdout, the result is the last line
+        sys.stdout.write( json.dumps(result) + '\n' )
+        sys.stdout.flush()
+        os._exit(0)
+
+    results = []
+    for engine in ['threaded', 'loop']:
+        output = subprocess.check_output([sys.executable, __file__, args.file,
+                                          '--engine', engine,
+                                          '--delay', str(args.delay),
+                                          '--timeout', str(args.timeout)])
+        results.append( json.loads(output.strip().splitlines()[-1]) )
+
+    print json.dumps(results, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
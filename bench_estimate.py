@@ -0,0 +1,88 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the print time estimation done by GCodeFile.estimate_time.
+
+Reports for every file the time spent parsing the moves and planning them,
+the estimated print time and, for comparison, the time of every move at
+its feedrate without acceleration.
+"""
+
+# Import standard python module
+import argparse
+import time
+
+# Import external modules
+
+# Import internal modules
+from fabtotum.utils import gcodetime
+from fabtotum.utils.gcodefile import GCodeFile
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files",        help="GCode files", nargs='*', default=['cura.gcode', 'slicer.gcode'])
+    parser.add_argument("--repeat",     help="Number of runs, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    if not gcodetime.AVAILABLE:
+        print "NumPy is not available"
+        return
+
+    for filename in args.files:
+        gfile = GCodeFile(filename)
+        layers = gfile.layer_index()
+
+        parse_time = plan_time = None
+        for i in xrange(args.repeat):
+            t0 = cpu_time()
+            moves = gcodetime.parse_moves(filename)
+            t1 = cpu_time()
+            times = gcodetime.plan_moves(moves)
+            t2 = cpu_time()
+            if parse_time is None or t1 - t0 < parse_time:
+                parse_time = t1 - t0
+            if plan_time is None or t2 - t1 < plan_time:
+                plan_time = t2 - t1
+
+        estimate = gcodetime.estimate_print_time(filename, layers)
+        length = (moves['dx']**2 + moves['dy']**2 + moves['dz']**2) ** 0.5
+        e_only = length == 0
+        length[e_only] = abs(moves['de'][e_only])
+        naive = (length / moves['feedrate']).sum()
+
+        print "{0}: {1} lines, {2} moves, {3} layers".format(filename, gfile.info['line_count'], len(times), len(layers))
+        print "  parse:     {0:.3f} s CPU".format(parse_time)
+        print "  plan:      {0:.3f} s CPU".format(plan_time)
+        print "  estimate:  {0}".format( format_time(estimate['total']) )
+        print "  feedrate:  {0} (no acceleration)".format( format_time(naive) )
+
+if __name__ == "__main__":
+    main()
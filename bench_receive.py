@@ -0,0 +1,150 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the receive framing used by GCodeService.
+
+Compares the previous framing (split the buffer once per line and decode
+every line) with LineFramer and the undecoded 'ok' fast path. The reply
+stream is either a raw capture of Totumduino output (--capture) or a
+generated one with the reply mix of a print job. Data is fed in chunks of
+random size the way serial.read() returns it.
+"""
+
+# Import standard python module
+import argparse
+import random
+import time
+
+# Import external modules
+
+# Import internal modules
+from fabtotum.totumduino.framing import LineFramer
+
+READ_TERM = b'\n'
+ENCODING = 'utf-8'
+UNICODE_HANDLING = 'replace'
+OK_REPLY_RAW = b'ok'
+OK_REPLY = u'ok'
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+def generate_stream(replies, seed):
+    rnd = random.Random(seed)
+    lines = []
+    for i in xrange(replies):
+        r = rnd.random()
+        if r < 0.90:
+            lines.append(b'ok')
+        elif r < 0.97:
+            lines.append(b'ok T:%.1f /215.0 B:%.1f /60.0 @:64 B@:0' % (rnd.uniform(210, 220), rnd.uniform(58, 62)))
+        else:
+            lines.append(b'echo:busy: processing')
+    return READ_TERM.join(lines) + READ_TERM
+
+def split_chunks(stream, seed, max_chunk):
+    rnd = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rnd.randint(1, max_chunk)
+        chunks.append( stream[pos:pos+size] )
+        pos += size
+    return chunks
+
+def handle_line(line):
+    pass
+
+def run_split(chunks):
+    """ Previous framing: split per line, decode every line. """
+    buf = bytearray()
+    count = 0
+    for data in chunks:
+        buf.extend(data)
+        while READ_TERM in buf:
+            line_raw, buf = buf.split(READ_TERM, 1)
+            line = line_raw.decode(ENCODING, UNICODE_HANDLING)
+            handle_line(line)
+            count += 1
+    return count
+
+def run_framer(chunks):
+    """ LineFramer with 'ok' fast path. """
+    framer = LineFramer(READ_TERM)
+    count = 0
+    for data in chunks:
+        for line_raw in framer.feed(data):
+            if line_raw == OK_REPLY_RAW:
+                line = OK_REPLY
+            else:
+                line = line_raw.decode(ENCODING, UNICODE_HANDLING)
+            handle_line(line)
+            count += 1
+    return count
+
+def measure(fun, chunks, repeat):
+    best = None
+    count = 0
+    for i in xrange(repeat):
+        t0 = cpu_time()
+        count = fun(chunks)
+        elapsed = cpu_time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture",    help="Raw capture of Totumduino replies", default=None)
+    parser.add_argument("--replies",    help="Number of generated replies", type=int, default=10000)
+    parser.add_argument("--chunk",      help="Maximum read chunk size in bytes", type=int, default=64)
+    parser.add_argument("--repeat",     help="Number of runs, the best one is reported", type=int, default=5)
+    parser.add_argument("--seed",       help="Random seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = generate_stream(args.replies, args.seed)
+
+    chunks = split_chunks(stream, args.seed, args.chunk)
+
+    old_time, old_count = measure(run_split, chunks, args.repeat)
+    new_time, new_count = measure(run_framer, chunks, args.repeat)
+
+    if old_count != new_count:
+        print "Line count mismatch: {0} != {1}".format(old_count, new_count)
+        return
+
+    old_10k = old_time * 10000.0 / old_count
+    new_10k = new_time * 10000.0 / new_count
+
+    print "replies:            {0} in {1} chunks".format(new_count, len(chunks))
+    print "split + decode:     {0:.2f} ms CPU / 10k replies".format(old_10k * 1000)
+    print "framer + fast path: {0:.2f} ms CPU / 10k replies".format(new_10k * 1000)
+    print "saved:              {0:.2f} ms CPU / 10k replies ({1:.1f}%)".format((old_10k - new_10k) * 1000,
+                                                                             100.0 * (old_10k - new_10k) / old_10k)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the gcode file analysis done by GCodeFile before a push.
+
+Compares the previous analysis pass (every slicer parser with several
+regular expression searches on every line) with GCodeFile.process_file,
+which sniffs the slicer first and parses comment lines only. Both must
+extract the same information, the lines per second of both are reported.
+"""
+
+# Import standard python module
+import re
+import argparse
+import time
+
+# Import external modules
+
+# Import internal modules
+from fabtotum.utils.gcodefile import GCodeFile, GCodeInfo
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+def legacy_cura_line(line):
+    attrs = {}
+    if re.search('CURA_PROFILE_STRING:', line):
+        attrs['slicer'] = 'CURA'
+    tags = line.split(';')
+    if len(tags) == 2:
+        if re.search('Layer count:', tags[1]):
+            tag, value = tags[1].split(':')
+            value = value.strip()
+            if _is_number(value):
+                attrs['layer_count'] = value
+        elif re.search('LAYER:', tags[1]):
+            tag, value = tags[1].split(':')
+            attrs['layer'] = value.strip()
+    return attrs
+
+def legacy_slic3r_line(line):
+    attrs = {}
+    if re.search('generated by Slic3r', line):
+        attrs['slicer'] = 'SLIC3R'
+    tags = line.split(';')
+    if len(tags) == 2:
+        if re.search('move to next layer', tags[1]):
+            m = re.search('\((?P<layer>[0-9]+)\)',tags[1])
+            if m:
+                attrs['layer'] = m.group('layer')
+    return attrs
+
+def legacy_process_file(filename):
+    """ Previous analysis pass of GCodeFile. """
+    info = GCodeInfo(filename)
+    count = 0
+    gcode_count = 0
+    max_layer = 0
+    layer_count = 0
+    gcode_type = None
+
+    with open(filename, 'r+') as file:
+        for line in file:
+            count += 1
+            head = line[:4]
+            if head == 'M109':
+                gcode_type = info['type'] = GCodeInfo.PRINT
+            elif head == 'M3 S' or head == 'M4 S':
+                gcode_type = info['type'] = GCodeInfo.MILL
+
+            for process_line in (legacy_cura_line, legacy_slic3r_line):
+                attrs = process_line(line)
+                if 'type' in attrs:
+                    gcode_type = info['type'] = attrs['type']
+                if 'slicer' in attrs:
+                    info['slicer'] = attrs['slicer']
+                if 'layer_count' in attrs:
+                    layer_count = info['layer_count'] = attrs['layer_count']
+                if 'layer' in attrs:
+                    layer = int(attrs['layer'])
+                    if layer > max_layer:
+                        max_layer = layer
+
+            tags = line.strip().split(';')
+            if tags[0]:
+                gcode_count += 1
+
+    if not layer_count and gcode_type == GCodeInfo.PRINT and max_layer > 0:
+        info['layer_count'] = max_layer
+
+    info['line_count'] = count
+    info['gcode_count'] = gcode_count
+    return info.attribs
+
+def current_process_file(filename):
+    """ Current analysis pass of GCodeFile. """
+    return GCodeFile(filename).info.attribs
+
+def measure(fun, filename, repeat):
+    best = None
+    result = None
+    for i in xrange(repeat):
+        t0 = cpu_time()
+        result = fun(filename)
+        elapsed = cpu_time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files",        help="GCode files", nargs='*', default=['cura.gcode', 'slicer.gcode'])
+    parser.add_argument("--repeat",     help="Number of runs, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    for filename in args.files:
+        old_time, old_info = measure(legacy_process_file, filename, args.repeat)
+        new_time, new_info = measure(current_process_file, filename, args.repeat)
+
+        lines = new_info['line_count']
+        print "{0}: {1} lines".format(filename, lines)
+        if old_info != new_info:
+            print "  information mismatch: {0} != {1}".format(old_info, new_info)
+        print "  previous: {0:9.0f} lines/s ({1:.3f} s CPU)".format(lines / old_time, old_time)
+        print "  current:  {0:9.0f} lines/s ({1:.3f} s CPU)".format(lines / new_time, new_time)
+        print "  speedup:  {0:.1f}x".format(old_time / new_time)
+
+if __name__ == "__main__":
+    main()
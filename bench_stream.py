@@ -0,0 +1,324 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Streaming benchmark of GCodeService against the Totumduino emulator.
+
+The emulator runs in a forked process. The benchmark measures the
+round trip of interactive commands on an idle service, then pushes the
+file with send_file while another thread keeps sending interactive
+commands. It reports lines per second, acknowledge latency percentiles,
+sender stall time, CPU time per service thread and interactive latency
+during the push, and writes the results as JSON to --output.
+
+With --check the exit status is non-zero when not every file line has
+been acknowledged or when the number of retransmitted lines exceeds
+--max-resend times the number of lines corrupted by the emulator.
+"""
+
+# Import standard python module
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import platform
+import threading
+
+# Import external modules
+
+# Import internal modules
+from fabtotum.totumduino.emulator import TotumduinoEmulator
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def track_threads():
+    """
+    Record the kernel thread id of every thread started from now on,
+    keyed by the name of its target function.
+    """
+    tids = {'main' : os.getpid()}
+    run = threading.Thread.run
+
+    def tracked_run(thread):
+        target = getattr(thread, '_Thread__target', None) or getattr(thread, '_target', None)
+        name = thread.name
+        if target is not None:
+            name = target.__name__.split('__')[-1]
+        try:
+            tids[name] = int( os.readlink('/proc/thread-self').split('/')[-1] )
+        except OSError:
+            pass
+        run(thread)
+
+    threading.Thread.run = tracked_run
+    return tids
+
+def thread_cpu(tids):
+    """
+    Return user + system CPU time in seconds of every tracked thread.
+    """
+    result = {}
+    for name, tid in tids.items():
+        try:
+            with open('/proc/self/task/{0}/stat'.format(tid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        result[name] = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    return result
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count' : 0}
+    count = len(samples)
+    return {
+        'count' : count,
+        'mean'  : sum(samples) / count,
+        'p50'   : samples[int(0.50 * (count-1))],
+        'p90'   : samples[int(0.90 * (count-1))],
+        'p99'   : samples[int(0.99 * (count-1))],
+        'max'   : samples[-1]
+    }
+
+def start_emulator(args):
+    """
+    Fork a process running the emulator and return its pid, port and a
+    function returning the emulator counters.
+    """
+    rd, wr = os.pipe()
+    ctl_rd, ctl_wr = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rd)
+        os.close(ctl_wr)
+        emulator = TotumduinoEmulator(speed=args.speed, corrupt_rate=args.corrupt)
+        port = emulator.start()
+        os.write(wr, port + '\n')
+        # Counters are written back on every request
+        while os.read(ctl_rd, 1):
+            os.write(wr, json.dumps(emulator.get_stats()) + '\n')
+        os._exit(0)
+
+    os.close(wr)
+    os.close(ctl_rd)
+    replies = os.fdopen(rd)
+    port = replies.readline().strip()
+
+    def emulator_stats():
+        os.write(ctl_wr, '\n')
+        return json.loads(replies.readline())
+
+    return pid, port, emulator_stats
+
+def count_lines(filename):
+    """
+    Return the number of lines of **filename** carrying a command.
+    """
+    count = 0
+    with open(filename) as f:
+        for line in f:
+            if line.split(';', 1)[0].strip():
+                count += 1
+    return count
+
+def check(args, result):
+    """
+    Return the list of failed checks of a finished push.
+    """
+    failed = []
+    if not result['completed']:
+        failed.append('file push not completed in {0} s'.format(args.timeout))
+
+    expected = count_lines(args.file)
+    if result['lines'] != expected:
+        failed.append('{0} file lines acknowledged, {1} expected'.format(result['lines'], expected))
+
+    corrupted = result['emulator']['corrupted']
+    resent = result['resend'].get('lines', 0)
+    if resent > args.max_resend * max(corrupted, 1):
+        failed.append('{0} lines retransmitted for {1} corrupted lines'.format(resent, corrupted))
+
+    return failed
+
+class InteractiveClient(threading.Thread):
+    """
+    Send **code** every **interval** seconds and record the round trip.
+    """
+
+    def __init__(self, gcs, code, interval):
+        super(InteractiveClient, self).__init__()
+        self.daemon = True
+        self.gcs = gcs
+        self.code = code
+        self.interval = interval
+        self.samples = []
+        self.timeouts = 0
+        self.ev_stop = threading.Event()
+
+    def run(self):
+        while not self.ev_stop.is_set():
+            t0 = time.time()
+            reply = self.gcs.send(self.code, timeout=10)
+            if reply is None:
+                self.timeouts += 1
+            else:
+                self.samples.append(time.time() - t0)
+            self.ev_stop.wait(self.interval)
+
+    def stop(self):
+        self.ev_stop.set()
+        self.join()
+
+def run(args):
+    tids = track_threads()
+
+    from fabtotum.totumduino.gcode import GCodeService
+
+    pid, port, emulator_stats = start_emulator(args)
+    try:
+        gcs = GCodeService(port, 115200, use_checksum=args.checksum)
+
+        done = threading.Event()
+        def callback(action, data):
+            if action == 'file_done':
+                done.set()
+
+        gcs.start()
+        gcs.register_callback('bench', callback)
+
+        # Interactive round trip on an idle service
+        idle = []
+        for i in xrange(args.idle_commands):
+            t0 = time.time()
+            gcs.send(args.interactive)
+            idle.append(time.time() - t0)
+
+        gcs.get_ack_latency(clear=True)
+
+        client = None
+        if args.interval > 0:
+            client = InteractiveClient(gcs, args.interactive, args.interval)
+
+        cpu0 = thread_cpu(tids)
+        t0 = time.time()
+        gcs.send_file(args.file)
+        if client:
+            client.start()
+        done.wait(args.timeout)
+        elapsed = time.time() - t0
+        cpu1 = thread_cpu(tids)
+
+        if client:
+            client.stop()
+
+        stream = gcs.get_stream_stats()
+        cpu = {}
+        for name in cpu1:
+            cpu[name] = cpu1[name] - cpu0.get(name, 0.0)
+
+        result = {
+            'file'                  : os.path.basename(args.file),
+            'completed'             : done.is_set(),
+            'elapsed'               : elapsed,
+            'lines'                 : stream.get('lines', 0),
+            'lines_per_second'      : stream.get('lines_per_second', 0.0),
+            'stall_time'            : stream.get('stall_time', 0.0),
+            'barrier_time'          : stream.get('barrier_time', 0.0),
+            'ack_latency'           : gcs.get_ack_latency(),
+            'interactive_idle'      : percentiles(idle),
+            'interactive_streaming' : percentiles(client.samples if client else []),
+            'interactive_timeouts'  : client.timeouts if client else 0,
+            'cpu'                   : cpu,
+            'cpu_total'             : sum(cpu.values()),
+            'lanes'                 : gcs.get_lane_stats(),
+            'resend'                : gcs.get_resend_stats(),
+            'emulator'              : emulator_stats(),
+            'callbacks'             : gcs.get_callback_stats()
+        }
+
+        gcs.stop()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    result['settings'] = {
+        'checksum'      : args.checksum,
+        'speed'         : args.speed,
+        'corrupt'       : args.corrupt,
+        'interactive'   : args.interactive,
+        'interval'      : args.interval
+    }
+    result['platform'] = {
+        'python'        : platform.python_version(),
+        'machine'       : platform.machine(),
+        'time'          : time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file",             help="GCode file to push")
+    parser.add_argument("-o", "--output",   help="JSON result file", default="bench_stream.json")
+    parser.add_argument("--checksum",       help="Use line numbers and checksums", action='store_true')
+    parser.add_argument("--speed",          help="Emulator speed factor, high values make the host the bottleneck", type=float, default=1000.0)
+    parser.add_argument("--corrupt",        help="Probability of a corrupted line on the emulator", type=float, default=0.0)
+    parser.add_argument("--interactive",    help="Interactive command", default="M105")
+    parser.add_argument("--interval",       help="Interactive command interval during the push in seconds, 0 disables", type=float, default=0.1)
+    parser.add_argument("--idle-commands",  help="Number of interactive commands on the idle service", type=int, default=100)
+    parser.add_argument("--timeout",        help="Maximum duration of the file push in seconds", type=float, default=600.0)
+    parser.add_argument("--check",          help="Exit with an error status when a check fails", action='store_true')
+    parser.add_argument("--max-resend",     help="Retransmitted lines allowed per corrupted line with --check", type=float, default=4.0)
+    args = parser.parse_args()
+
+    result = run(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=4, sort_keys=True)
+
+    print "lines:               {0} in {1:.2f} s ({2:.0f} lines/s)".format(result['lines'], result['elapsed'], result['lines_per_second'])
+    print "stall time:          {0:.3f} s".format(result['stall_time'])
+    ack = result['ack_latency'].get('file', {})
+    if ack:
+        print "file ack latency:    p50 {0:.2f} ms, p99 {1:.2f} ms".format(ack['p50'] * 1000, ack['p99'] * 1000)
+    for key in ('interactive_idle', 'interactive_streaming'):
+        stats = result[key]
+        if stats['count']:
+            print "{0:20} p50 {1:.2f} ms, p99 {2:.2f} ms".format(key + ':', stats['p50'] * 1000, stats['p99'] * 1000)
+    print "CPU:                 {0}".format(', '.join('{0} {1:.2f} s'.format(k, v) for k, v in sorted(result['cpu'].items())))
+    print "results written to {0}".format(args.output)
+
+    status = 0
+    if args.check:
+        failed = check(args, result)
+        for message in failed:
+            print "check failed:        {0}".format(message)
+        if failed:
+            status = 1
+
+    sys.stdout.flush()
+    # Daemon threads of the service may still be running
+    os._exit(status)
+
+if __name__ == "__main__":
+    main()
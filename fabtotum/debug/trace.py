@@ -0,0 +1,166 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import standard python module
+import sys
+import time
+from collections import deque
+from threading import current_thread
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+class Trace(object):
+    """
+    Leveled in-memory trace buffer.
+
+    Records are kept in a ring buffer of fixed size and formatted only when
+    the buffer is dumped, so tracing does not cause any terminal I/O.
+    A record with level above the current trace level is discarded right away.
+
+    Usage::
+
+        trace = Trace()
+        trace.set_level(Trace.DEBUG)
+        trace.debug("<< {0}", line)
+        print '\\n'.join( trace.dump() )
+    """
+
+    OFF     = 0
+    ERROR   = 1
+    WARNING = 2
+    INFO    = 3
+    DEBUG   = 4
+
+    LEVEL_NAMES = {
+        OFF     : 'OFF',
+        ERROR   : 'ERROR',
+        WARNING : 'WARNING',
+        INFO    : 'INFO',
+        DEBUG   : 'DEBUG'
+    }
+
+    def __init__(self, size = 4096, level = OFF):
+        """
+        :param size: Number of records kept in the ring buffer
+        :param level: Initial trace level
+        :type size: int
+        :type level: int
+        """
+        self.level = level
+        self.records = deque(maxlen=size)
+
+    def set_level(self, level):
+        """
+        Set the trace level. Records with a higher level are discarded,
+        ``Trace.OFF`` disables tracing.
+
+        :param level: Trace level or level name
+        :type level: int, string
+        """
+        if isinstance(level, basestring):
+            for value, name in self.LEVEL_NAMES.iteritems():
+                if name == level.upper():
+                    level = value
+                    break
+            else:
+                raise ValueError("Unknown trace level '{0}'".format(level))
+
+        self.level = level
+
+    def get_level(self):
+        """
+        Return the current trace level.
+        """
+        return self.level
+
+    def log(self, level, msg, *args):
+        """
+        Add a record to the ring buffer. **msg** is formatted with
+        ``msg.format(*args)`` only when the record is dumped.
+
+        :param level: Record level
+        :param msg: Message format string
+        :param args: Message arguments
+        """
+        if level <= self.level:
+            self.records.append( (time.time(), level, current_thread().name, msg, args) )
+
+    def error(self, msg, *args):
+        if self.level >= Trace.ERROR:
+            self.records.append( (time.time(), Trace.ERROR, current_thread().name, msg, args) )
+
+    def warning(self, msg, *args):
+        if self.level >= Trace.WARNING:
+            self.records.append( (time.time(), Trace.WARNING, current_thread().name, msg, args) )
+
+    def info(self, msg, *args):
+        if self.level >= Trace.INFO:
+            self.records.append( (time.time(), Trace.INFO, current_thread().name, msg, args) )
+
+    def debug(self, msg, *args):
+        if self.level >= Trace.DEBUG:
+            self.records.append( (time.time(), Trace.DEBUG, current_thread().name, msg, args) )
+
+    def clear(self):
+        """
+        Remove all records from the ring buffer.
+        """
+        self.records.clear()
+
+    def dump(self, clear = False):
+        """
+        Format the buffered records, oldest first.
+
+        :param clear: Remove the records after formatting them
+        :type clear: bool
+        :returns: List of formatted records
+        :rtype: list
+        """
+        records = list(self.records)
+        if clear:
+            self.clear()
+
+        lines = []
+        for timestamp, level, thread_name, msg, args in records:
+            try:
+                text = msg.format(*args)
+            except Exception as e:
+                text = "{0} {1} ({2})".format(msg, args, e)
+
+            lines.append( "{0:.6f} {1:<7} [{2}] {3}".format(timestamp,
+                            self.LEVEL_NAMES.get(level, level),
+                            thread_name,
+                            text.rstrip()) )
+
+        return lines
+
+    def write(self, stream = None, clear = False):
+        """
+        Write the buffered records to **stream** (default *stdout*).
+        """
+        if stream is None:
+            stream = sys.stdout
+        for line in self.dump(clear):
+            stream.write(line + '\n')
+        stream.flush()
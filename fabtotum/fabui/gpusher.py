@@ -38,8 +38,10 @@ from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
 # Import internal modules
+from fabtotum.os.paths import ANALYSIS_CACHE_PATH
 from fabtotum.fabui.config import ConfigService
 from fabtotum.utils.gcodefile import GCodeFile, GCodeInfo
+from fabtotum.utils.gcodecache import AnalysisCache
 from fabtotum.utils.pyro.gcodeclient import GCodeServiceClient
 
 # Set up message catalog access
@@ -80,6 +82,8 @@ class GCodePusher(object):
     def __init__(self, log_trace, monitor_file = None, gcs = None, use_callback = True):
         
         self.config = ConfigService()
+        # Shared with GCodeService, the file is analysed only once
+        self.analysis_cache = AnalysisCache(ANALYSIS_CACHE_PATH)
         
         self.monitor_file = monitor_file
         self.trace_file = log_trace
@@ -110,6 +114,8 @@ class GCodePusher(object):
             "tip"                   : False,
             "message"               : '',
             "current_line_number"   : 0,
+            "estimated_time"        : 0.0,
+            "remaining_time"        : 0.0,
             "gcode_info"            : None
         }
         
@@ -150,7 +156,9 @@ class GCodePusher(object):
                     "rpm"               : str(self.monitor_info['rpm']),
                     "fan"               : str(self.monitor_info['fan']),
                     "speed"             : str(self.monitor_info['speed']),
-                    "flow_rate"         : str(self.monitor_info['flow_rate'])
+                    "flow_rate"         : str(self.monitor_info['flow_rate']),
+                    "estimated_time"    : str(self.monitor_info['estimated_time']),
+                    "remaining_time"    : str(self.monitor_info['remaining_time'])
                     }
                                 
         _tip    =   {
@@ -409,6 +417,40 @@ class GCodePusher(object):
         
         self.state_change_callback(data)
     
+    def z_override_callback(self, z_override):
+        """
+        Triggered when a live Z adjustment has been applied.
+        
+        :param z_override: Accumulated Z adjustment in mm
+        :type z_override: float
+        """
+        pass
+    
+    def __z_override_callback(self, z_override):
+        self.monitor_lock.acquire()
+        
+        self.monitor_info["z_override"] = z_override
+        
+        self.monitor_lock.release()
+        
+        self.writeMonitor()
+        
+        self.z_override_callback(z_override)
+    
+    def slow_command_callback(self, code, elapsed, threshold):
+        """ 
+        Triggered when a command waits for its reply abnormally long
+        compared to the recorded reply times of its code.
+        
+        :param code: GCode
+        :param elapsed: Time in seconds since the command was sent
+        :param threshold: Usual reply time limit in seconds
+        :type code: string
+        :type elapsed: float
+        :type threshold: float
+        """
+        pass
+    
     def progress_callback(self, percentage):
         """ 
         Triggered when progress percentage changes 
@@ -447,6 +489,10 @@ class GCodePusher(object):
             self.__temp_change_callback(action.split(':')[1], data)
         elif action == 'state_change':
             self.__state_change_callback()
+        elif action == 'z_override':
+            self.__z_override_callback(data)
+        elif action == 'slow_command':
+            self.slow_command_callback(data[0], data[1], data[2])
         elif action == 'error':
             self.__error_callback(data[0], data[1])
 
@@ -471,6 +517,13 @@ class GCodePusher(object):
                     except Exception:
                         pass
                     self.monitor_lock.release()
+                    
+                    estimate = self.gcs.get_time_estimate()
+                    if estimate:
+                        self.monitor_lock.acquire()
+                        self.monitor_info['estimated_time'] = estimate['total']
+                        self.monitor_info['remaining_time'] = estimate['remaining']
+                        self.monitor_lock.release()
                     monitor_write = True
                 
             if old_progress != progress:
@@ -501,7 +554,7 @@ class GCodePusher(object):
         :param rpm: ???
         """
         
-        gfile = GCodeFile(gcode_file)
+        gfile = GCodeFile(gcode_file, self.analysis_cache)
         
         self.monitor_info["progress"] = 0.0
         self.monitor_info["paused"] = False
@@ -526,8 +579,19 @@ class GCodePusher(object):
         self.monitor_info["tip"] = False
         self.monitor_info["message"] = ''
         self.monitor_info["current_line_number"] = 0
+        self.monitor_info["estimated_time"] = 0.0
+        self.monitor_info["remaining_time"] = 0.0
         self.monitor_info["gcode_info"] = gfile.info
         
+        if gfile.info['type'] == GCodeInfo.PRINT:
+            # Built once and kept in the analysis cache, GCodeService
+            # uses the same index for layer progress and remaining time
+            layers = gfile.layer_index()
+            if 'layer_count' in gfile.info:
+                self.monitor_info["layer_count"] = gfile.info['layer_count']
+            else:
+                self.monitor_info["layer_count"] = len(layers)
+        
         if self.monitor_file:
             print "Creating monitor thread"
             
@@ -593,7 +657,7 @@ class GCodePusher(object):
         :param code: gcode
         :param expected_reply: Expected reply
         :param error_msg: Error message to display
-        :param timeout: Reply timeout in seconds
+        :param timeout: Reply timeout in seconds, extended once a longer reply time of the code is learned
         :param delay_after: Time in seconds to wait after receiving the rely
         :param warning: Treat wrong reply as warning not as error
         :param verbose: Whether initial message should be displayed or not.
@@ -609,8 +673,16 @@ class GCodePusher(object):
             if verbose:
                 self.trace(error_msg)
             
-            reply = self.gcs.send(code, timeout=timeout, group = 'macro')
-            if expected_reply:
+            reply = self.gcs.send(code, timeout=timeout, adaptive=True)
+            if reply is None:
+                # Timed out or the service was stopped
+                if warning:
+                    self.trace(error_msg + _(": Warning!"))
+                    self.macro_warning += 1
+                else:
+                    self.trace(error_msg + _(": Failed (no reply)"))
+                    self.macro_error += 1
+            elif expected_reply:
                 # Check if the reply is as expected
                 if reply[0] != expected_reply:
                     if warning:
@@ -633,8 +705,11 @@ class GCodePusher(object):
             self.trace(trace)
         return self.gcs.send(code, expected_reply, block, timeout)
         
-    def send_file(self, filename):
+    def send_file(self, filename, arc_tolerance = None, compact = False):
         """
+        Push a gcode file, optionally an arc fitted copy of it deviating
+        at most **arc_tolerance** mm from it. With **compact** redundant
+        parameters and collinear segments are not sent.
         """
-        return self.gcs.send_file(filename)
+        return self.gcs.send_file(filename, arc_tolerance, compact)
  
@@ -32,6 +32,7 @@ import RPi.GPIO as GPIO
 
 # Import internal modules
 from fabtotum.fabui.config import ConfigService
+from fabtotum.utils.future import TimeoutError, CancelledError
 
 # Set up message catalog access
 tr = gettext.translation('gpio_monitor', 'locale', fallback=True)
@@ -41,6 +42,8 @@ class GPIOMonitor:
     
     ACTION_PIN = None
     EMERGENCY_FILE = None
+    # Time in seconds to wait for the M730 reply
+    REPLY_TIMEOUT = 10
     
     def __init__(self, WebSocket, gcs, action_pin, emergency_file):
         self.ws = WebSocket
@@ -55,21 +58,36 @@ class GPIOMonitor:
         print "====== START ============"
         print 'GPIO STATUS: ', GPIO.input(self.ACTION_PIN)
         if GPIO.input(self.ACTION_PIN) == 0 :
-            reply = self.gcs.send("M730")
-            
-            if reply:
-                if len(reply) > 1:
-                    search = re.search('ERROR\s:\s(\d+)', reply[0])
-                    if search != None:
-                        errorNumber = int(search.group(1))
-                        print "Error Number:", errorNumber
-                        self.manageErrorNumber(errorNumber)
-                    else:
-                        print "Unrecognized error: ", reply[0]
+            # The reply is handled when it arrives, the GPIO event thread
+            # is not blocked in the meantime
+            future = self.gcs.send_async("M730", timeout=self.REPLY_TIMEOUT)
+            future.add_done_callback(self.errorReplyHandler)
 
         GPIO_STATUS = GPIO.HIGH
         print 'GPIO STATUS on EXIT: ', GPIO.input(self.ACTION_PIN)
         print "====== EXIT ============"
+    
+    def errorReplyHandler(self, future):
+        """
+        Triggered when the M730 reply is received or the request failed.
+        """
+        try:
+            reply = future.result(0)
+        except TimeoutError:
+            print "No reply to M730"
+            return
+        except CancelledError:
+            return
+        
+        if reply:
+            if len(reply) > 1:
+                search = re.search('ERROR\s:\s(\d+)', reply[0])
+                if search != None:
+                    errorNumber = int(search.group(1))
+                    print "Error Number:", errorNumber
+                    self.manageErrorNumber(errorNumber)
+                else:
+                    print "Unrecognized error: ", reply[0]
 
     def manageErrorNumber(self, error):
         alertErrors = [110]
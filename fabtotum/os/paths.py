@@ -13,14 +13,17 @@ BASH_PATH		= FABUI_PATH + 'ext/bash/'
 
 TASKS_PATH		= WWW_PATH + 'tasks'
 RECOVERY_PATH	= WWW_PATH + 'recovery/'
+RECOVERY_JSON	= RECOVERY_PATH + 'checkpoint.json'
 UPLOAD_PATH		= WWW_PATH + 'upload/'
 TEMP_PATH		= WWW_PATH + 'temp/'
 
 BIGTEMP_PATH	= '/mnt/bigtemp/'
+ANALYSIS_CACHE_PATH	= BIGTEMP_PATH + 'gcode-cache/'
 USERDATA_PATH	= '/mnt/userdata/'
 USB_MEDIA_PATH	= '/run/media/'
 
 CONFIG_INI		= LIB_PATH + 'config.ini'
 SERIAL_INI		= LIB_PATH + 'serial.ini'
+LATENCY_JSON	= LIB_PATH + 'latency.json'
 
 DEBUG_IS_ON			= False
@@ -0,0 +1,607 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Totumduino firmware emulator.
+
+The emulator creates a pseudo terminal and answers on it the way the
+Totumduino (Marlin) firmware does, so GCodeService can be run and measured
+on a plain Linux box. Use :attr:`TotumduinoEmulator.port` as the serial port,
+or run this module to get a standalone device::
+
+    python -m fabtotum.totumduino.emulator --link /tmp/ttyTOTUMDUINO
+"""
+
+# Import standard python module
+import os
+import pty
+import tty
+import math
+import time
+import errno
+import random
+import select
+import argparse
+import operator
+from collections import deque
+from threading import Thread, RLock
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+class Heater(object):
+    """
+    First order heater model, the temperature approaches the target
+    exponentially with **time_constant** seconds.
+    """
+
+    def __init__(self, ambient = 25.0, time_constant = 10.0):
+        self.ambient = ambient
+        self.time_constant = time_constant
+        self.temperature = ambient
+        self.target = 0.0
+
+    def update(self, dt):
+        target = max(self.target, self.ambient)
+        self.temperature += (target - self.temperature) * (1.0 - math.exp(-dt / self.time_constant))
+
+    def reached(self, hysteresis):
+        return abs(self.temperature - max(self.target, self.ambient)) <= hysteresis
+
+
+class TotumduinoEmulator(object):
+    """
+    Emulated Totumduino board on a pseudo terminal.
+
+    The model follows the Marlin main loop: received bytes go to an RX ring
+    buffer, complete lines are moved to a small command buffer (where line
+    numbers and checksums are checked) and commands are executed one at a
+    time. ``ok`` is sent when a command has been executed, moves are
+    executed by adding them to the planner buffer and block while it is full.
+
+    :param speed: Simulation speed factor, 10.0 runs moves and heating ten times faster
+    :param rx_buffer_size: RX ring buffer size, received data not fitting is dropped
+    :param command_buffer_size: Number of lines buffered ahead of execution
+    :param planner_size: Planner buffer size in moves
+    :param corrupt_rate: Probability of corrupting a received line
+    :param seed: Random seed used for line corruption
+    """
+
+    RX_BUFFER_SIZE      = 128
+    COMMAND_BUFFER_SIZE = 4
+    PLANNER_SIZE        = 16
+    TEMP_HYSTERESIS     = 1.0
+    # Interval of temperature reports while waiting for M109/M190
+    TEMP_REPORT_INTERVAL = 1.0
+    # Duration of G28 in seconds
+    HOMING_TIME         = 5.0
+    # Feedrate in mm/min used until F is specified
+    DEFAULT_FEEDRATE    = 3000.0
+    # Longest sleep of the emulator loop in seconds
+    POLL_INTERVAL       = 0.1
+
+    def __init__(self, speed = 1.0, rx_buffer_size = RX_BUFFER_SIZE,
+                    command_buffer_size = COMMAND_BUFFER_SIZE,
+                    planner_size = PLANNER_SIZE, corrupt_rate = 0.0, seed = 0):
+        self.speed = float(speed)
+        self.rx_buffer_size = rx_buffer_size
+        self.command_buffer_size = command_buffer_size
+        self.planner_size = planner_size
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+
+        self.running = False
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.lock = RLock()
+
+        self.rx = bytearray()
+        self.commands = deque()
+        self.last_line = 0
+
+        # Machine state
+        self.position = {'X' : 0.0, 'Y' : 0.0, 'Z' : 0.0, 'E' : 0.0}
+        self.relative = False
+        self.relative_e = False
+        self.feedrate = self.DEFAULT_FEEDRATE
+        self.extruder = Heater(time_constant = 10.0)
+        self.bed = Heater(time_constant = 60.0)
+        self.fan = 0
+        self.error_code = 0
+        self.error_on = {}
+        self.on_error = None
+
+        # Planner, durations of queued moves in simulated seconds
+        self.planner = deque()
+        self.head_end = 0.0
+
+        # Command being executed that is waiting for something
+        self.blocked = None
+        self.blocked_until = 0.0
+        self.next_report = 0.0
+
+        self.clock_start = time.time()
+        self.clock_last = 0.0
+
+        self.stats = {
+            'received_lines'    : 0,
+            'executed'          : 0,
+            'moves'             : 0,
+            'resends'           : 0,
+            'corrupted'         : 0,
+            'rx_overflow_bytes' : 0,
+            'planner_full'      : 0
+        }
+
+    """ Internal *private* functions """
+
+    def clock(self):
+        """
+        Return the simulated time in seconds.
+        """
+        return (time.time() - self.clock_start) * self.speed
+
+    def __write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError as e:
+            if e.errno not in (errno.EIO, errno.EBADF):
+                raise
+
+    def __reply(self, *lines):
+        self.__write( ''.join(line + '\n' for line in lines) )
+
+    def __checksum(self, data):
+        return reduce(operator.xor, bytearray(data), 0)
+
+    def __request_resend(self, error):
+        """
+        Reject the current line the way Marlin does: report the error,
+        request the line after the last accepted one and flush the RX buffer.
+        """
+        self.stats['resends'] += 1
+        del self.rx[:]
+        self.__reply('Error:{0}, Last Line: {1}'.format(error, self.last_line),
+                     'Resend: {0}'.format(self.last_line + 1),
+                     'ok')
+
+    def __receive(self):
+        """
+        Move received bytes into the RX ring buffer.
+        """
+        try:
+            data = os.read(self.master, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EIO):
+                return
+            raise
+
+        free = self.rx_buffer_size - 1 - len(self.rx)
+        if len(data) > free:
+            self.stats['rx_overflow_bytes'] += len(data) - max(free, 0)
+            data = data[:max(free, 0)]
+        self.rx.extend(data)
+
+    def __get_commands(self):
+        """
+        Move complete lines from the RX buffer to the command buffer.
+        """
+        while len(self.commands) < self.command_buffer_size:
+            idx = self.rx.find(b'\n')
+            if idx == -1:
+                return
+            line = str(self.rx[:idx]).strip()
+            del self.rx[:idx+1]
+
+            if not line:
+                continue
+
+            self.stats['received_lines'] += 1
+
+            if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+                self.stats['corrupted'] += 1
+                pos = self.random.randrange(len(line))
+                line = line[:pos] + '#' + line[pos+1:]
+
+            if line[0] == 'N' or '*' in line:
+                if line[0] != 'N':
+                    self.__request_resend('No Line Number with checksum')
+                    return
+                if '*' not in line:
+                    self.__request_resend('No Checksum with line number')
+                    return
+
+                body, checksum = line.rsplit('*', 1)
+                tags = body.split(' ', 1)
+                try:
+                    line_number = int(tags[0][1:])
+                except ValueError:
+                    line_number = -1
+
+                code = ''
+                if len(tags) > 1:
+                    code = tags[1].strip()
+
+                if line_number != self.last_line + 1 and not code.startswith('M110'):
+                    self.__request_resend('Line Number is not Last Line Number+1')
+                    return
+
+                if not checksum.strip().isdigit() or int(checksum) != self.__checksum(body):
+                    self.__request_resend('checksum mismatch')
+                    return
+
+                self.last_line = line_number
+                line = code
+
+            # Comments are not part of the command
+            line = line.split(';', 1)[0].strip()
+            if line:
+                self.commands.append(line)
+            else:
+                self.__reply('ok')
+
+    def __advance(self, now):
+        """
+        Advance planner and heaters to simulated time **now**.
+        """
+        dt = now - self.clock_last
+        if dt > 0:
+            self.extruder.update(dt)
+            self.bed.update(dt)
+        self.clock_last = now
+
+        while self.planner and self.head_end <= now:
+            self.planner.popleft()
+            if self.planner:
+                self.head_end += self.planner[0]
+
+    def __enqueue_move(self, duration, now):
+        if not self.planner:
+            self.head_end = now + duration
+        self.planner.append(duration)
+        self.stats['moves'] += 1
+
+    def __params(self, code):
+        params = {}
+        for tag in code.split()[1:]:
+            try:
+                params[tag[0].upper()] = float(tag[1:])
+            except ValueError:
+                params[tag[0].upper()] = None
+        return params
+
+    def __temperatures(self):
+        return 'T:{0:.1f} /{1:.1f} B:{2:.1f} /{3:.1f} @:0 B@:0'.format(
+                    self.extruder.temperature, self.extruder.target,
+                    self.bed.temperature, self.bed.target)
+
+    def __move_duration(self, params, code):
+        """
+        Update the position and return the move duration in seconds.
+        """
+        if params.get('F'):
+            self.feedrate = params['F']
+
+        distance = 0.0
+        for axis in 'XYZ':
+            value = params.get(axis)
+            if value is None:
+                continue
+            target = self.position[axis] + value if self.relative else value
+            distance += (target - self.position[axis]) ** 2
+            self.position[axis] = target
+        distance = math.sqrt(distance)
+
+        if code in ('G2', 'G3'):
+            # Arc length from the chord and the radius given by I/J
+            radius = math.hypot(params.get('I') or 0.0, params.get('J') or 0.0)
+            if radius > 0 and distance > 0:
+                distance = 2.0 * radius * math.asin( min(1.0, distance / (2.0 * radius)) )
+
+        value = params.get('E')
+        if value is not None:
+            target = self.position['E'] + value if (self.relative or self.relative_e) else value
+            distance = max(distance, abs(target - self.position['E']))
+            self.position['E'] = target
+
+        if self.feedrate <= 0:
+            return 0.0
+        return distance / (self.feedrate / 60.0)
+
+    def __execute(self, code, now):
+        """
+        Execute **code**. Returns ``True`` when done, ``False`` if it has to
+        wait (the command is retried later).
+        """
+        tags = code.split()
+        name = tags[0].upper()
+        params = self.__params(code)
+
+        if name in self.error_on:
+            self.trigger_error( self.error_on.pop(name) )
+
+        if self.error_code and name not in ('M105', 'M730', 'M999'):
+            # Stopped because of an error, commands have no effect
+            self.__reply('ok')
+            return True
+
+        if name in ('G0', 'G1', 'G2', 'G3'):
+            if len(self.planner) >= self.planner_size:
+                self.stats['planner_full'] += 1
+                return False
+            duration = self.__move_duration(params, name)
+            if duration > 0:
+                self.__enqueue_move(duration, now)
+            self.__reply('ok')
+
+        elif name == 'G4':
+            if self.blocked is None:
+                dwell = (params.get('P') or 0.0) / 1000.0 + (params.get('S') or 0.0)
+                self.blocked_until = None
+                self.blocked = dwell
+            if self.planner:
+                return False
+            if self.blocked_until is None:
+                self.blocked_until = now + self.blocked
+            if now < self.blocked_until:
+                return False
+            self.__reply('ok')
+
+        elif name == 'G28':
+            if self.planner:
+                return False
+            if self.blocked is None:
+                self.blocked = True
+                self.blocked_until = now + self.HOMING_TIME
+            if now < self.blocked_until:
+                return False
+            for axis in 'XYZ':
+                self.position[axis] = 0.0
+            self.__reply('ok')
+
+        elif name == 'G90':
+            self.relative = False
+            self.relative_e = False
+            self.__reply('ok')
+
+        elif name == 'G91':
+            self.relative = True
+            self.__reply('ok')
+
+        elif name == 'M82':
+            self.relative_e = False
+            self.__reply('ok')
+
+        elif name == 'M83':
+            self.relative_e = True
+            self.__reply('ok')
+
+        elif name == 'G92':
+            for axis in 'XYZE':
+                if params.get(axis) is not None:
+                    self.position[axis] = params[axis]
+            self.__reply('ok')
+
+        elif name == 'M400':
+            if self.planner:
+                return False
+            self.__reply('ok')
+
+        elif name in ('M104', 'M109'):
+            if self.blocked is None:
+                self.extruder.target = params.get('S') or 0.0
+                self.blocked = True
+                self.next_report = now
+            if name == 'M109' and not self.extruder.reached(self.TEMP_HYSTERESIS):
+                if now >= self.next_report:
+                    self.__reply('T:{0:.1f} E:0 W:?'.format(self.extruder.temperature))
+                    self.next_report = now + self.TEMP_REPORT_INTERVAL
+                return False
+            self.__reply('ok')
+
+        elif name in ('M140', 'M190'):
+            if self.blocked is None:
+                self.bed.target = params.get('S') or 0.0
+                self.blocked = True
+                self.next_report = now
+            if name == 'M190' and not self.bed.reached(self.TEMP_HYSTERESIS):
+                if now >= self.next_report:
+                    self.__reply('T:{0:.1f} E:0 B:{1:.1f}'.format(self.extruder.temperature, self.bed.temperature))
+                    self.next_report = now + self.TEMP_REPORT_INTERVAL
+                return False
+            self.__reply('ok')
+
+        elif name == 'M105':
+            self.__reply('ok ' + self.__temperatures())
+
+        elif name == 'M106':
+            self.fan = int(params.get('S') or 255)
+            self.__reply('ok')
+
+        elif name == 'M107':
+            self.fan = 0
+            self.__reply('ok')
+
+        elif name == 'M110':
+            if params.get('N') is not None:
+                self.last_line = int(params['N'])
+            self.__reply('ok')
+
+        elif name == 'M114':
+            self.__reply('X:{X:.2f} Y:{Y:.2f} Z:{Z:.2f} E:{E:.2f}'.format(**self.position), 'ok')
+
+        elif name == 'M730':
+            self.__reply('ERROR : {0}'.format(self.error_code), 'ok')
+
+        elif name == 'M999':
+            self.error_code = 0
+            self.__reply('ok')
+
+        elif name[0] in 'GMT' and name[1:].isdigit():
+            self.__reply('ok')
+
+        else:
+            self.__reply('echo:Unknown command: "{0}"'.format(code), 'ok')
+
+        return True
+
+    def __process(self, now):
+        """
+        Execute buffered commands until one has to wait.
+        """
+        while self.commands:
+            if not self.__execute(self.commands[0], now):
+                return
+            self.commands.popleft()
+            self.blocked = None
+            self.blocked_until = 0.0
+            self.stats['executed'] += 1
+            # Executing a command frees space in the command buffer
+            self.__get_commands()
+
+    def __next_event(self, now):
+        """
+        Return the simulated time of the next internal event.
+        """
+        events = []
+        if self.planner:
+            events.append(self.head_end)
+        if self.blocked is not None:
+            if self.blocked_until:
+                events.append(self.blocked_until)
+            events.append(self.next_report)
+        if not events:
+            return None
+        return min(events)
+
+    def __loop(self):
+        while self.running:
+            with self.lock:
+                now = self.clock()
+                self.__advance(now)
+                self.__get_commands()
+                self.__process(now)
+                next_event = self.__next_event(now)
+
+            timeout = self.POLL_INTERVAL
+            if next_event is not None:
+                timeout = min(timeout, max(0.0, (next_event - now) / self.speed))
+
+            try:
+                readable, writable, exceptional = select.select([self.master], [], [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if readable:
+                with self.lock:
+                    self.__receive()
+
+    """ APIs *public* functions """
+
+    def start(self):
+        """
+        Create the pseudo terminal and start the emulator thread.
+
+        :returns: Serial port name
+        :rtype: string
+        """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.running = True
+        self.thread = Thread( target = self.__loop )
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self.port
+
+    def stop(self):
+        """
+        Stop the emulator thread and close the pseudo terminal.
+        """
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def trigger_error(self, error_code):
+        """
+        Put the board into error state, like a triggered safety check.
+        The error code is reported by M730 and cleared by M999.
+
+        :param error_code: Error code, see ``fabtotum.totumduino.gcode.ERROR_CODES``
+        :type error_code: int
+        """
+        with self.lock:
+            self.error_code = int(error_code)
+            # Heaters are turned off, a waiting command is released by __execute
+            self.extruder.target = 0.0
+            self.bed.target = 0.0
+        if self.on_error:
+            self.on_error(self.error_code)
+
+    def get_stats(self):
+        """
+        Return emulator counters.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats['planner'] = len(self.planner)
+            stats['extruder'] = self.extruder.temperature
+            stats['bed'] = self.bed.temperature
+        return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Totumduino firmware emulator")
+    parser.add_argument("--link",       help="Create a symlink to the serial port", default=None)
+    parser.add_argument("--speed",      help="Simulation speed factor", type=float, default=1.0)
+    parser.add_argument("--corrupt",    help="Probability of corrupting a received line", type=float, default=0.0)
+    args = parser.parse_args()
+
+    emulator = TotumduinoEmulator(speed=args.speed, corrupt_rate=args.corrupt)
+    port = emulator.start()
+
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(port, args.link)
+        print "Totumduino emulator on {0} ({1})".format(port, args.link)
+    else:
+        print "Totumduino emulator on {0}".format(port)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    emulator.stop()
+    if args.link:
+        os.remove(args.link)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import standard python module
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+class LineFramer(object):
+    """
+    Split a stream of received data into lines.
+
+    Received data is appended to a reusable buffer and the terminators are
+    located by scanning from an offset. Each line is copied out exactly once
+    and the consumed part of the buffer is discarded once per :func:`feed`
+    call instead of once per line.
+
+    Usage::
+
+        framer = LineFramer(b'\\n')
+        for line in framer.feed(data):
+            handle_line(line)
+
+    :param terminator: Line terminator
+    :type terminator: bytes
+    """
+
+    def __init__(self, terminator = b'\n'):
+        self.terminator = terminator
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Append **data** to the buffer and iterate over all complete lines.
+        Lines are returned without the terminator, incomplete data is kept
+        until the rest of the line is received.
+
+        :param data: Received data
+        :type data: bytes
+        :returns: Iterator of lines
+        :rtype: bytearray
+        """
+        buf = self.buffer
+        buf.extend(data)
+
+        term = self.terminator
+        term_len = len(term)
+        start = 0
+        end = buf.find(term)
+
+        try:
+            while end != -1:
+                line = buf[start:end]
+                start = end + term_len
+                yield line
+                end = buf.find(term, start)
+        finally:
+            # Drop consumed data, also when the iteration was interrupted
+            if start:
+                del buf[:start]
+
+    def clear(self):
+        """
+        Discard buffered data.
+        """
+        del self.buffer[:]
+
+    def pending(self):
+        """
+        Return number of buffered bytes not yet terminated.
+        """
+        return len(self.buffer)
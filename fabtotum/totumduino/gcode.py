@@ -22,7 +22,9 @@
 # Import standard python module
 import time
 import re
-from threading import Event, Thread
+import heapq
+from collections import deque
+from threading import Event, Thread, Condition, Lock
 try:
     import queue
 except ImportError:
@@ -33,8 +35,16 @@ import serial
 
 # Import internal modules
 from fabtotum.utils.singleton import Singleton
-from fabtotum.utils.gcodefile import GCodeFile
+from fabtotum.utils.future import Future, TimeoutError
+from fabtotum.debug.trace import Trace
+from fabtotum.utils.gcodefile import GCodeFile, GCodeInfo, frame_line
+from fabtotum.utils.gcodecache import AnalysisCache
+from fabtotum.utils.gcodefilter import BandwidthFilter
+from fabtotum.utils.gcodetime import remaining_time
 from fabtotum.totumduino.hooks import action_hook
+from fabtotum.totumduino.framing import LineFramer
+from fabtotum.totumduino.latency import LatencyStats, command_code
+from fabtotum.totumduino.recovery import ModalState, CheckpointWriter, file_identity, same_file, resume_gcode
 from fabtotum.totumduino.hardware import reset as totumduino_reset
 from fabtotum.totumduino.hardware import startup as totumduino_startup
 
@@ -95,6 +105,20 @@ class Command(object):
         self.__ev = Event()
         self.expected_reply = expected_reply
         self.group = group
+        # Number of bytes this command occupies in the Totumduino RX buffer
+        # while it is waiting for an acknowledge.
+        self.tx_bytes = 0
+        # Line number used for N/* framing (checksum mode only)
+        self.line_number = None
+        # Priority lane and time of queuing, used for injection latency
+        self.lane = None
+        self.time_queued = None
+        # Time of writing to serial, used for acknowledge latency
+        self.time_sent = None
+        # Acknowledge sequence number of file lines
+        self.seq = None
+        # Future resolved with the reply (event loop engine)
+        self.future = None
 
     def __str__(self):
         msg = 'cmd: ' + self.id
@@ -112,6 +136,12 @@ class Command(object):
         else:
             return NotImplemented
     
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
     def notify(self):
         """
         Notify the waiting thread that the reply has been received.
@@ -201,17 +231,226 @@ class Command(object):
         :param z: Amount by which to modify z axis.
         :type z: float
         """
-        return cls(Command.ZPLUS, z)
+        return cls(Command.ZMODIFY, z)
 
     @classmethod
-    def file(cls, filename):
+    def file(cls, filename, checkpoint = None, arc_tolerance = None, compact = False):
         """
         Constructor for ``FILE`` command.
         
         :param filename: Filename of file to be pushed.
+        :param checkpoint: Recovery checkpoint to continue from
+        :param arc_tolerance: Push an arc fitted copy of the file, see :func:`GCodeFile.fit_arcs`
+        :param compact: Pass the file through a :class:`BandwidthFilter`
         :type filename: string
+        :type checkpoint: dict
+        :type arc_tolerance: float
+        :type compact: bool
+        """
+        cmd = cls(Command.FILE, filename, 'file')
+        cmd.checkpoint = checkpoint
+        cmd.arc_tolerance = arc_tolerance
+        cmd.compact = compact
+        # Set by GCodeService before the command is queued
+        cmd.gfile = None
+        cmd.layer_index = None
+        cmd.time_estimate = None
+        cmd.frames = None
+        cmd.identity = None
+        return cmd
+
+
+class FileLine(object):
+    """
+    Lightweight record of a file line sent to Totumduino. Nobody waits for
+    the reply of an ordinary file line, so it has no event and no reply
+    list. Completion is tracked by its acknowledge sequence number **seq**,
+    file lines are acknowledged in the order they were sent.
+    
+    File lines that have to be waited for (M109, M190, G28) are sent as
+    ``Command`` objects with a sequence number.
+    
+    :param data: GCode line without line terminator
+    :param seq: Acknowledge sequence number
+    :type data: string
+    :type seq: int
+    """
+    
+    __slots__ = ('data', 'seq', 'tx_bytes', 'line_number', 'time_sent')
+    
+    # Read-only attributes shared with Command
+    id = Command.GCODE
+    group = 'file'
+    expected_reply = 'ok'
+    reply = None
+    lane = None
+    time_queued = None
+    future = None
+    
+    def __init__(self, data, seq):
+        self.data = data
+        self.seq = seq
+        self.tx_bytes = 0
+        self.line_number = None
+        self.time_sent = None
+    
+    def __str__(self):
+        return 'file line: ' + str(self.seq) + ', data: ' + self.data
+    
+    def notify(self):
+        pass
+    
+    def hasExpectedReply(self, line):
+        return line[:2] == 'ok'
+
+class CommandLanes(object):
+    """
+    Priority lanes of commands waiting for the sender thread. Commands are
+    served from the highest priority non-empty lane, in order of queuing
+    within a lane.
+    
+    The lanes share the condition variable of the streaming window so a
+    sender waiting for window space or for a barrier reply is woken up as
+    soon as a higher priority command is queued.
+    
+    :param cond: Condition variable used for waiting and notification
+    :type cond: threading.Condition
+    """
+    
+    EMERGENCY   = 0
+    INTERACTIVE = 1
+    FILE        = 2
+    
+    NAMES = ('emergency', 'interactive', 'file')
+    
+    def __init__(self, cond):
+        self.cond = cond
+        self.lanes = ( deque(), deque(), deque() )
+        self.stats = [ {'count' : 0, 'total' : 0.0, 'max' : 0.0, 'last' : 0.0} for name in self.NAMES ]
+    
+    def put(self, cmd, lane):
+        """
+        Queue **cmd** in **lane**.
+        """
+        cmd.lane = lane
+        cmd.time_queued = time.time()
+        with self.cond:
+            self.lanes[lane].append(cmd)
+            self.cond.notify_all()
+    
+    def put_many(self, cmds, lane):
+        """
+        Queue all **cmds** in **lane** at once, no other command of the
+        same lane gets in between.
+        """
+        now = time.time()
+        for cmd in cmds:
+            cmd.lane = lane
+            cmd.time_queued = now
+        with self.cond:
+            self.lanes[lane].extend(cmds)
+            self.cond.notify_all()
+    
+    def pending(self, below = FILE + 1):
+        """
+        Return ``True`` if there is a command in a lane with higher priority
+        than **below**.
+        """
+        for lane in xrange(below):
+            if self.lanes[lane]:
+                return True
+        return False
+    
+    def peek(self, below = FILE + 1):
+        """
+        Return the next command from lanes with higher priority than **below**
+        without removing it, ``None`` if there is no such command.
+        """
+        with self.cond:
+            for lane in xrange(below):
+                if self.lanes[lane]:
+                    return self.lanes[lane][0]
+        return None
+    
+    def get_nowait(self, below = FILE + 1):
+        """
+        Return the next command from lanes with higher priority than **below**.
+        
+        :raises queue.Empty: No such command is queued
+        """
+        with self.cond:
+            for lane in xrange(below):
+                if self.lanes[lane]:
+                    cmd = self.lanes[lane].popleft()
+                    if cmd != Command.GCODE:
+                        # Control commands take effect when served,
+                        # gcode when it is written to the serial port
+                        self.record(cmd)
+                    return cmd
+        raise queue.Empty
+    
+    def get(self):
+        """
+        Block until a command is queued and return it.
+        """
+        with self.cond:
+            while not self.pending():
+                # put() notifies, a timed wait would poll on Python 2
+                self.cond.wait()
+            return self.get_nowait()
+    
+    def clear(self):
+        """
+        Remove and return all queued commands.
+        """
+        with self.cond:
+            cmds = []
+            for lane in self.lanes:
+                cmds.extend(lane)
+                lane.clear()
+            return cmds
+    
+    def record(self, cmd):
+        """
+        Record the injection latency of **cmd**, time from queuing until
+        it was written to the serial port.
+        """
+        if cmd.time_queued is None or cmd.lane is None:
+            return
+        
+        latency = time.time() - cmd.time_queued
+        cmd.time_queued = None
+        
+        stats = self.stats[cmd.lane]
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['last'] = latency
+        if latency > stats['max']:
+            stats['max'] = latency
+    
+    def get_stats(self):
+        """
+        Return injection latency statistics per lane.
+        
+        :returns: Dictionary of lane names with ``count``, ``mean``, ``max``,
+                  ``last`` and ``queued`` keys, latencies are in seconds.
+        :rtype: dict
         """
-        return cls(Command.FILE, filename, 'file')
+        result = {}
+        with self.cond:
+            for lane, name in enumerate(self.NAMES):
+                stats = self.stats[lane]
+                mean = 0.0
+                if stats['count']:
+                    mean = stats['total'] / stats['count']
+                result[name] = {
+                    'count'     : stats['count'],
+                    'mean'      : mean,
+                    'max'       : stats['max'],
+                    'last'      : stats['last'],
+                    'queued'    : len(self.lanes[lane])
+                }
+        return result
 
 
 class GCodeService:
@@ -281,12 +520,59 @@ class GCodeService:
     READ_TERM    = b'\n'
     ENCODING = 'utf-8'
     UNICODE_HANDLING = 'replace'
+    # Most frequent reply, handled without decoding
+    OK_REPLY_RAW = b'ok'
+    OK_REPLY     = u'ok'
     
-    REPLY_QUEUE_SIZE = 1
-        
-    def __init__(self, serial_port, serial_baud, serial_timeout = 5, use_checksum = False):
+    # Totumduino serial RX ring buffer size in bytes (Marlin RX_BUFFER_SIZE
+    # is 128, one byte is kept free by the ring buffer implementation).
+    RX_BUFFER_SIZE = 127
+    # Maximal number of unacknowledged commands in flight. Setting it to 1
+    # restores the old stop-and-wait behaviour.
+    STREAM_WINDOW = 4
+    # Number of framed lines kept for retransmission (checksum mode only)
+    RESEND_HISTORY = 64
+    # Time in seconds without any reply after which a retransmission is
+    # considered lost (checksum mode only)
+    RESEND_TIMEOUT = 1.0
+    # Number of records kept in the trace ring buffer
+    TRACE_SIZE = 4096
+    # Maximum number of callback events waiting to be dispatched
+    CALLBACK_QUEUE_SIZE = 256
+    # Callback events carrying a state, only the most recent one is delivered
+    CALLBACK_COALESCE = ('temp_change:ext', 'temp_change:all')
+    # Codes sent through the emergency lane
+    EMERGENCY_CODES = ('M112', 'M730', 'M999')
+    # Codes the file push waits for before sending the next line
+    BARRIER_CODES = ('M109', 'M190', 'G28')
+    # Number of acknowledge latency samples kept per command group
+    ACK_LATENCY_SIZE = 4096
+    # File line codes whose absolute Z word is shifted by the live Z adjustment
+    Z_OFFSET_CODES = ('G0', 'G1', 'G2', 'G3', 'G92')
+    # First and longest delay in seconds between attempts to reopen a lost
+    # serial port, the delay doubles after every failed attempt
+    RECONNECT_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 8.0
+    # File push is resumed after a shorter serial outage in seconds and
+    # aborted after a longer one
+    RESUME_TIMEOUT = 60.0
+    # Interval in seconds between taking recovery checkpoints of a file
+    # push and between writing them
+    CHECKPOINT_STEP = 0.5
+    CHECKPOINT_INTERVAL = 2.0
+    # Acknowledged file lines that may still be waiting in Totumduino
+    # planner and command buffer, a checkpoint is written once it is
+    # older than that
+    CHECKPOINT_MARGIN = 24
+        
+    def __init__(self, serial_port, serial_baud, serial_timeout = 5, use_checksum = False,
+                    rx_buffer_size = RX_BUFFER_SIZE, stream_window = STREAM_WINDOW,
+                    trace_level = Trace.OFF, latency_file = None, recovery_file = None,
+                    steps_per_mm = None, analysis_cache = None, machine_profile = None):
         self.running = False
+        self.trace = Trace(self.TRACE_SIZE, trace_level)
         self.is_resetting = False
+        self.state = GCodeService.IDLE
         self.SERIAL_PORT = serial_port
         self.SERIAL_BAUD = serial_baud
         self.SERIAL_TIMEOUT = serial_timeout
@@ -298,80 +584,648 @@ class GCodeService:
                                 timeout = serial_timeout
                                 )
         self.serial.flushInput()
-        self.buffer = bytearray()
+        self.framer = LineFramer(self.READ_TERM)
+        
+        # Serial connection supervision
+        self.connected = True
+        self.ev_stop = Event()
+        self.outage_started = None
+        self.outage_aborted = False
+        self.recovery_started = None
+        self.recovery_cmd = None # First command sent after reopening the port
+        self.connection_stats = {
+            'outages'       : 0, # Number of serial connection losses
+            'resumed'       : 0, # File pushes resumed after an outage
+            'aborted'       : 0, # File pushes aborted after a too long outage
+            'retransmitted' : 0, # Unacknowledged lines sent again after an outage
+            'last_outage'   : 0.0, # From losing the connection until the port was reopened
+            'last_recovery' : 0.0, # From reopening the port until Totumduino replied
+            'total_outage'  : 0.0
+        }
         
         # Inter-thread communication
         # Must be defined before any thread is created
-        self.cq = queue.Queue() # Command Queue
-        self.rq = queue.Queue(self.REPLY_QUEUE_SIZE) # Reply Queue
+        self.rq = queue.Queue() # Reply Queue, commands waiting for a reply in order of sending
         self.active_cmd = None
         self.wait_for_cmd = None
         self.ev_tx_started = Event()
         self.ev_rx_started = Event()
         
+        # Streaming window, Totumduino RX buffer accounting
+        self.rx_buffer_size = rx_buffer_size
+        self.stream_window = max(1, stream_window)
+        self.tx_cond = Condition()
+        # Command lanes (emergency, interactive, file)
+        self.lanes = CommandLanes(self.tx_cond)
+        self.tx_pending_bytes = 0
+        self.tx_pending_lines = 0
+        self.stream_stats = {}
+        self.stall_time = 0.0
+        self.barrier_time = 0.0
+        self.arc_fit = None # Arc fitting report of the pushed file
+        # Layer index, print time estimate and line iterator of the pushed file
+        self.layer_index = None
+        self.time_estimate = None
+        self.file_lines = None
+        # Planner limits used to estimate print time, see gcodetime.machine_profile
+        self.machine_profile = machine_profile
+        # Stream stage of compacted file pushes, see BandwidthFilter
+        self.stream_filter = None
+        self.steps_per_mm = steps_per_mm
+        # File analysis kept between pushes of the same file
+        self.analysis_cache = None
+        if analysis_cache:
+            self.analysis_cache = AnalysisCache(analysis_cache)
+        self.ack_latency = {}
+        # Reply latency per G/M code, kept in latency_file between restarts
+        self.latency = LatencyStats()
+        self.latency_file = latency_file
+        self.slow_commands = 0
+        
         self.file_time_started = None
         self.file_time_finished = None
         self.idle_time_started = time.time()
         self.progress = 0.0
         self.current_line_number = 0
         self.total_line_number = 0
+        # Acknowledge sequence numbers of the last sent and last
+        # acknowledged file line
+        self.file_seq = 0
+        self.file_acked = 0
+        
+        # Power-loss recovery checkpoints
+        self.recovery = None
+        if recovery_file:
+            self.recovery = CheckpointWriter(recovery_file)
+        self.modal = ModalState()
+        self.checkpoints = deque() # Checkpoints waiting for their lines to be acknowledged
+        self.checkpoint_written = 0.0
+        
+        # Live Z adjustment
+        self.z_override = 0.0
+        self.z_relative = False # File push is in relative mode (G91)
+        self.z_requests = deque() # Request time of queued adjustments
+        self.z_pending = deque() # Injected Z moves waiting for a reply
+        self.z_stats = {
+            'count'         : 0, # Number of applied adjustments
+            'total'         : 0.0,
+            'last'          : 0.0,
+            'max'           : 0.0
+        }
         
         # Note: experimental feature
         self.use_checksum = use_checksum
         self.line_number = 0
+        self.tx_line_number = 0 # Line number of the last written line
+        # Resend support (checksum mode only)
+        self.tx_history = deque(maxlen=self.RESEND_HISTORY)
+        self.resend_backlog = deque()
+        self.resync_entry = None
+        self.resend_restart = None # [line number, stale requests, ignored requests] of the last restart
+        self.reject_ok_pending = 0
+        self.resend_stats = {
+            'requests'      : 0, # Number of Resend: requests received
+            'ignored'       : 0, # Requests caused by lines sent before the retransmission
+            'stalled'       : 0, # Retransmissions sent again after RESEND_TIMEOUT
+            'failed'        : 0, # Requested line was not in the history anymore
+            'lost'          : 0, # Lines given up on because of a failed request
+            'lines'         : 0, # Number of retransmitted lines
+            'bytes'         : 0  # Number of retransmitted bytes
+        }
         
         self.group_ack = {'gcode' : 0, 'file' : 0, 'gmacro' : 0}
         self.atomic_group = None
         
         # Callback handler
         self.callback = None
+        self.eq = queue.Queue(self.CALLBACK_QUEUE_SIZE) # Event Queue, callback events in order of triggering
+        self.eq_latest = {}
+        self.eq_lock = Lock()
+        # Deadlines of send_async() futures and slow command thresholds,
+        # expired by the dispatcher thread
+        self.async_timeouts = []
+        self.callback_stats = {
+            'dispatched'    : 0, # Number of delivered events
+            'dropped'       : 0, # Events dropped because the event queue was full
+            'coalesced'     : 0  # Events replaced by a more recent one of the same type
+        }
     
     """ Internal *private* functions """
     
-    def __file_done_thread(self, last_command):
+    def __file_done_thread(self, last_seq):
         """
-        To ensure that the callback function cannot block sender/receiver threads
-        calling it must be done from a separate thread.
+        Wait for the last file line in a separate thread so that neither the
+        sender nor the receiver thread blocks. ``file_done`` is delivered by
+        the dispatcher thread after the callbacks triggered before it.
         """
-        print "waiting for last_command", last_command
-        last_command.wait()
+        self.trace.debug("waiting for file line {0}", last_seq)
+        with self.tx_cond:
+            while self.running and self.file_acked < last_seq:
+                self.tx_cond.wait(0.5)
+        
+        self.file_time_finished = time.time()
+        self.__update_stream_stats()
+        self.trace.info("stream stats: {0}", self.stream_stats)
         
         self.progress = 100.0
         
         self.state = GCodeService.IDLE
         
-        if self.callback:
-            self.callback('file_done', None)
-            
-        self.progress = 0.0
+        # Must not be dropped, waits for room in the event queue
+        self.__trigger_callback('file_done', None, block = True)
     
-    def __trigger_file_done(self, last_command):
+    def __trigger_file_done(self, last_seq):
         callback_thread = Thread( 
                 target = self.__file_done_thread, 
-                args=( [last_command] ) 
+                args=( [last_seq] ) 
                 )
         callback_thread.start()
         
-    def __callback_thread(self, callback_name, data):
-        if self.callback:
-            self.callback(callback_name, data)
+    def __callback_thread(self):
+        """
+        Callback dispatcher thread. Events are delivered one at a time in
+        the order they were triggered.
+        """
+        while True:
+            timeout = self.__expire_futures()
+            try:
+                callback_name, data = self.eq.get(True, timeout)
+            except queue.Empty:
+                continue
+            
+            if callback_name is None:
+                break
+            
+            if not callback_name:
+                # Woken up for a new send_async() deadline
+                continue
+            
+            if callback_name in self.CALLBACK_COALESCE:
+                with self.eq_lock:
+                    data = self.eq_latest.pop(callback_name, None)
+            
+            if self.callback:
+                try:
+                    self.callback(callback_name, data)
+                except Exception as e:
+                    self.trace.error("callback {0} failed: {1}", callback_name, e)
+            
+            if callback_name == 'file_done':
+                # See get_progress()
+                self.progress = 0.0
+            
+            with self.eq_lock:
+                self.callback_stats['dispatched'] += 1
+        
+    def __add_deadline(self, deadline, item):
+        """
+        Register a send_async() future or a slow command threshold with
+        the dispatcher thread, see :func:`__expire_futures`.
+        """
+        with self.eq_lock:
+            heapq.heappush(self.async_timeouts, (deadline, id(item), item))
+            first = self.async_timeouts[0][2] is item
+        if first:
+            # Wake up the dispatcher to wait for the earlier deadline
+            try:
+                self.eq.put_nowait( ('', None) )
+            except queue.Full:
+                pass
+    
+    def __expire_futures(self):
+        """
+        Fail send_async() futures whose timeout has expired and signal
+        commands still waiting for a reply after their slow threshold.
         
-    def __trigger_callback(self, callback_name, data):
-        print "trigger_callback", callback_name, data
-        callback_thread = Thread( 
-                target = self.__callback_thread, 
-                args=( [callback_name, data] ) 
-                )
-        callback_thread.start()
+        :returns: Time in seconds until the next deadline, ``None`` if there is none
+        """
+        now = time.time()
+        expired = []
+        slow = []
+        
+        with self.eq_lock:
+            while self.async_timeouts:
+                deadline, key, item = self.async_timeouts[0]
+                if isinstance(item, Command):
+                    done = item.wait(0)
+                else:
+                    done = item.done()
+                if deadline > now and not done:
+                    break
+                heapq.heappop(self.async_timeouts)
+                if done:
+                    continue
+                if isinstance(item, Command):
+                    slow.append(item)
+                else:
+                    expired.append(item)
+            
+            timeout = None
+            if self.async_timeouts:
+                timeout = self.async_timeouts[0][0] - now
+        
+        for future in expired:
+            future.set_exception( TimeoutError() )
+        
+        for cmd in slow:
+            self.__slow_command(cmd, now)
+        
+        return timeout
+    
+    def __slow_command(self, cmd, now):
+        """
+        Signal a command waiting for its reply abnormally long compared to
+        the recorded reply latency of its code with ``slow_command`` callback.
+        """
+        elapsed = now - cmd.time_sent
+        threshold = self.latency.threshold( command_code(cmd.data) )
+        self.slow_commands += 1
+        self.trace.warning("{0} waiting for reply for {1:.2f} s, usually below {2:.2f} s", cmd.data, elapsed, threshold)
+        self.__trigger_callback('slow_command', [cmd.data, elapsed, threshold])
+    
+    def __trigger_callback(self, callback_name, data, block = False):
+        """
+        Queue a callback event for the dispatcher thread. Never blocks unless
+        **block** is set, an event is dropped if the event queue is full.
+        """
+        self.trace.debug("trigger_callback {0} {1}", callback_name, data)
+        
+        if block:
+            self.eq.put( (callback_name, data) )
+            return
+        
+        with self.eq_lock:
+            if callback_name in self.CALLBACK_COALESCE:
+                if callback_name in self.eq_latest:
+                    # Still waiting to be dispatched, just update the state
+                    self.eq_latest[callback_name] = data
+                    self.callback_stats['coalesced'] += 1
+                    return
+                
+                self.eq_latest[callback_name] = data
+                data = None
+            
+            try:
+                self.eq.put_nowait( (callback_name, data) )
+            except queue.Full:
+                self.eq_latest.pop(callback_name, None)
+                self.callback_stats['dropped'] += 1
+                self.trace.warning("callback {0} dropped", callback_name)
+    
+    def __update_stream_stats(self):
+        """
+        Calculate streaming statistics of the current/last file push.
+        """
+        if not self.file_time_started:
+            return
+        
+        finished = self.file_time_finished or time.time()
+        elapsed = finished - self.file_time_started
+        lines = self.group_ack['file']
+        
+        lines_per_second = 0.0
+        if elapsed > 0:
+            lines_per_second = lines / elapsed
+        
+        self.stream_stats = {
+            'lines'             : lines,
+            'elapsed'           : elapsed,
+            'lines_per_second'  : lines_per_second,
+            'stall_time'        : self.stall_time,
+            'barrier_time'      : self.barrier_time,
+            'stream_window'     : self.stream_window,
+            'rx_buffer_size'    : self.rx_buffer_size,
+            'arc_fit'           : self.arc_fit,
+            'compact'           : None
+        }
+        if self.stream_filter:
+            self.stream_stats['compact'] = self.stream_filter.get_stats()
+    
+    def __wait_for_window(self, nbytes):
+        """
+        Block until there is enough free space in the Totumduino RX buffer
+        and in the streaming window to send **nbytes** long command.
+        Must be called with ``tx_cond`` acquired.
+        """
+        while self.running:
+            # Retransmissions have to be written before any new line
+            if not self.resend_backlog and self.__window_fits(nbytes):
+                break
+            if self.resend_restart and self.resend_restart[2]:
+                # Nothing notifies when a retransmission has been dropped
+                self.tx_cond.wait(self.RESEND_TIMEOUT)
+                self.__check_resend_stall()
+                continue
+            # No timeout, a timed wait polls with up to 50 ms sleeps on
+            # Python 2. Acknowledges, queued commands and stop() notify.
+            self.tx_cond.wait()
+    
+    def __window_fits(self, nbytes):
+        """
+        Check whether **nbytes** long command fits into the streaming window.
+        """
+        if not self.connected:
+            return False
+        if not self.tx_pending_lines:
+            return True
+        return ( self.tx_pending_lines < self.stream_window and
+                 self.tx_pending_bytes + nbytes <= self.rx_buffer_size )
+    
+    def __transmit(self, cmd, data, queue_reply = True):
+        """
+        Write **data** to serial and register **cmd** as waiting for a reply.
+        Must be called with ``tx_cond`` acquired.
+        
+        :param queue_reply: Put **cmd** into the reply queue, a retransmitted command is there already
+        """
+        nbytes = len(data)
+        cmd.tx_bytes = nbytes
+        self.tx_pending_bytes += nbytes
+        self.tx_pending_lines += 1
+        # Command has to be in the reply queue before it is written
+        # otherwise a fast reply could be received without a command
+        # waiting for it.
+        if queue_reply:
+            self.rq.put(cmd)
+        cmd.time_sent = time.time()
+        if cmd.line_number is not None:
+            self.tx_line_number = cmd.line_number
+        try:
+            self.serial.write(data)
+        except serial.SerialException as e:
+            # Sent again once the receiver thread has reopened the port
+            self.__connection_lost(e)
+        if queue_reply:
+            self.lanes.record(cmd)
+    
+    def __release_window(self, cmd):
+        """
+        Free the RX buffer space occupied by an acknowledged command.
+        """
+        with self.tx_cond:
+            if cmd.tx_bytes:
+                self.tx_pending_bytes -= cmd.tx_bytes
+                self.tx_pending_lines -= 1
+                cmd.tx_bytes = 0
+            if self.resend_backlog:
+                self.__pump_resend()
+            self.tx_cond.notify_all()
+    
+    def __reset_window(self):
+        """
+        Forget about all in flight commands.
+        """
+        with self.tx_cond:
+            self.tx_pending_bytes = 0
+            self.tx_pending_lines = 0
+            self.tx_history.clear()
+            self.resend_backlog.clear()
+            self.resync_entry = None
+            self.resend_restart = None
+            self.reject_ok_pending = 0
+            self.tx_cond.notify_all()
+    
+    def __pump_resend(self):
+        """
+        Retransmit as many lines from the resend backlog as the streaming
+        window allows. Must be called with ``tx_cond`` acquired.
+        """
+        while self.resend_backlog:
+            data, cmd, queue_reply = self.resend_backlog[0]
+            if not self.__window_fits(len(data)):
+                break
+            self.resend_backlog.popleft()
+            self.trace.debug("<< (resend) {0}", data)
+            self.__transmit(cmd, data, queue_reply)
+            self.resend_stats['lines'] += 1
+            self.resend_stats['bytes'] += len(data)
+        
+        if not self.resend_backlog:
+            self.tx_cond.notify_all()
+    
+    def __handle_resend(self, line):
+        """
+        Process a ``Resend: N`` request. All lines starting with N are
+        retransmitted from the history ring.
+        
+        Totumduino replies to a rejected line with ``Resend: N`` followed by
+        ``ok`` and flushes its RX buffer. Lines that were in flight behind
+        the rejected one reach it before the retransmission and are rejected
+        the same way (line number error) or silently dropped. Up to that many
+        requests of the same line are ignored after a restart, restarting
+        for each of them would reject the retransmitted lines in turn.
+        """
+        try:
+            line_no = int(line.split(':')[1].strip())
+        except (IndexError, ValueError):
+            self.trace.warning("Malformed resend request: {0}", line)
+            return
+        
+        # The ok following Resend: does not belong to any command
+        self.reject_ok_pending += 1
+        
+        with self.tx_cond:
+            self.resend_stats['requests'] += 1
+            
+            restart = self.resend_restart
+            if restart and restart[0] == line_no and restart[1] > 0:
+                # Rejection of a line sent before the retransmission
+                restart[1] -= 1
+                restart[2] += 1
+                self.resend_stats['ignored'] += 1
+                return
+            
+            self.__restart_resend(line_no)
+    
+    def __restart_resend(self, line_no):
+        """
+        Retransmit all lines starting with **line_no**. The rejected commands
+        stay in the reply queue, Totumduino acknowledges every accepted line
+        exactly once and in order of line numbers.
+        Must be called with ``tx_cond`` acquired.
+        """
+        history = list(self.tx_history)
+        start = None
+        
+        if self.resync_entry:
+            # Line number resync (M110) is the only line in flight
+            start = 0
+        elif not history or line_no > history[-1][0]:
+            # A stale copy of an already accepted line has been rejected,
+            # Totumduino is waiting for a line that was not sent yet.
+            self.resend_restart = None
+            self.resend_backlog = deque( entry for entry in self.resend_backlog if entry[2] )
+            self.tx_cond.notify_all()
+            return
+        else:
+            # Find the most recent transmission of the requested line
+            for idx in xrange(len(history)-1, -1, -1):
+                if history[idx][0] == line_no:
+                    start = idx
+                    break
+        
+        if start is None:
+            self.__resend_failed(line_no)
+            return
+        
+        entries = history[start:]
+        
+        waiting = set()
+        if self.active_cmd:
+            waiting.add( id(self.active_cmd) )
+        with self.rq.mutex:
+            for cmd in self.rq.queue:
+                waiting.add( id(cmd) )
+        
+        # Commands sent again after a serial outage enter the reply queue
+        # once they are written
+        unsent = set( id(cmd) for data, cmd, queue_reply in self.resend_backlog if queue_reply )
+        
+        if id(entries[0][2]) not in waiting and id(entries[0][2]) not in unsent:
+            # Already acknowledged, a stale copy has been rejected
+            self.resend_stats['ignored'] += 1
+            return
+        
+        self.resend_backlog.clear()
+        in_flight = 0
+        for line_number, data, cmd in entries:
+            if id(cmd) in unsent:
+                self.resend_backlog.append( (data, cmd, True) )
+            elif id(cmd) in waiting:
+                if cmd.tx_bytes:
+                    # Rejected or dropped by Totumduino
+                    self.tx_pending_bytes -= cmd.tx_bytes
+                    self.tx_pending_lines -= 1
+                    cmd.tx_bytes = 0
+                    in_flight += 1
+                self.resend_backlog.append( (data, cmd, False) )
+        
+        # One of the lines in flight caused this request
+        self.resend_restart = [line_no, max(in_flight - 1, 0), 0]
+        
+        self.__pump_resend()
+    
+    def __resend_failed(self, line_no):
+        """
+        Give up on lines starting with **line_no**, which are not in the
+        history ring anymore. A file push is aborted, commands waiting for
+        one of the lost lines are released without a reply and the line
+        number continues with **line_no** so that Totumduino accepts the
+        following commands.
+        Must be called with ``tx_cond`` acquired.
+        """
+        lost = max(self.tx_line_number - line_no + 1, 0)
+        self.trace.error("Line {0} not in resend history, {1} lines lost", line_no, lost)
+        self.resend_stats['failed'] += 1
+        self.resend_stats['lost'] += lost
+        
+        if self.state in (GCodeService.FILE, GCodeService.PAUSED):
+            self.trace.error("file push aborted, line {0} cannot be sent again", line_no)
+            # Queued before the waiting commands are released so that
+            # the file push does not continue with the next line
+            self.lanes.put( Command.abort(), CommandLanes.EMERGENCY )
+        
+        cmds = []
+        if self.active_cmd and self.active_cmd.line_number >= line_no:
+            cmds.append(self.active_cmd)
+            self.active_cmd = None
+        
+        # Lines before the requested one are accepted and still acknowledged
+        with self.rq.mutex:
+            keep = deque()
+            for cmd in self.rq.queue:
+                if cmd.line_number >= line_no:
+                    cmds.append(cmd)
+                else:
+                    keep.append(cmd)
+            self.rq.queue.clear()
+            self.rq.queue.extend(keep)
+        
+        taken = set( id(cmd) for cmd in cmds )
+        for data, cmd, queue_reply in self.resend_backlog:
+            if id(cmd) not in taken:
+                taken.add( id(cmd) )
+                cmds.append(cmd)
+        self.resend_backlog.clear()
+        
+        for cmd in cmds:
+            if cmd.tx_bytes:
+                self.tx_pending_bytes -= cmd.tx_bytes
+                self.tx_pending_lines -= 1
+                cmd.tx_bytes = 0
+        
+        self.z_pending = deque( entry for entry in self.z_pending if id(entry[0]) not in taken )
+        
+        self.tx_history.clear()
+        self.resend_restart = None
+        self.line_number = self.tx_line_number = line_no - 1
+        
+        self.__release_commands(cmds)
+        self.tx_cond.notify_all()
+    
+    def __check_resend_stall(self):
+        """
+        Retransmit the requested lines again when nothing was received for
+        ``RESEND_TIMEOUT`` after ignoring a request. The RX buffer flush of
+        a rejected stale line can drop the retransmission as well.
+        Must be called with ``tx_cond`` acquired.
+        """
+        restart = self.resend_restart
+        if not restart or not restart[2]:
+            return
+        if time.time() - self.idle_time_started < self.RESEND_TIMEOUT:
+            return
+        
+        self.trace.warning("No reply to retransmitted line {0}, sending it again", restart[0])
+        self.resend_stats['stalled'] += 1
+        self.__restart_resend(restart[0])
     
-    def __send_gcode_command(self, code, group = 'gcode'):
+    def __wait_for_drain(self):
+        """
+        Wait until all transmitted lines are acknowledged.
+        Must be called with ``tx_cond`` acquired.
+        """
+        while self.running and (self.tx_pending_lines or self.resend_backlog):
+            self.tx_cond.wait(0.5)
+
+    def __resync_line_number(self, line_number):
+        """
+        Set Totumduino last line number to **line_number** with a framed M110
+        so that pre-framed lines can be sent as they are.
+        Must be called with ``tx_cond`` acquired.
+        """
+        # Lines sent with the old numbering have to be acknowledged first,
+        # otherwise line numbers requested by Resend would be ambiguous.
+        self.__wait_for_drain()
+        self.tx_history.clear()
+        
+        cmd = Command.gcode('M110', group=None)
+        cmd.line_number = line_number
+        data = frame_line(cmd.data, line_number)
+        
+        self.resync_entry = [line_number, data, cmd]
+        self.tx_history.append(self.resync_entry)
+        self.__transmit(cmd, data)
+        
+        self.__wait_for_drain()
+        
+        self.tx_history.clear()
+        self.resync_entry = None
+        self.line_number = line_number
+    
+    def __send_gcode_command(self, code, group = 'gcode', frame = None):
         """
         Internal gcode send function with command processing hooks
+        
+        :param frame: Pre-framed line as ``(line_number, data)``, used in checksum mode
         """
         if isinstance(code, str):
             gcode_raw = code
             gcode_command = Command.gcode(gcode_raw, group=group)
-        elif isinstance(code, Command):
+        elif isinstance(code, (Command, FileLine)):
+            if code.future is not None and code.future.done():
+                # Cancelled or timed out before it was sent
+                return code
             gcode_raw = code.data + '\r\n'
             gcode_command = code
         else:
@@ -383,31 +1237,252 @@ class GCodeService:
             if trigger:
                 self.__trigger_callback(callback_name, callback_data)
         
-        # Note: experimental feature
-        if self.use_checksum:
-            data = gcode_raw[:-2]
-            self.line_number += 1
-            new_code = "N{0} {1}".format(self.line_number, data)
+        with self.tx_cond:
+            # Note: experimental feature
+            if self.use_checksum and frame:
+                line_number, gcode_complete = frame
+                # Interactive commands could have been sent in between
+                if self.line_number != line_number - 1:
+                    self.__resync_line_number(line_number - 1)
+                self.line_number = line_number
+                gcode_command.line_number = line_number
+            elif self.use_checksum:
+                self.line_number += 1
+                gcode_complete = frame_line(gcode_raw[:-2], self.line_number)
+                gcode_command.line_number = self.line_number
+            else:
+                gcode_complete = gcode_raw
             
-            checksum = 0
+            self.__wait_for_window( len(gcode_complete) )
             
-            for c in new_code:
-                checksum = int(checksum) ^ ord(c)
-            checksum = checksum & 0xff
+            self.trace.debug("<< {0}", gcode_complete)
             
-            # Modify original command
-            gcode_complete = "{0}*{1}\r\n".format(new_code, checksum)
-        else:
-            gcode_complete = gcode_raw
-        
-        print "<< ", gcode_complete[:-2]
+            if self.use_checksum:
+                # Keep the framed line in case a resend is requested
+                self.tx_history.append( [gcode_command.line_number, gcode_complete, gcode_command] )
+            
+            self.__transmit(gcode_command, gcode_complete)
         
-        #~ self.rq.put(gcode_command)
-        self.serial.write(gcode_complete)
-        self.rq.put(gcode_command)
+        if isinstance(gcode_command, Command) and gcode_command.group is not None:
+            threshold = self.latency.threshold( command_code(gcode_command.data) )
+            if threshold is not None:
+                self.__add_deadline(gcode_command.time_sent + threshold, gcode_command)
         
         return gcode_command
 
+    def __inject_z_modify(self, cmd):
+        """
+        Move Z by the requested amount right away. The accumulated amount
+        is added to the Z words of the following absolute file lines so
+        the next layer does not undo the adjustment.
+        """
+        try:
+            requested = self.z_requests.popleft()
+        except IndexError:
+            requested = time.time()
+        
+        dz = float(cmd.data)
+        move = 'G0 Z{0:.3f}\r\n'.format(dz)
+        
+        if self.z_relative:
+            z_cmd = self.__send_gcode_command(move)
+        else:
+            self.__send_gcode_command('G91\r\n')
+            z_cmd = self.__send_gcode_command(move)
+            self.__send_gcode_command('G90\r\n')
+        
+        self.z_override += dz
+        self.z_pending.append( (z_cmd, requested, self.z_override) )
+    
+    def __z_modify_done(self):
+        """
+        The injected Z move has been acknowledged.
+        """
+        z_cmd, requested, z_override = self.z_pending.popleft()
+        
+        latency = time.time() - requested
+        self.z_stats['count'] += 1
+        self.z_stats['total'] += latency
+        self.z_stats['last'] = latency
+        if latency > self.z_stats['max']:
+            self.z_stats['max'] = latency
+        
+        self.__trigger_callback('z_override', z_override)
+    
+    def __offset_z(self, line):
+        """
+        Add the live Z adjustment to the Z word of an absolute move or
+        position (G92) line.
+        """
+        tags = line.split()
+        if tags[0] not in self.Z_OFFSET_CODES:
+            return line
+        
+        for idx, tag in enumerate(tags):
+            if tag[0] == 'Z':
+                try:
+                    z = float(tag[1:])
+                except ValueError:
+                    return line
+                tags[idx] = 'Z{0:.3f}'.format(z + self.z_override)
+                return ' '.join(tags)
+        
+        return line
+    
+    def __send_preamble(self, lines):
+        """
+        Send commands preceding a resumed file push, one at a time.
+        
+        :returns: ``True`` if the file push has been aborted
+        :rtype: bool
+        """
+        for line in lines:
+            cmd = Command.gcode(line)
+            self.__send_gcode_command(cmd)
+            if self.__wait_for_barrier(cmd) or not self.running:
+                return True
+        return False
+    
+    def __checkpoint(self, seq, identity, offset, codes):
+        """
+        Take a recovery checkpoint after file line **seq**. The most recent
+        checkpoint whose line is surely executed is written, at most once
+        every ``CHECKPOINT_INTERVAL`` seconds.
+        
+        :param seq: Acknowledge sequence number of the last sent line
+        :param identity: File identity
+        :param offset: Byte offset of the next file line
+        :param codes: Number of sent codes
+        """
+        now = time.time()
+        self.checkpoints.append( (seq, {
+            'file'          : identity,
+            'offset'        : offset,
+            'line'          : self.current_line_number,
+            'codes'         : codes,
+            'state'         : self.modal.snapshot(),
+            'z_override'    : self.z_override,
+            'compact'       : self.stream_filter is not None,
+            'time'          : now
+        }) )
+        
+        acked = self.file_acked - self.CHECKPOINT_MARGIN
+        entry = None
+        while self.checkpoints and self.checkpoints[0][0] <= acked:
+            entry = self.checkpoints.popleft()
+        
+        if entry:
+            if now - self.checkpoint_written >= self.CHECKPOINT_INTERVAL:
+                self.checkpoint_written = now
+                self.recovery.write(entry[1])
+            else:
+                self.checkpoints.appendleft(entry)
+    
+    def __wait_for_file_slot(self, nbytes):
+        """
+        Wait until a **nbytes** long file line fits in the streaming window.
+        
+        :returns: ``False`` if a higher priority command is waiting to be sent first
+        :rtype: bool
+        """
+        result = True
+        stalled = None
+        
+        with self.tx_cond:
+            while self.running:
+                if self.lanes.pending(CommandLanes.FILE):
+                    result = False
+                    break
+                if not self.resend_backlog and self.__window_fits(nbytes):
+                    break
+                if stalled is None:
+                    stalled = time.time()
+                # Woken up by acknowledges and queued commands
+                self.tx_cond.wait()
+        
+        # Time the file push waited for Totumduino to free the window
+        if stalled is not None:
+            self.stall_time += time.time() - stalled
+        
+        return result
+    
+    def __wait_for_barrier(self, cmd):
+        """
+        Wait for the reply of a blocking command (M109, M190, G28) while
+        still serving higher priority lanes.
+        
+        :returns: ``True`` if the file push has been aborted
+        :rtype: bool
+        """
+        started = time.time()
+        aborted = False
+        
+        while self.running:
+            with self.tx_cond:
+                while ( self.running and not cmd.wait(0) and
+                        not self.lanes.pending(CommandLanes.FILE) ):
+                    self.tx_cond.wait()
+            
+            if cmd.wait(0):
+                break
+            
+            if self.__serve_lanes():
+                aborted = True
+                break
+        
+        self.barrier_time += time.time() - started
+        return aborted
+    
+    def __serve_lanes(self):
+        """
+        Send all queued emergency and interactive commands during a file push.
+        
+        :returns: ``True`` if the file push has been aborted
+        :rtype: bool
+        """
+        while self.running:
+            try:
+                cmd = self.lanes.get_nowait(CommandLanes.FILE)
+            except queue.Empty:
+                return False
+            
+            if cmd == Command.GCODE:
+                self.__send_gcode_command(cmd)
+                
+            elif cmd == Command.ZMODIFY:
+                self.__inject_z_modify(cmd)
+                
+            elif cmd == Command.PAUSE:
+                self.state = GCodeService.PAUSED
+                
+                self.__trigger_callback('state_change', 'paused')
+                
+                while self.running:
+                    cmd = self.lanes.get()
+                    if cmd == Command.GCODE:
+                        self.__send_gcode_command(cmd)
+                    elif cmd == Command.ZMODIFY:
+                        self.__inject_z_modify(cmd)
+                    elif cmd == Command.RESUME:
+                        self.state = GCodeService.FILE
+                        self.__trigger_callback('state_change', 'resumed')
+                        break
+                    elif cmd == Command.ABORT or cmd == Command.KILL:
+                        break
+                
+                # This is not a mistake. Once ABORT or KILL is received
+                # during PAUSE it will exit that loop and the
+                # command will be processed.
+                if cmd == Command.ABORT or cmd == Command.KILL:
+                    self.__trigger_callback('state_change', 'aborted')
+                    return True
+                
+            elif cmd == Command.ABORT or cmd == Command.KILL:
+                self.__trigger_callback('state_change', 'aborted')
+                return True
+        
+        return True
+    
     def __sender_thread(self):
         """
         Sender thread used to send commands to Totumduino.
@@ -418,33 +1493,103 @@ class GCodeService:
         
         self.ev_tx_started.set()
         
-        while (self.running and self.serial.is_open):
-            cmd = self.cq.get()
+        # The port is closed for a while when the connection is lost,
+        # commands are sent again once it is reopened.
+        while self.running:
+            cmd = self.lanes.get()
 
             if cmd == Command.GCODE:
                 self.__send_gcode_command(cmd)
                 #print "G <<", cmd.data
                 
+            elif cmd == Command.ZMODIFY:
+                self.__inject_z_modify(cmd)
+                
             elif cmd == Command.FILE:
                 filename = cmd.data
-                last_command = None
+                last_seq = self.file_seq
                 aborted = False
                 first_move = False
                 
                 self.state = GCodeService.FILE
                 self.progress = 0.0
-                # TODO: try except protection
+                self.file_time_started = time.time()
+                self.file_time_finished = None
+                self.stream_stats = {}
+                self.stall_time = 0.0
+                self.barrier_time = 0.0
+                self.z_override = 0.0
+                self.z_relative = False
+                self.modal = ModalState()
+                self.checkpoints.clear()
+                if self.connected:
+                    self.outage_aborted = False
+                
+                # Analysed, arc fitted, indexed and framed by __prepare_file
+                gfile = cmd.gfile
+                filename = gfile.info['filename']
                 
-                gfile = GCodeFile(filename)
+                self.arc_fit = None
+                if 'arc_fit' in gfile.info:
+                    self.arc_fit = gfile.info['arc_fit']
+                    self.trace.info("arc fitting: {0} -> {1} lines, {2} -> {3} bytes",
+                                    self.arc_fit['lines_in'], self.arc_fit['lines_out'],
+                                    self.arc_fit['bytes_in'], self.arc_fit['bytes_out'])
                 
                 self.total_line_number = gfile.info['line_count']
                 self.current_line_number = 0
                 
+                self.layer_index = cmd.layer_index
+                self.time_estimate = cmd.time_estimate
+                
                 gcode_count = self.total_line_number = gfile.info['gcode_count']
                 
                 self.group_ack['file'] = 0
                 
-                for line, attrs in gfile:
+                # Line numbers and checksums are computed ahead of streaming,
+                # compacted lines are framed as they are sent
+                frames = None
+                frame_number = 0
+                if cmd.frames is not None:
+                    frames = iter(cmd.frames)
+                
+                offset = 0
+                checkpoint = cmd.checkpoint
+                if checkpoint:
+                    # Continue after the last checkpoint of an interrupted push
+                    offset = checkpoint['offset']
+                    self.current_line_number = checkpoint['line']
+                    self.group_ack['file'] = frame_number = checkpoint['codes']
+                    self.z_override = checkpoint['z_override']
+                    self.modal.restore(checkpoint['state'])
+                    self.z_relative = not self.modal.absolute
+                    if frames:
+                        for i in xrange(frame_number):
+                            if next(frames, None) is None:
+                                self.trace.error("pre-framed lines end before line {0}, framing while sending", frame_number)
+                                frames = None
+                                break
+                    aborted = self.__send_preamble( resume_gcode(checkpoint) )
+                
+                identity = None
+                next_checkpoint = None
+                if self.recovery:
+                    identity = cmd.identity
+                    next_checkpoint = time.time() + self.CHECKPOINT_STEP
+                
+                lines = []
+                stream_filter = self.stream_filter = None
+                if not aborted:
+                    lines = gfile.iterate(offset)
+                    if cmd.compact:
+                        state = None
+                        if checkpoint:
+                            state = checkpoint['state']
+                        lines = BandwidthFilter(lines, self.steps_per_mm, state = state)
+                        stream_filter = self.stream_filter = lines
+                    self.file_lines = lines
+                
+                for line, attrs in lines:
                     line = line.rstrip()
                     #print "L << ", line
                     
@@ -459,7 +1604,12 @@ class GCodeService:
                     self.current_line_number += 1
                     
                     #~ self.progress = 100 * float(self.current_line_number) / float(self.total_line_number)
-                    self.progress = 100 * float(self.group_ack['file']) / float(gcode_count)
+                    acked = float(self.group_ack['file'])
+                    if stream_filter:
+                        # Sent codes stand for more file codes
+                        filter_stats = stream_filter.stats
+                        acked = min(gcode_count, acked * filter_stats['codes_in'] / max(1, filter_stats['codes_out']))
+                    self.progress = 100 * acked / float(gcode_count)
                     
                     if line:
                         # QUESTION: should this be handled or not?
@@ -469,63 +1619,85 @@ class GCodeService:
                             #~ self.resume()
                         #~ else:
                         
-                        last_command = self.__send_gcode_command(line + '\r\n', group='file')
+                        frame = None
+                        frame_number += 1
+                        if frames:
+                            data = next(frames, None)
+                            if data is None:
+                                # Line numbers continue, the service frames the rest
+                                self.trace.error("pre-framed lines end before line {0}, framing while sending", frame_number)
+                                frames = None
+                            else:
+                                frame = (frame_number, data)
+                        if frame:
+                            nbytes = len(frame[1])
+                        else:
+                            nbytes = len(line) + 2
                         
-                        # Wait until reply received M109 M190 G28 
-                        if ( line[:4] == 'M109' or
-                             line[:4] == 'M190' or
-                             line[:3] == 'G28'):
-                            """ Wait for reply before continuing """
-                            last_command.wait()
+                        # Emergency and interactive commands take the next
+                        # free slot of the streaming window.
+                        while not self.__wait_for_file_slot(nbytes):
+                            if self.__serve_lanes():
+                                aborted = True
+                                break
+                        
+                        if aborted or not self.running:
+                            break
                         
-                        try:
-                            cmd = self.cq.get_nowait()
+                        if line[:2] == 'G9':
+                            if line[:3] == 'G91':
+                                self.z_relative = True
+                            elif line[:3] == 'G90':
+                                self.z_relative = False
+                        
+                        # Adjustments made while waiting are applied too
+                        if self.z_override and not self.z_relative and 'Z' in line:
+                            line = self.__offset_z(line)
+                            if frame:
+                                frame = (frame_number, frame_line(line, frame_number))
+                        
+                        if identity:
+                            self.modal.update(line)
+                        
+                        self.file_seq += 1
+                        last_seq = self.file_seq
+                        
+                        # Wait until reply received M109 M190 G28 
+                        if line.split(' ', 1)[0] in self.BARRIER_CODES:
+                            barrier = Command.gcode(line, group='file')
+                            barrier.seq = last_seq
+                            self.__send_gcode_command(barrier, frame=frame)
                             
-                            if cmd == Command.GCODE:
-                                #~ self.serial.write(cmd.data + '\r\n')
-                                #~ #print "# >>", cmd.data
-                                #~ self.rq.put(cmd)
-                                
-                                self.__send_gcode_command(cmd)
-                                
-                            elif cmd == Command.PAUSE:
-                                self.state = GCodeService.PAUSED
-                                
-                                self.__trigger_callback('state_change', 'paused')
-                                
-                                while self.running:
-                                    cmd = self.cq.get()
-                                    if cmd == Command.GCODE:
-                                        self.serial.write(cmd.data + '\r\n')
-                                        self.rq.put(cmd)
-                                    elif cmd == Command.RESUME:
-                                        self.state = GCodeService.FILE
-                                        self.__trigger_callback('state_change', 'resumed')
-                                        break
-                                    elif cmd == Command.ABORT or cmd == Command.KILL:
-                                        break
-                                
-                                # This is not a mistake. Once ABORT or KILL is received
-                                # during PAUSE it will exit that loop and the
-                                # command will be processed.
-                                if cmd == Command.ABORT or cmd == Command.KILL:
-                                    self.__trigger_callback('state_change', 'aborted')
-                                    aborted = True
-                                    break
-                                
-                            elif cmd == Command.ABORT or cmd == Command.KILL:
-                                self.__trigger_callback('state_change', 'aborted')
+                            """ Wait for reply before continuing """
+                            if self.__wait_for_barrier(barrier):
+                                # The file push ends now, the barrier is
+                                # acknowledged whenever Totumduino is done
+                                if not barrier.wait(0):
+                                    last_seq -= 1
                                 aborted = True
                                 break
-                                
-                        except queue.Empty as e:
-                            cmd = Command.NONE
-                            continue
+                        else:
+                            self.__send_gcode_command(FileLine(line, last_seq), frame=frame)
+                        
+                        if next_checkpoint and time.time() >= next_checkpoint:
+                            next_checkpoint = time.time() + self.CHECKPOINT_STEP
+                            self.__checkpoint(last_seq, identity, lines.offset, frame_number)
+                
+                if hasattr(frames, 'close'):
+                    frames.close()
+                
+                # Injected Z moves of an idle service switch to G91 themselves,
+                # the positioning mode of this file does not apply to them
+                self.z_relative = False
+                
+                # A push aborted by a serial outage can still be resumed
+                if self.recovery and self.running and not (aborted and self.outage_aborted):
+                    self.recovery.clear()
                 
                 # Create a new thread that is waiting for the last command 
                 # to get it's reply and call the callback function if one
                 # was specified.
-                self.__trigger_file_done(last_command)
+                self.__trigger_file_done(last_seq)
                 
             elif cmd == Command.KILL:
                 break
@@ -537,18 +1709,21 @@ class GCodeService:
         Process a one line of reply message.
         """
         
-        print "__handle_line", line_raw, "[", self.active_cmd, self.rq.qsize(),  "]"
+        self.trace.debug("__handle_line {0} [ {1} ]", line_raw, self.active_cmd)
         
         if self.is_resetting:
             return
         
-        try:
-            # The received packet is a bytearray so it has to be converted to a
-            # string type according to selected ENCODING
-            line = line_raw.decode(self.ENCODING, self.UNICODE_HANDLING)
-        except Exception as e:
-            print e
-            return
+        if line_raw == self.OK_REPLY_RAW:
+            line = self.OK_REPLY
+        else:
+            try:
+                # The received packet is a bytearray so it has to be converted to a
+                # string type according to selected ENCODING
+                line = line_raw.decode(self.ENCODING, self.UNICODE_HANDLING)
+            except Exception as e:
+                self.trace.error("{0}", e)
+                return
         
         #print "__handle_line: decoded"
         
@@ -559,6 +1734,20 @@ class GCodeService:
         # Update idle time start
         self.idle_time_started = time.time()
         
+        # Note: experimental feature
+        if self.use_checksum:
+            if line.startswith('Resend:'):
+                self.__handle_resend(line)
+                return
+            elif self.reject_ok_pending and line.startswith('ok'):
+                # Acknowledge of a rejected line
+                self.reject_ok_pending -= 1
+                return
+            elif line.startswith('Error:') and 'Last Line' in line:
+                # Reason of the following Resend:, not a command reply
+                self.trace.warning(">> {0}", line)
+                return
+        
         #print "__handle_line: get reply from queue"
         
         # If there is no active command try to get it from the reply queue
@@ -573,15 +1762,16 @@ class GCodeService:
                     self.active_cmd = self.rq.get_nowait()
             except queue.Empty as e:
                 #print "Reply queue is EMPTY, ignoring received reply."
-                print ">>", line
+                self.trace.debug(">> {0}", line)
                 return
          
-        print "@ >>", line, self.active_cmd
+        self.trace.debug("@ >> {0} {1}", line, self.active_cmd)
         
         if self.active_cmd:
             # Get the active command as this is the on waiting for the reply.
             cmd = self.active_cmd
-            cmd.reply.append( line )
+            if cmd.reply is not None:
+                cmd.reply.append( line )
 
             if cmd.hasExpectedReply(line):
                 
@@ -598,23 +1788,8 @@ class GCodeService:
                     #~ print error_msg
                     #~ cmd.reply = []
                     
-                # TODO: should a command be resent?
-                if len(cmd.reply) > 1:
-                    if cmd.reply[-2].startswith("Resend:") and cmd.data[:4]: # Second to last line of reply
-                        
-                        resend, line_no = cmd.reply[-2].split(':')
-                        
-                        self.line_number = int(line_no) -1
-                        
-                        #print "Communication error. Need to resend command [{0}]".format(cmd.data)
-                        print cmd.reply
-                        
-                        if cmd.data[:4] != 'M999' and cmd.data[:4] != 'M998':
-                            cmd.reply = None
-                        
-                print "Notify:", cmd
-                cmd.notify()
-                
+                # Update acknowledge counters before the waiting thread is
+                # released so it sees the final values.
                 group = self.active_cmd.group
                 if group:
                     count = 1
@@ -627,6 +1802,41 @@ class GCodeService:
                     
                     #print "group_ack", group, count
                 
+                if cmd.time_sent is not None:
+                    latency = time.time() - cmd.time_sent
+                    samples = self.ack_latency.get(group)
+                    if samples is None:
+                        samples = self.ack_latency[group] = deque(maxlen=self.ACK_LATENCY_SIZE)
+                    samples.append(latency)
+                    # File lines are acknowledged at the pace of the planner,
+                    # only commands have a meaningful latency per code
+                    if group and cmd.reply is not None:
+                        code = command_code(cmd.data)
+                        if code:
+                            self.latency.record(code, latency)
+                
+                if cmd.seq:
+                    self.file_acked = cmd.seq
+                
+                restart = self.resend_restart
+                if restart and cmd.line_number is not None and cmd.line_number >= restart[0]:
+                    # Retransmission accepted, no stale rejection can follow
+                    self.resend_restart = None
+                
+                if self.z_pending and cmd is self.z_pending[0][0]:
+                    self.__z_modify_done()
+                
+                if cmd is self.recovery_cmd:
+                    self.__connection_restored()
+                
+                self.trace.debug("Notify: {0}", cmd)
+                cmd.notify()
+                if cmd.future is not None:
+                    cmd.future.set_result(cmd.reply)
+                
+                # Wakes up the sender, also when waiting for this reply
+                self.__release_window(cmd)
+                
                 self.active_cmd = None
                 
             # Line does not contain expected reply
@@ -672,31 +1882,244 @@ class GCodeService:
             self.serial.timeout = 1
             print "has no cancel_read"
         
+        rx_timeout = self.serial.timeout
+        
         self.ev_rx_started.set()
 
         # Run this thread while the service is active        
-        while self.running and self.serial.is_open:
+        while self.running:
             
             #while self.serial.is_open:
             try:
                 # read all that is there or wait for one byte (blocking)
                 data = self.serial.read(self.serial.in_waiting or 1)
             except serial.SerialException as e:
+                if not self.running:
+                    break
                 # probably some I/O problem such as disconnected USB serial
-                # adapters -> exit
-                error = e
+                # adapters -> reopen the port
                 print e
-                break
+                with self.tx_cond:
+                    self.__connection_lost(e)
+                self.__reconnect()
             else:
                 if data:
-                    self.buffer.extend(data)
                     #print 'R: [', data, ']'
-                    while self.READ_TERM in self.buffer:
-                        line_raw, self.buffer = self.buffer.split(self.READ_TERM, 1)
+                    for line_raw in self.framer.feed(data):
                         self.__handle_line(line_raw)
+                elif not self.connected:
+                    # Write failed but reading did not
+                    self.__reconnect()
+                
+                timeout = rx_timeout
+                if self.resend_restart and self.resend_restart[2]:
+                    # Wake up in time to notice a dropped retransmission
+                    if timeout is None or timeout > self.RESEND_TIMEOUT:
+                        timeout = self.RESEND_TIMEOUT
+                    with self.tx_cond:
+                        self.__check_resend_stall()
+                if self.serial.timeout != timeout:
+                    self.serial.timeout = timeout
         
         print "receiver thread: stopped"
     
+    def __connection_lost(self, error):
+        """
+        Stop transmitting until the receiver thread has reopened the port.
+        Must be called with ``tx_cond`` acquired.
+        """
+        if not self.connected:
+            return
+        
+        self.connected = False
+        self.outage_started = time.time()
+        self.outage_aborted = False
+        self.recovery_cmd = None
+        self.connection_stats['outages'] += 1
+        self.trace.error("serial connection lost: {0}", error)
+        self.__trigger_callback('connection_lost', str(error))
+        self.tx_cond.notify_all()
+    
+    def __reconnect(self):
+        """
+        Reopen the serial port with exponential backoff. A file push is
+        aborted once the outage is longer than ``RESUME_TIMEOUT``.
+        """
+        delay = self.RECONNECT_DELAY
+        
+        while self.running:
+            with self.tx_cond:
+                try:
+                    self.serial.close()
+                except (serial.SerialException, OSError):
+                    pass
+                
+                try:
+                    self.serial.open()
+                except (serial.SerialException, OSError) as e:
+                    self.trace.warning("serial port reopen failed: {0}", e)
+                else:
+                    self.__restore_connection()
+                    return
+                
+                if ( not self.outage_aborted and
+                     time.time() - self.outage_started > self.RESUME_TIMEOUT ):
+                    self.__abort_in_flight()
+            
+            # Set by stop()
+            self.ev_stop.wait(delay)
+            delay = min(2 * delay, self.RECONNECT_MAX_DELAY)
+    
+    def __take_in_flight(self):
+        """
+        Take all commands waiting for a reply out of the reply queue and the
+        resend backlog, in order of sending, and empty the streaming window.
+        Must be called with ``tx_cond`` acquired.
+        """
+        cmds = []
+        if self.active_cmd:
+            cmds.append(self.active_cmd)
+            self.active_cmd = None
+        
+        with self.rq.mutex:
+            cmds.extend(self.rq.queue)
+            self.rq.queue.clear()
+        
+        taken = set( id(cmd) for cmd in cmds )
+        for data, cmd, queue_reply in self.resend_backlog:
+            if id(cmd) not in taken:
+                taken.add( id(cmd) )
+                cmds.append(cmd)
+        
+        for cmd in cmds:
+            cmd.tx_bytes = 0
+            if cmd.reply is not None:
+                cmd.reply = []
+        
+        self.tx_pending_bytes = 0
+        self.tx_pending_lines = 0
+        self.resend_backlog.clear()
+        self.resync_entry = None
+        self.resend_restart = None
+        self.reject_ok_pending = 0
+        
+        return cmds
+    
+    def __abort_in_flight(self):
+        """
+        Abort the file push after a too long serial outage. All commands
+        waiting for a reply are released without one.
+        Must be called with ``tx_cond`` acquired.
+        """
+        self.outage_aborted = True
+        
+        if self.state in (GCodeService.FILE, GCodeService.PAUSED):
+            self.trace.error("file push aborted, serial outage longer than {0} s", self.RESUME_TIMEOUT)
+            self.connection_stats['aborted'] += 1
+            # Queued before the waiting commands are released so that
+            # the file push does not continue with the next line
+            self.lanes.put( Command.abort(), CommandLanes.EMERGENCY )
+        
+        self.__release_commands( self.__take_in_flight() )
+        
+        self.z_pending.clear()
+        self.tx_cond.notify_all()
+    
+    def __release_commands(self, cmds):
+        """
+        Release threads waiting for **cmds** without a reply.
+        """
+        for cmd in cmds:
+            if cmd.seq and cmd.seq > self.file_acked:
+                self.file_acked = cmd.seq
+            if cmd.reply is not None:
+                cmd.reply = None
+            cmd.notify()
+            if cmd.future is not None:
+                cmd.future.cancel()
+    
+    def __restore_connection(self):
+        """
+        Send all unacknowledged commands again on the reopened port. They
+        are preceded by M110 setting Totumduino line number right before
+        the first of them (checksum mode) or by M105 (no checksum), which
+        tells when Totumduino is responding again.
+        
+        A line received by Totumduino just before the connection was lost
+        can be executed twice.
+        Must be called with ``tx_cond`` acquired.
+        """
+        now = time.time()
+        outage = now - self.outage_started
+        
+        self.framer.clear()
+        try:
+            self.serial.reset_input_buffer()
+        except (serial.SerialException, OSError):
+            pass
+        
+        streaming = self.state in (GCodeService.FILE, GCodeService.PAUSED)
+        if not self.outage_aborted and outage > self.RESUME_TIMEOUT:
+            self.__abort_in_flight()
+        
+        cmds = self.__take_in_flight()
+        
+        if self.use_checksum:
+            # Keep the original framing of the lines
+            sent = set( id(cmd) for cmd in cmds )
+            entries = [ entry for entry in self.tx_history if id(entry[2]) in sent ]
+            if len(entries) != len(cmds):
+                self.trace.error("{0} commands not in resend history", len(cmds) - len(entries))
+            
+            # A line waiting for the window has its number already
+            line_number = self.tx_line_number
+            if entries:
+                line_number = entries[0][0] - 1
+            
+            probe = Command.gcode('M110', group=None)
+            probe.line_number = line_number
+            probe_entry = [line_number, frame_line(probe.data, line_number), probe]
+            
+            self.tx_history.clear()
+            self.tx_history.append(probe_entry)
+            self.tx_history.extend(entries)
+        else:
+            entries = []
+            for cmd in cmds:
+                entries.append( [None, cmd.data.rstrip() + self.WRITE_TERM, cmd] )
+            probe = Command.gcode('M105', group=None)
+            probe_entry = [None, probe.data + self.WRITE_TERM, probe]
+        
+        self.resend_backlog.append( (probe_entry[1], probe, True) )
+        for line_number, data, cmd in entries:
+            self.resend_backlog.append( (data, cmd, True) )
+        
+        self.recovery_cmd = probe
+        self.recovery_started = now
+        
+        stats = self.connection_stats
+        stats['last_outage'] = outage
+        stats['total_outage'] += outage
+        stats['retransmitted'] += len(entries)
+        if streaming and not self.outage_aborted:
+            stats['resumed'] += 1
+        
+        self.trace.info("serial port reopened after {0:.2f} s, sending {1} lines again", outage, len(entries))
+        
+        self.connected = True
+        self.__pump_resend()
+        self.tx_cond.notify_all()
+    
+    def __connection_restored(self):
+        """
+        Totumduino replied to the first command sent after reopening the port.
+        """
+        stats = self.connection_stats
+        stats['last_recovery'] = time.time() - self.recovery_started
+        self.recovery_cmd = None
+        self.trace.info("serial connection restored in {0:.3f} s", stats['last_recovery'])
+        self.__trigger_callback('connection_restored', [stats['last_outage'], stats['last_recovery']])
+    
     def __reset_totumduino(self):
         """ Does a hardware reset of the totumduino board. """
         
@@ -710,6 +2133,10 @@ class GCodeService:
         time.sleep(1)
         #self.serial.open()
         
+        # Totumduino starts counting lines from zero after a reset
+        self.line_number = 0
+        self.tx_line_number = 0
+        
         self.__cleanup()
     
         self.is_resetting = False
@@ -726,29 +2153,37 @@ class GCodeService:
         self.serial.reset_output_buffer()
         
         if self.active_cmd:
-            self.active_cmd.reply = None
+            if self.active_cmd.reply is not None:
+                self.active_cmd.reply = None
             self.active_cmd.notify()
+            if self.active_cmd.future is not None:
+                self.active_cmd.future.cancel()
             self.active_cmd = None
         
+        self.__reset_window()
+        
         # Release all threads waiting for a reply (from reply queue)
-        while not self.rq.empty:
+        while not self.rq.empty():
             print "reply queue is not empty"
             try:
                 cmd = self.rq.get_nowait()
                 cmd.notify()
+                if cmd.future is not None:
+                    cmd.future.cancel()
                 #print "notifing ", cmd
             except queue.Empty as e:
                 break
         
-        # Release all threads waiting for a reply (from command queue)
-        while not self.cq.empty:
-            print "command queue is not empty"
-            try:
-                cmd = self.cq.get_nowait()
-                cmd.notify()
-                #print "notifing ", cmd
-            except queue.Empty as e:
-                break
+        self.z_requests.clear()
+        self.z_pending.clear()
+        self.recovery_cmd = None
+        
+        # Release all threads waiting for a reply (from command lanes)
+        for cmd in self.lanes.clear():
+            print "command lanes are not empty"
+            cmd.notify()
+            if cmd.future is not None:
+                cmd.future.cancel()
                 
 
         
@@ -768,10 +2203,24 @@ class GCodeService:
         # Receiver Thread
         self.receiver = Thread( target = self.__receiver_thread )
         self.receiver.start()
+        # Callback dispatcher Thread
+        self.dispatcher = Thread( target = self.__callback_thread )
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        # Recovery checkpoint writer Thread
+        if self.recovery:
+            self.recovery.start()
         
         # Wait for both threads to start before continuing
         self.ev_tx_started.wait()
         self.ev_rx_started.wait()
+        
+        if self.latency_file:
+            self.latency.restore(self.latency_file)
+        
+        # Synchronize Totumduino line number with ours
+        if self.use_checksum:
+            self.send('M110', block=False)
     
     def loop(self):
         """
@@ -786,14 +2235,21 @@ class GCodeService:
         """
         self.wait_for_reply = wait_for_reply
         self.running = False
+        self.ev_stop.set()
         if hasattr(self.serial, 'cancel_read'):
-            self.cancel_read()
-        self.cq.put( Command.kill() )
+            self.serial.cancel_read()
+        self.lanes.put( Command.kill(), CommandLanes.EMERGENCY )
         
         # Wait for both threads to be stopped and then clean up the queues.
         self.sender.join()
         self.receiver.join()
         
+        self.eq.put( (None, None) )
+        self.dispatcher.join()
+        
+        if self.recovery:
+            self.recovery.stop()
+        
         # stop() is called from another thread of execution so try to suspend it
         # to allow the thread system to switch to other running threads
         time.sleep(1)
@@ -802,6 +2258,12 @@ class GCodeService:
         
         self.serial.close()
         
+        if self.latency_file:
+            try:
+                self.latency.save(self.latency_file)
+            except IOError as e:
+                print "Latency statistics not saved:", e
+        
         print "All threads stopped"       
     
     def reset(self):
@@ -815,27 +2277,34 @@ class GCodeService:
         Pause current file push. In case no file is being pushed this command
         has no effect.
         """
-        self.cq.put( Command.pause() )
+        self.lanes.put( Command.pause(), CommandLanes.EMERGENCY )
         
     def resume(self):
         """
         Resume current file push. In case no file is being pushed this command
         has no effect.
         """
-        self.cq.put( Command.resume() )
+        self.lanes.put( Command.resume(), CommandLanes.EMERGENCY )
         
     def abort(self):
         """
         Abort current file push. In case no file is being pushed this command
         has no effect.
         """
-        self.cq.put( Command.abort() )
+        self.lanes.put( Command.abort(), CommandLanes.EMERGENCY )
     
     def z_modify(self, z):
         """
-        Modify the Z axis by amount z
+        Modify the Z axis by amount z. The move is injected right away, also
+        during a file push, and the following absolute Z moves of the file
+        are shifted by the accumulated amount. ``z_override`` callback is
+        triggered with the accumulated amount once the move is acknowledged.
+        
+        :param z: Amount in mm, negative moves towards the bed
+        :type z: float
         """
-        self.cq.put( Command.zplus(z) )
+        self.z_requests.append( time.time() )
+        self.lanes.put( Command.zmodify(z), CommandLanes.INTERACTIVE )
     
     def register_callback(self, callback_name, callback_fun):
         """
@@ -878,11 +2347,26 @@ class GCodeService:
         """
         pass
     
-    def send(self, code, block = True, timeout = None):
+    def send(self, code, block = True, timeout = None, adaptive = False):
         """
         Send GCode and return reply.
+        
+        :param code: GCode
+        :param block: Wait for the reply
+        :param timeout: Time in seconds to wait for the reply, wait forever if ``None``
+        :param adaptive: Extend **timeout** to the timeout learned from the
+                         recorded reply latency of the code, it is never
+                         shortened, see :func:`get_timeout`
+        :type code: string
+        :type block: bool
+        :type timeout: float, None
+        :type adaptive: bool
+        :returns: Reply lines, ``None`` on timeout or if the service is stopped
+        :rtype: list
         """
         code = code.encode('latin-1')
+        if adaptive and timeout is not None:
+            timeout = max( timeout, self.latency.timeout(command_code(code), timeout) )
         if self.running:
             sent_timestamp = time.time()
             # QUESTION: should this be handled or not?
@@ -894,7 +2378,10 @@ class GCodeService:
                 return None
             
             cmd = Command.gcode(code, 'ok')
-            self.cq.put(cmd)
+            if code.split(' ', 1)[0] in self.EMERGENCY_CODES:
+                self.lanes.put(cmd, CommandLanes.EMERGENCY)
+            else:
+                self.lanes.put(cmd, CommandLanes.INTERACTIVE)
             
             # Don't block, return immediately 
             if not block:
@@ -921,21 +2408,199 @@ class GCodeService:
         else:
             return None
         
-    def send_file(self, filename):
+    def send_async(self, code, timeout = None, expected_reply = 'ok'):
+        """
+        Send GCode without blocking.
+        
+        The returned future is resolved with the reply once the expected
+        reply is received. Its done callbacks are called from the receiver
+        thread and must not block. A command cancelled or timed out before
+        it was written to Totumduino is not sent.
+        
+        :param code: GCode
+        :param timeout: Time in seconds after which the future fails with ``TimeoutError``
+        :param expected_reply: Expected reply
+        :type code: string
+        :type timeout: float, None
+        :type expected_reply: string
+        :rtype: Future
+        """
+        future = Future()
+        if not self.running:
+            future.cancel()
+            return future
+        
+        code = code.encode('latin-1')
+        cmd = Command.gcode(code, expected_reply)
+        cmd.future = future
+        
+        if timeout is not None:
+            self.__add_deadline(time.time() + timeout, future)
+        
+        if code.split(' ', 1)[0] in self.EMERGENCY_CODES:
+            self.lanes.put(cmd, CommandLanes.EMERGENCY)
+        else:
+            self.lanes.put(cmd, CommandLanes.INTERACTIVE)
+        
+        return future
+    
+    def send_many(self, lines, timeout = None):
+        """
+        Send a batch of GCode lines and return their replies. The whole
+        batch is queued at once and streamed to Totumduino without waiting
+        for each reply, so it takes about one round trip instead of one per
+        line. All lines go through the interactive lane, in order.
+        
+        :param lines: GCode lines
+        :param timeout: Time in seconds to wait for the whole batch, wait forever if ``None``
+        :type lines: list
+        :type timeout: float, None
+        :returns: Replies in the order of **lines**, ``None`` for a line
+                  without reply (timeout or service stopped)
+        :rtype: list
+        """
+        if not self.running:
+            return [None] * len(lines)
+        
+        sent_timestamp = time.time()
+        cmds = [ Command.gcode(code.encode('latin-1'), 'ok') for code in lines ]
+        if not cmds:
+            return []
+        
+        self.lanes.put_many(cmds, CommandLanes.INTERACTIVE)
+        
+        # Replies come in order of sending, the last one completes the batch
+        last = cmds[-1]
+        while not last.wait(3):
+            if not self.running:
+                break
+            if timeout and ( time.time() - sent_timestamp ) >= timeout:
+                print 'Timeout for batch of', len(cmds)
+                break
+        
+        replies = []
+        for cmd in cmds:
+            if cmd.wait(0):
+                replies.append(cmd.reply)
+            else:
+                replies.append(None)
+        return replies
+    
+    def send_file(self, filename, arc_tolerance = None, compact = False):
         """
         Send GCode from a file.
         Returns ``False`` if a file is already being pushed.
         
+        :param filename: GCode file
+        :param arc_tolerance: Push an arc fitted copy of the file deviating at
+                              most **arc_tolerance** mm from it, see :func:`GCodeFile.fit_arcs`.
+                              Line and byte reduction are reported in ``arc_fit``
+                              of :func:`get_stream_stats`.
+        :param compact: Merge collinear moves, drop modal repeats and trim
+                        coordinates to the machine resolution while sending,
+                        see :class:`fabtotum.utils.gcodefilter.BandwidthFilter`.
+                        Bytes saved are reported in ``compact`` of :func:`get_stream_stats`.
+        :type filename: string
+        :type arc_tolerance: float
+        :type compact: bool
         :rtype: bool
+        :raises IOError: The file cannot be read
         """
         if self.running:
             if self.state == GCodeService.IDLE:
-                cmd = Command.file(filename)
-                self.cq.put(cmd)
+                cmd = Command.file(filename, arc_tolerance = arc_tolerance, compact = compact)
+                self.__prepare_file(cmd)
+                self.lanes.put(cmd, CommandLanes.FILE)
                 return True
                 
         return False
+    
+    def __prepare_file(self, cmd):
+        """
+        Analyse, arc fit, index and frame the file of a ``FILE`` command in
+        the calling thread. On a file that is not cached yet this takes
+        seconds, the sender thread would not serve the emergency and
+        interactive lanes meanwhile.
+        """
+        gfile = GCodeFile(cmd.data, self.analysis_cache)
+        if cmd.arc_tolerance:
+            gfile = gfile.fit_arcs(cmd.arc_tolerance)
+        cmd.gfile = gfile
+        
+        if gfile.info['type'] == GCodeInfo.PRINT:
+            cmd.layer_index = gfile.layer_index()
+            cmd.time_estimate = gfile.estimate_time(self.machine_profile)
+        
+        if self.use_checksum and not cmd.compact:
+            cmd.frames = gfile.framed()
+        
+        if self.recovery:
+            cmd.identity = file_identity(gfile.info['filename'])
             
+    def get_checkpoint(self):
+        """
+        Return the recovery checkpoint of an interrupted file push.
+        
+        :returns: Checkpoint or ``None`` if there is none or the file has
+                  changed since
+        :rtype: dict
+        """
+        if not self.recovery:
+            return None
+        checkpoint = self.recovery.load()
+        if checkpoint is None or not same_file(checkpoint['file']):
+            return None
+        return checkpoint
+    
+    def resume_file(self):
+        """
+        Continue a file push interrupted by a power cut from its recovery
+        checkpoint. The machine is heated up, XY homed at a lifted Z and
+        moved back to the checkpoint position first, see
+        :func:`fabtotum.totumduino.recovery.resume_gcode`.
+        Returns ``False`` if there is no checkpoint or a file is already
+        being pushed.
+        
+        :rtype: bool
+        """
+        if self.running:
+            if self.state == GCodeService.IDLE:
+                checkpoint = self.get_checkpoint()
+                if checkpoint:
+                    cmd = Command.file(checkpoint['file']['filename'], checkpoint,
+                                       compact = checkpoint.get('compact', False))
+                    self.__prepare_file(cmd)
+                    self.lanes.put(cmd, CommandLanes.FILE)
+                    return True
+        
+        return False
+    
+    def get_recovery_stats(self):
+        """
+        Return recovery checkpoint writer counters.
+        
+        :returns: Dictionary with ``submitted``, ``written``, ``failed``,
+                  ``write_time`` and ``last`` keys, see :func:`CheckpointWriter.get_stats`,
+                  empty if checkpoints are disabled
+        :rtype: dict
+        """
+        if not self.recovery:
+            return {}
+        return self.recovery.get_stats()
+    
+    def get_analysis_cache_stats(self):
+        """
+        Return file analysis cache counters and usage.
+        
+        :returns: Dictionary with ``hits``, ``misses``, ``stored``, ``evicted``,
+                  ``errors``, ``entries``, ``size`` and ``budget`` keys, see
+                  :func:`AnalysisCache.get_stats`, empty if there is no cache
+        :rtype: dict
+        """
+        if not self.analysis_cache:
+            return {}
+        return self.analysis_cache.get_stats()
+    
     def get_progress(self):
         """
         Return current file progress.
@@ -943,6 +2608,248 @@ class GCodeService:
         """
         return self.progress
         
+    def get_layer_progress(self):
+        """
+        Return the layer reached by the current or last file push, from the
+        layer index of the file, see :class:`fabtotum.utils.gcodeindex.LayerIndex`.
+        
+        :returns: Dictionary with ``layer`` (slicer layer number), ``index``
+                  (position in the layer index), ``layers`` (number of layers),
+                  ``z`` and ``progress`` (percentage counted in layers) keys,
+                  empty if the file has no layer index. Layer values are
+                  ``None`` before the first layer.
+        :rtype: dict
+        """
+        layers = self.layer_index
+        lines = self.file_lines
+        if not layers or lines is None:
+            return {}
+        
+        offset = lines.offset
+        i = layers.find_offset(offset)
+        progress = {
+            'layer'     : None,
+            'index'     : i,
+            'layers'    : len(layers),
+            'z'         : None,
+            'progress'  : layers.progress(offset)
+        }
+        if i >= 0:
+            progress['layer'] = layers[i]['layer']
+            progress['z'] = layers[i]['z']
+        return progress
+    
+    def get_time_estimate(self):
+        """
+        Return the estimated print time of the current or last file push, see
+        :func:`fabtotum.utils.gcodetime.estimate_print_time`. The remaining
+        time is taken from the layer reached, or from the progress if the file
+        has no layers.
+        
+        :returns: Dictionary with ``total``, ``remaining`` and ``elapsed`` keys
+                  in seconds, empty if there is no estimate (not a print or
+                  NumPy not available)
+        :rtype: dict
+        """
+        estimate = self.time_estimate
+        lines = self.file_lines
+        if not estimate or lines is None:
+            return {}
+        
+        remaining = remaining_time(estimate, self.layer_index, lines.offset)
+        if remaining is None:
+            remaining = estimate['total'] * (1.0 - self.progress / 100.0)
+        
+        elapsed = 0.0
+        if self.file_time_started:
+            elapsed = (self.file_time_finished or time.time()) - self.file_time_started
+        
+        return {
+            'total'     : estimate['total'],
+            'remaining' : remaining,
+            'elapsed'   : elapsed
+        }
+    
+    def get_stream_stats(self):
+        """
+        Return streaming statistics of the current or last file push.
+        
+        :returns: Dictionary with ``lines``, ``elapsed``, ``lines_per_second``,
+                  ``stall_time``, ``barrier_time``, ``stream_window``,
+                  ``rx_buffer_size``, ``arc_fit`` and ``compact`` keys.
+        :rtype: dict
+        """
+        if self.state == GCodeService.FILE:
+            self.__update_stream_stats()
+        return self.stream_stats
+        
+    def get_ack_latency(self, clear = False):
+        """
+        Return acknowledge latency statistics per command group, time from
+        writing a command until its reply is complete. Only the most recent
+        ``ACK_LATENCY_SIZE`` samples of each group are used.
+        
+        :param clear: Remove the samples after computing the statistics
+        :type clear: bool
+        :returns: Dictionary of groups with ``count``, ``mean``, ``p50``,
+                  ``p90``, ``p99`` and ``max`` keys, latencies are in seconds.
+        :rtype: dict
+        """
+        result = {}
+        for group, samples in self.ack_latency.items():
+            samples = sorted(samples)
+            if not samples:
+                continue
+            count = len(samples)
+            result[group] = {
+                'count' : count,
+                'mean'  : sum(samples) / count,
+                'p50'   : samples[int(0.50 * (count-1))],
+                'p90'   : samples[int(0.90 * (count-1))],
+                'p99'   : samples[int(0.99 * (count-1))],
+                'max'   : samples[-1]
+            }
+            
+        if clear:
+            self.ack_latency = {}
+        
+        return result
+    
+    def get_timeout(self, code, default = None):
+        """
+        Return the adaptive timeout of a GCode, learned from the recorded
+        reply latency of its G/M code.
+        
+        :param code: GCode, only its G/M code is used
+        :param default: Returned until enough replies of the code are recorded
+        :type code: string
+        :type default: float, None
+        :rtype: float
+        """
+        return self.latency.timeout( command_code(code), default )
+    
+    def get_latency_stats(self):
+        """
+        Return reply latency statistics per G/M code, time from writing a
+        command until its reply is complete, with the adaptive timeout and
+        slow threshold derived from them. File lines are not included.
+        
+        :returns: Dictionary with ``machine``, ``slow_commands`` and ``codes``
+                  keys, see :func:`LatencyStats.get_stats` for ``codes``
+        :rtype: dict
+        """
+        return {
+            'machine'       : self.latency.machine,
+            'slow_commands' : self.slow_commands,
+            'codes'         : self.latency.get_stats()
+        }
+    
+    def export_latency_stats(self):
+        """
+        Return the recorded reply latency samples in a JSON serializable
+        form, see :func:`LatencyStats.export`.
+        
+        :rtype: dict
+        """
+        return self.latency.export()
+    
+    def load_latency_stats(self, data):
+        """
+        Add reply latency samples returned by :func:`export_latency_stats`.
+        Samples of another machine are ignored.
+        
+        :rtype: bool
+        """
+        return self.latency.load(data)
+    
+    def get_z_stats(self):
+        """
+        Return the live Z adjustment of the current or last file push and
+        the latency of adjustments, time from :func:`z_modify` until the
+        injected move is acknowledged.
+        
+        :returns: Dictionary with ``z_override``, ``count``, ``mean``, ``last``
+                  and ``max`` keys, latencies are in seconds.
+        :rtype: dict
+        """
+        stats = dict(self.z_stats)
+        total = stats.pop('total')
+        stats['mean'] = 0.0
+        if stats['count']:
+            stats['mean'] = total / stats['count']
+        stats['z_override'] = self.z_override
+        return stats
+    
+    def get_connection_stats(self):
+        """
+        Return serial connection supervision counters. Outage is the time
+        from losing the connection until the port was reopened, recovery
+        the time from reopening the port until Totumduino replied.
+        
+        :returns: Dictionary with ``connected``, ``outages``, ``resumed``,
+                  ``aborted``, ``retransmitted``, ``last_outage``,
+                  ``last_recovery`` and ``total_outage`` keys, times are in seconds.
+        :rtype: dict
+        """
+        stats = dict(self.connection_stats)
+        stats['connected'] = self.connected
+        return stats
+    
+    def get_resend_stats(self):
+        """
+        Return resend counters of the checksum mode.
+        
+        :returns: Dictionary with ``requests``, ``failed``, ``lines`` and
+                  ``bytes`` keys.
+        :rtype: dict
+        """
+        return dict(self.resend_stats)
+    
+    def get_callback_stats(self):
+        """
+        Return callback dispatcher counters.
+        
+        :returns: Dictionary with ``dispatched``, ``dropped``, ``coalesced``
+                  and ``queued`` keys.
+        :rtype: dict
+        """
+        with self.eq_lock:
+            stats = dict(self.callback_stats)
+        stats['queued'] = self.eq.qsize()
+        return stats
+    
+    def get_lane_stats(self):
+        """
+        Return injection latency statistics of the command lanes, time from
+        queuing a command until it is written to Totumduino (gcode) or
+        served by the sender (pause, resume, abort, file).
+        
+        :returns: Dictionary with ``emergency``, ``interactive`` and ``file``
+                  keys, see :func:`CommandLanes.get_stats`
+        :rtype: dict
+        """
+        return self.lanes.get_stats()
+    
+    def set_trace_level(self, level):
+        """
+        Set the level of the trace ring buffer, ``Trace.OFF`` disables tracing.
+        
+        :param level: Trace level (``Trace.OFF``, ``Trace.ERROR``, ``Trace.WARNING``,
+                      ``Trace.INFO``, ``Trace.DEBUG``) or level name
+        :type level: int, string
+        """
+        self.trace.set_level(level)
+    
+    def get_trace(self, clear = False):
+        """
+        Return the formatted records of the trace ring buffer, oldest first.
+        
+        :param clear: Remove the records after formatting them
+        :type clear: bool
+        :rtype: list
+        """
+        return self.trace.dump(clear)
+        
     def get_idle_time(self):
         """
         Return amount of time that no command was executed from a file.
@@ -0,0 +1,647 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import standard python module
+import os
+import time
+import errno
+import fcntl
+import select
+from collections import deque
+from threading import Thread, Condition
+
+# Import external modules
+import serial
+
+# Import internal modules
+from fabtotum.utils.singleton import Singleton
+from fabtotum.utils.future import Future, TimeoutError, CancelledError
+from fabtotum.utils.gcodefile import GCodeFile
+from fabtotum.debug.trace import Trace
+from fabtotum.totumduino.framing import LineFramer
+from fabtotum.totumduino.gcode import Command, FileLine, CommandLanes, GCodeService, HOOKS
+
+################################################################################
+
+class GCodeLoopService:
+    """
+    Event loop engine of the GCode service.
+
+    Provides the same public API as :class:`GCodeService` but file streaming,
+    reply parsing and callbacks all run in a single thread around a
+    ``select()`` loop, instead of separate sender, receiver and callback
+    threads. Other threads (Pyro, monitors) only queue commands into the
+    command lanes and wake the loop up through a pipe. Every command gets a
+    :class:`Future` resolved with its reply.
+
+    Callbacks are called from the loop thread and must not block, in
+    particular they must not wait for a reply of this service.
+
+    .. note::
+        Checksum mode (line numbers and resend) is not supported by this engine.
+    """
+
+    __metaclass__ = Singleton
+
+    IDLE        = GCodeService.IDLE
+    EXECUTING   = GCodeService.EXECUTING
+    FILE        = GCodeService.FILE
+    PAUSED      = GCodeService.PAUSED
+
+    READ_TERM        = GCodeService.READ_TERM
+    ENCODING         = GCodeService.ENCODING
+    UNICODE_HANDLING = GCodeService.UNICODE_HANDLING
+    OK_REPLY_RAW     = GCodeService.OK_REPLY_RAW
+    OK_REPLY         = GCodeService.OK_REPLY
+
+    RX_BUFFER_SIZE   = GCodeService.RX_BUFFER_SIZE
+    STREAM_WINDOW    = GCodeService.STREAM_WINDOW
+    TRACE_SIZE       = GCodeService.TRACE_SIZE
+    EMERGENCY_CODES  = GCodeService.EMERGENCY_CODES
+    BARRIER_CODES    = GCodeService.BARRIER_CODES
+
+    # Maximum time in seconds the loop sleeps without any event
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, serial_port, serial_baud, serial_timeout = 5,
+                    rx_buffer_size = RX_BUFFER_SIZE, stream_window = STREAM_WINDOW,
+                    trace_level = Trace.OFF):
+        self.running = False
+        self.state = GCodeLoopService.IDLE
+        self.SERIAL_PORT = serial_port
+        self.SERIAL_BAUD = serial_baud
+        self.SERIAL_TIMEOUT = serial_timeout
+        self.trace = Trace(self.TRACE_SIZE, trace_level)
+
+        # Serial, reads never block, the loop waits in select()
+        self.serial = serial.serial_for_url(
+                                serial_port,
+                                baudrate = serial_baud,
+                                timeout = 0
+                                )
+        self.serial.flushInput()
+        self.framer = LineFramer(self.READ_TERM)
+
+        # Wakeup pipe, written by other threads when a command is queued
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.lanes = CommandLanes(Condition())
+        self.inflight = deque() # Commands waiting for a reply in order of sending
+        self.active_cmd = None
+
+        # Streaming window, Totumduino RX buffer accounting
+        self.rx_buffer_size = rx_buffer_size
+        self.stream_window = max(1, stream_window)
+        self.tx_pending_bytes = 0
+
+        # File push
+        self.gfile = None
+        self.file_line = None
+        self.file_done = True
+        self.barrier = None
+        # Acknowledge sequence numbers of the last sent and last
+        # acknowledged file line, the file push is finished once
+        # file_last is acknowledged
+        self.file_seq = 0
+        self.file_acked = 0
+        self.file_last = None
+        self.first_move = False
+        self.gcode_count = 0
+        self.progress = 0.0
+        self.file_time_started = None
+        self.file_time_finished = None
+        self.idle_time_started = time.time()
+        self.stream_stats = {}
+
+        self.group_ack = {'gcode' : 0, 'file' : 0, 'gmacro' : 0}
+
+        # Callback handler
+        self.callback = None
+
+    """ Internal *private* functions """
+
+    def __wakeup(self):
+        """
+        Wake up the loop from another thread.
+        """
+        try:
+            os.write(self.wakeup_w, b'x')
+        except OSError as e:
+            # Pipe is full, the loop is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def __trigger_callback(self, callback_name, data):
+        self.trace.debug("trigger_callback {0} {1}", callback_name, data)
+        if self.callback:
+            try:
+                self.callback(callback_name, data)
+            except Exception as e:
+                self.trace.error("callback {0} failed: {1}", callback_name, e)
+
+    def __window_fits(self, nbytes):
+        if not self.inflight:
+            return True
+        return ( len(self.inflight) < self.stream_window and
+                 self.tx_pending_bytes + nbytes <= self.rx_buffer_size )
+
+    def __transmit(self, cmd, data):
+        """
+        Write **data** to serial and register **cmd** as waiting for a reply.
+        """
+        for hook in HOOKS:
+            trigger, callback_name, callback_data = hook.process_command(cmd.data)
+            if trigger:
+                self.__trigger_callback(callback_name, callback_data)
+
+        cmd.tx_bytes = len(data)
+        self.tx_pending_bytes += cmd.tx_bytes
+        self.inflight.append(cmd)
+        self.trace.debug("<< {0}", data)
+        self.serial.write(data)
+        self.lanes.record(cmd)
+
+    def __next_file_line(self):
+        """
+        Read the next gcode line from the file being pushed.
+        Returns ``None`` at the end of the file.
+        """
+        for line, attrs in self.gfile:
+            line = line.rstrip()
+
+            if attrs:
+                self.__trigger_callback('process_comment', attrs)
+
+            if not self.first_move:
+                if line[:2] == 'G0' or line[:2] == 'G1':
+                    self.__trigger_callback('first_move', None)
+                    self.first_move = True
+
+            if line:
+                return line
+
+        return None
+
+    def __start_file(self, filename):
+        self.state = GCodeLoopService.FILE
+        self.progress = 0.0
+        self.file_time_started = time.time()
+        self.file_time_finished = None
+        self.stream_stats = {}
+
+        self.gfile = GCodeFile(filename)
+        self.gcode_count = self.gfile.info['gcode_count']
+        self.group_ack['file'] = 0
+        self.file_line = None
+        self.file_done = False
+        self.barrier = None
+        self.first_move = False
+
+        self.gfile = iter(self.gfile)
+
+    def __end_file(self):
+        """
+        No more lines are going to be sent from the file.
+        """
+        self.file_last = self.file_seq
+        if self.barrier is not None:
+            # Aborted during a barrier, the push ends without waiting
+            # until Totumduino is done with it
+            self.file_last = self.barrier.seq - 1
+
+        self.gfile = None
+        self.file_line = None
+        self.barrier = None
+        self.file_done = True
+
+        if self.file_acked >= self.file_last:
+            self.__finish_file()
+
+    def __finish_file(self):
+        """
+        Last line of the file has been acknowledged.
+        """
+        self.file_last = None
+        self.file_time_finished = time.time()
+        self.__update_stream_stats()
+        self.trace.info("stream stats: {0}", self.stream_stats)
+
+        self.progress = 100.0
+        self.state = GCodeLoopService.IDLE
+        self.__trigger_callback('file_done', None)
+        self.progress = 0.0
+
+    def __update_stream_stats(self):
+        if not self.file_time_started:
+            return
+
+        finished = self.file_time_finished or time.time()
+        elapsed = finished - self.file_time_started
+        lines = self.group_ack['file']
+
+        lines_per_second = 0.0
+        if elapsed > 0:
+            lines_per_second = lines / elapsed
+
+        self.stream_stats = {
+            'lines'             : lines,
+            'elapsed'           : elapsed,
+            'lines_per_second'  : lines_per_second,
+            'stream_window'     : self.stream_window,
+            'rx_buffer_size'    : self.rx_buffer_size
+        }
+
+    def __handle_control(self, cmd):
+        """
+        Handle pause, resume, abort and kill commands.
+        """
+        if cmd == Command.PAUSE:
+            if self.state == GCodeLoopService.FILE:
+                self.state = GCodeLoopService.PAUSED
+                self.__trigger_callback('state_change', 'paused')
+
+        elif cmd == Command.RESUME:
+            if self.state == GCodeLoopService.PAUSED:
+                self.state = GCodeLoopService.FILE
+                self.__trigger_callback('state_change', 'resumed')
+
+        elif cmd == Command.ABORT:
+            if not self.file_done:
+                self.__trigger_callback('state_change', 'aborted')
+                self.state = GCodeLoopService.FILE
+                self.__end_file()
+
+        elif cmd == Command.KILL:
+            self.running = False
+
+    def __dispatch(self):
+        """
+        Send queued commands and file lines as long as the streaming window
+        allows. Emergency and interactive commands always go first.
+        """
+        while self.running:
+            cmd = self.lanes.peek(CommandLanes.FILE)
+
+            if cmd is not None:
+                if cmd != Command.GCODE:
+                    self.lanes.get_nowait(CommandLanes.FILE)
+                    self.__handle_control(cmd)
+                    continue
+
+                data = cmd.data + '\r\n'
+                if not self.__window_fits(len(data)):
+                    return
+                self.lanes.get_nowait(CommandLanes.FILE)
+                self.__transmit(cmd, data)
+                continue
+
+            if self.state == GCodeLoopService.IDLE:
+                cmd = self.lanes.peek()
+                if cmd is None:
+                    return
+                self.lanes.get_nowait()
+                if cmd == Command.FILE:
+                    self.__start_file(cmd.data)
+                continue
+
+            if self.state != GCodeLoopService.FILE or self.file_done or self.barrier:
+                return
+
+            if self.file_line is None:
+                self.file_line = self.__next_file_line()
+                if self.file_line is None:
+                    self.__end_file()
+                    return
+
+            data = self.file_line + '\r\n'
+            if not self.__window_fits(len(data)):
+                return
+
+            self.file_seq += 1
+            if self.file_line.split(' ', 1)[0] in self.BARRIER_CODES:
+                # Wait for the reply before sending more file lines
+                cmd = Command.gcode(self.file_line, group='file')
+                cmd.seq = self.file_seq
+                self.barrier = cmd
+            else:
+                cmd = FileLine(self.file_line, self.file_seq)
+            self.file_line = None
+            self.__transmit(cmd, data)
+
+    def __handle_line(self, line_raw):
+        """
+        Process a one line of reply message.
+        """
+        self.trace.debug("__handle_line {0} [ {1} ]", line_raw, self.active_cmd)
+
+        if line_raw == self.OK_REPLY_RAW:
+            line = self.OK_REPLY
+        else:
+            line = line_raw.decode(self.ENCODING, self.UNICODE_HANDLING)
+
+        if not line:
+            return
+
+        self.idle_time_started = time.time()
+
+        if not self.active_cmd:
+            if not self.inflight:
+                self.trace.debug(">> {0}", line)
+                return
+            self.active_cmd = self.inflight[0]
+
+        cmd = self.active_cmd
+        if cmd.reply is not None:
+            cmd.reply.append( line )
+
+        if cmd.hasExpectedReply(line):
+            self.inflight.popleft()
+            self.active_cmd = None
+            self.tx_pending_bytes -= cmd.tx_bytes
+            cmd.tx_bytes = 0
+
+            group = cmd.group
+            if group:
+                self.group_ack[group] = self.group_ack.get(group, 0) + 1
+
+            if cmd.future:
+                cmd.future.set_result(cmd.reply)
+
+            if cmd is self.barrier:
+                self.barrier = None
+
+            if cmd.seq:
+                self.file_acked = cmd.seq
+                self.progress = 100 * float(self.group_ack['file']) / float(self.gcode_count or 1)
+                if self.file_last is not None and self.file_acked >= self.file_last:
+                    self.__finish_file()
+
+        elif cmd.data[:4] == 'M109': # Extruder
+            # T:27.4 E:0 W:?
+            temps = line.split()
+            T = temps[0].replace("T:","").strip()
+            self.__trigger_callback('temp_change:ext', [T])
+
+        elif cmd.data[:4] == 'M190': # Bed
+            # T:27.38 E:0 B:54.9
+            temps = line.split()
+            T = temps[0].replace("T:","").strip()
+            B = temps[2].replace("B:","").strip()
+            self.__trigger_callback('temp_change:all', [T,B])
+
+    def __loop_thread(self):
+        """
+        Event loop, waits for serial data and wakeups.
+        """
+        print "loop thread: started"
+
+        serial_fd = self.serial.fileno()
+        rlist = [serial_fd, self.wakeup_r]
+
+        try:
+            while self.running and self.serial.is_open:
+                self.__dispatch()
+
+                if not self.running:
+                    break
+
+                try:
+                    readable, writable, exceptional = select.select(rlist, [], [], self.POLL_INTERVAL)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self.wakeup_r in readable:
+                    try:
+                        os.read(self.wakeup_r, 4096)
+                    except OSError:
+                        pass
+
+                if serial_fd in readable:
+                    try:
+                        data = self.serial.read(self.serial.in_waiting or 1)
+                    except serial.SerialException as e:
+                        # probably some I/O problem such as disconnected USB serial
+                        # adapters -> exit
+                        print e
+                        break
+
+                    for line_raw in self.framer.feed(data):
+                        self.__handle_line(line_raw)
+        finally:
+            # Nobody would resolve the pending futures anymore
+            self.running = False
+            self.__cleanup()
+
+        print "loop thread: stopped"
+
+    def __cleanup(self):
+        """
+        Cancel all queued and in flight commands.
+        """
+        for cmd in self.lanes.clear():
+            if cmd.future:
+                cmd.future.cancel()
+
+        while self.inflight:
+            cmd = self.inflight.popleft()
+            if cmd.future:
+                cmd.future.cancel()
+
+        self.active_cmd = None
+        self.tx_pending_bytes = 0
+
+    """ APIs *public* functions """
+
+    def start(self):
+        """
+        Start the event loop thread.
+        """
+        self.running = True
+
+        self.thread = Thread( target = self.__loop_thread )
+        self.thread.start()
+
+    def loop(self):
+        """
+        Wait until the event loop is closed.
+        """
+        self.thread.join()
+
+    def stop(self):
+        """
+        Stop the event loop and close the serial port.
+        """
+        self.lanes.put( Command.kill(), CommandLanes.EMERGENCY )
+        self.__wakeup()
+        self.thread.join()
+
+        self.serial.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+        print "Event loop stopped"
+
+    def pause(self):
+        """
+        Pause current file push. In case no file is being pushed this command
+        has no effect.
+        """
+        self.lanes.put( Command.pause(), CommandLanes.EMERGENCY )
+        self.__wakeup()
+
+    def resume(self):
+        """
+        Resume current file push. In case no file is being pushed this command
+        has no effect.
+        """
+        self.lanes.put( Command.resume(), CommandLanes.EMERGENCY )
+        self.__wakeup()
+
+    def abort(self):
+        """
+        Abort current file push. In case no file is being pushed this command
+        has no effect.
+        """
+        self.lanes.put( Command.abort(), CommandLanes.EMERGENCY )
+        self.__wakeup()
+
+    def register_callback(self, callback_name, callback_fun):
+        """
+        Callbacks: update, file_done, paused, resumed
+        """
+        self.callback = callback_fun
+
+    def unregister_callback(self):
+        """
+        Unregister callback function.
+        """
+        self.callback = None
+
+    def submit(self, code):
+        """
+        Queue GCode and return a future resolved with the reply.
+
+        :param code: GCode
+        :type code: string
+        :rtype: Future
+        """
+        cmd = Command.gcode(code, 'ok')
+        cmd.future = Future()
+
+        if not self.running:
+            cmd.future.cancel()
+            return cmd.future
+
+        if code.split(' ', 1)[0] in self.EMERGENCY_CODES:
+            self.lanes.put(cmd, CommandLanes.EMERGENCY)
+        else:
+            self.lanes.put(cmd, CommandLanes.INTERACTIVE)
+        self.__wakeup()
+
+        return cmd.future
+
+    def send(self, code, block = True, timeout = None):
+        """
+        Send GCode and return reply.
+        """
+        code = code.encode('latin-1')
+        if not self.running:
+            return None
+
+        if code == 'M25':
+            self.pause()
+            return None
+        elif code == 'M24':
+            self.resume()
+            return None
+
+        future = self.submit(code)
+
+        if not block:
+            return None
+
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            print 'Timeout for ', code
+        except CancelledError:
+            print 'Aborting reply.'
+        return None
+
+    def send_file(self, filename):
+        """
+        Send GCode from a file.
+        Returns ``False`` if a file is already being pushed.
+
+        :rtype: bool
+        """
+        if self.running:
+            if self.state == GCodeLoopService.IDLE:
+                self.lanes.put( Command.file(filename), CommandLanes.FILE )
+                self.__wakeup()
+                return True
+
+        return False
+
+    def get_progress(self):
+        """
+        Return current file progress.
+        After file_done callback is finished executing, progress will be set to 0.
+        """
+        return self.progress
+
+    def get_stream_stats(self):
+        """
+        Return streaming statistics of the current or last file push,
+        see :func:`GCodeService.get_stream_stats`.
+        """
+        if self.state == GCodeLoopService.FILE:
+            self.__update_stream_stats()
+        return self.stream_stats
+
+    def get_lane_stats(self):
+        """
+        Return injection latency statistics of the command lanes,
+        see :func:`GCodeService.get_lane_stats`.
+        """
+        return self.lanes.get_stats()
+
+    def set_trace_level(self, level):
+        """
+        Set the level of the trace ring buffer, ``Trace.OFF`` disables tracing.
+        """
+        self.trace.set_level(level)
+
+    def get_trace(self, clear = False):
+        """
+        Return the formatted records of the trace ring buffer, oldest first.
+        """
+        return self.trace.dump(clear)
+
+    def get_idle_time(self):
+        """
+        Return amount of time that no command was executed from a file.
+        """
+        return self.idle_time_started - time.time()
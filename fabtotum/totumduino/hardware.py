@@ -24,12 +24,14 @@ import time
     
 # Import external modules
 import serial
-import RPi.GPIO as GPIO
 
 # Import internal modules
 from fabtotum.fabui.config import ConfigService
 
 def reset():
+    # Imported here so that the service runs with the emulator off the board
+    import RPi.GPIO as GPIO
+    
     GPIO.setmode(GPIO.BOARD)
     GPIO.setwarnings(False)
 
@@ -70,13 +72,15 @@ def startup(gcs):
     except KeyError:
         collision_warning = 0
     
-    gcs.send("M728")
-    gcs.send("M402")
-    gcs.send("M701 S"+str(color['r']))
-    gcs.send("M702 S"+str(color['g']))
-    gcs.send("M703 S"+str(color['b']))
+    gcs.send_many([
+        "M728",
+        "M402",
+        "M701 S"+str(color['r']),
+        "M702 S"+str(color['g']),
+        "M703 S"+str(color['b']),
         
-    gcs.send("M732 S"+str(safety_door))
-    gcs.send("M714 S"+str(switch))
+        "M732 S"+str(safety_door),
+        "M714 S"+str(switch),
         
-    gcs.send("M734 S"+str(collision_warning))
+        "M734 S"+str(collision_warning)
+    ])
@@ -0,0 +1,268 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import standard python module
+import re
+import json
+import time
+import platform
+from collections import deque
+from threading import Lock
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+CODE_RE = re.compile(r'^([GMT])0*(\d+)')
+
+def command_code(line):
+    """
+    Return the normalized G/M/T code of a GCode line, ``G01 X1`` and
+    ``g1 x1`` both give ``G1``.
+
+    :param line: GCode line without line number and checksum
+    :type line: string
+    :returns: Code or ``None`` if the line does not start with a G/M/T word
+    :rtype: string
+    """
+    match = CODE_RE.match( line.lstrip().upper() )
+    if match:
+        return match.group(1) + match.group(2)
+    return None
+
+class LatencyStats(object):
+    """
+    Reply latency distributions per G/M code of one machine.
+
+    Only the most recent ``size`` samples of every code are kept. Once a
+    code has ``MIN_SAMPLES`` samples its distribution is used to derive
+    an adaptive timeout and an earlier threshold after which a command is
+    considered abnormally slow. Codes without enough samples have neither.
+
+    Usage::
+
+        stats = LatencyStats()
+        stats.record('M400', 1.2)
+        timeout = stats.timeout('M400', default=10)
+        with open(filename, 'w') as f:
+            json.dump(stats.export(), f)
+    """
+
+    # Number of samples kept per code
+    SIZE = 256
+    # Number of samples required before adaptive values are used
+    MIN_SAMPLES = 10
+    # Adaptive timeout is TIMEOUT_FACTOR times the 99th percentile
+    TIMEOUT_FACTOR = 3.0
+    # A command is slow after SLOW_FACTOR times the 99th percentile
+    SLOW_FACTOR = 1.5
+    # Lower bounds in seconds, short commands jitter with the serial
+    # link and the planner
+    MIN_TIMEOUT = 2.0
+    MIN_SLOW = 0.5
+    # Codes waiting for temperatures or endstops, their reply time depends
+    # on the machine state so no adaptive timeout is derived for them
+    BLOCKING_CODES = ('M109', 'M190', 'G28', 'G29')
+
+    def __init__(self, machine = None, size = SIZE):
+        """
+        :param machine: Machine name, defaults to the host name
+        :param size: Number of samples kept per code
+        :type machine: string
+        :type size: int
+        """
+        self.machine = machine or platform.node()
+        self.size = size
+        self.samples = {}
+        # Percentiles per code, invalidated by record()
+        self.cache = {}
+        self.lock = Lock()
+
+    def __percentiles(self, code):
+        """
+        Return the cached distribution of **code**, ``None`` if there are
+        not enough samples. Must be called with ``lock`` acquired.
+        """
+        stats = self.cache.get(code)
+        if stats is None:
+            samples = self.samples.get(code)
+            if not samples:
+                return None
+            samples = sorted(samples)
+            count = len(samples)
+            stats = {
+                'count' : count,
+                'mean'  : sum(samples) / count,
+                'p50'   : samples[int(0.50 * (count-1))],
+                'p90'   : samples[int(0.90 * (count-1))],
+                'p99'   : samples[int(0.99 * (count-1))],
+                'max'   : samples[-1]
+            }
+            stats['timeout'] = None
+            stats['slow'] = None
+            if count >= self.MIN_SAMPLES:
+                if code not in self.BLOCKING_CODES:
+                    stats['timeout'] = max(self.MIN_TIMEOUT, self.TIMEOUT_FACTOR * stats['p99'])
+                stats['slow'] = max(self.MIN_SLOW, self.SLOW_FACTOR * stats['p99'])
+            self.cache[code] = stats
+        return stats
+
+    def record(self, code, latency):
+        """
+        Add a latency sample of **code**.
+
+        :param code: Normalized code, see :func:`command_code`
+        :param latency: Time in seconds from sending the command until its reply was complete
+        :type code: string
+        :type latency: float
+        """
+        with self.lock:
+            samples = self.samples.get(code)
+            if samples is None:
+                samples = self.samples[code] = deque(maxlen=self.size)
+            samples.append(latency)
+            self.cache.pop(code, None)
+
+    def timeout(self, code, default = None):
+        """
+        Return the adaptive timeout of **code**.
+
+        :param code: Normalized code
+        :param default: Returned if there are not enough samples
+        :type code: string
+        :type default: float, None
+        :rtype: float
+        """
+        with self.lock:
+            stats = self.__percentiles(code)
+        if stats is None or stats['timeout'] is None:
+            return default
+        return stats['timeout']
+
+    def threshold(self, code):
+        """
+        Return the time after which a command of **code** is considered
+        abnormally slow, ``None`` if there are not enough samples.
+
+        :param code: Normalized code
+        :type code: string
+        :rtype: float, None
+        """
+        with self.lock:
+            stats = self.__percentiles(code)
+        if stats is None:
+            return None
+        return stats['slow']
+
+    def get_stats(self):
+        """
+        Return the latency distribution of every code.
+
+        :returns: Dictionary of codes with ``count``, ``mean``, ``p50``,
+                  ``p90``, ``p99``, ``max``, ``timeout`` and ``slow`` keys,
+                  times are in seconds.
+        :rtype: dict
+        """
+        result = {}
+        with self.lock:
+            for code in self.samples.keys():
+                stats = self.__percentiles(code)
+                if stats is not None:
+                    result[code] = dict(stats)
+        return result
+
+    def clear(self):
+        """
+        Remove all samples.
+        """
+        with self.lock:
+            self.samples = {}
+            self.cache = {}
+
+    def export(self):
+        """
+        Return the samples in a JSON serializable form, see :func:`load`.
+
+        :rtype: dict
+        """
+        with self.lock:
+            samples = {}
+            for code, values in self.samples.items():
+                samples[code] = list(values)
+        return {
+            'machine'   : self.machine,
+            'time'      : time.time(),
+            'samples'   : samples
+        }
+
+    def load(self, data):
+        """
+        Add previously exported samples. Samples of another machine are
+        ignored as reply times depend on the machine setup.
+
+        :param data: Result of :func:`export`
+        :type data: dict
+        :returns: ``True`` if the samples were loaded
+        :rtype: bool
+        """
+        if data.get('machine') != self.machine:
+            return False
+
+        with self.lock:
+            for code, values in data.get('samples', {}).items():
+                samples = self.samples.get(code)
+                if samples is None:
+                    samples = self.samples[code] = deque(maxlen=self.size)
+                # Loaded samples are older than the recorded ones
+                recorded = list(samples)
+                samples.clear()
+                samples.extend(values)
+                samples.extend(recorded)
+            self.cache = {}
+        return True
+
+    def save(self, filename):
+        """
+        Write the exported samples to a JSON file.
+
+        :param filename: JSON file
+        :type filename: string
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.export(), f)
+
+    def restore(self, filename):
+        """
+        Load samples from a JSON file written by :func:`save`. A missing or
+        damaged file is ignored.
+
+        :param filename: JSON file
+        :type filename: string
+        :returns: ``True`` if the samples were loaded
+        :rtype: bool
+        """
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return self.load(data)
@@ -0,0 +1,407 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Power-loss recovery of file pushes.
+
+While a file is pushed ``GCodeService`` tracks its modal state with
+:class:`ModalState` and periodically hands checkpoints to a
+:class:`CheckpointWriter`, which writes them to disk from its own thread.
+After a power cut :func:`resume_gcode` returns the commands bringing the
+machine back to the state of the checkpoint, the file push continues from
+the checkpoint offset.
+"""
+
+# Import standard python module
+import os
+import json
+import time
+import hashlib
+from threading import Thread, Condition
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+# Number of bytes at the start of a file used to identify it
+IDENTITY_SIZE = 65536
+
+# Z lift in mm before homing XY on resume
+RESUME_Z_LIFT = 2.0
+# Feedrate in mm/min of resume travel moves
+RESUME_XY_FEEDRATE = 6000
+RESUME_Z_FEEDRATE = 1000
+
+def file_identity(filename):
+    """
+    Return the identity of a file, used to check that a checkpoint
+    belongs to it.
+
+    :param filename: File
+    :type filename: string
+    :returns: Dictionary with ``filename``, ``size``, ``mtime`` and ``md5``
+              (of the first ``IDENTITY_SIZE`` bytes) keys
+    :rtype: dict
+    """
+    st = os.stat(filename)
+    with open(filename, 'rb') as f:
+        digest = hashlib.md5( f.read(IDENTITY_SIZE) ).hexdigest()
+    return {
+        'filename'  : os.path.abspath(filename),
+        'size'      : st.st_size,
+        'mtime'     : st.st_mtime,
+        'md5'       : digest
+    }
+
+def same_file(identity):
+    """
+    Check whether the file of **identity** still exists unchanged.
+
+    :param identity: Result of :func:`file_identity`
+    :type identity: dict
+    :rtype: bool
+    """
+    try:
+        current = file_identity(identity['filename'])
+    except (OSError, IOError, KeyError):
+        return False
+    return ( current['size'] == identity.get('size') and
+             current['md5'] == identity.get('md5') )
+
+class ModalState(object):
+    """
+    Modal state of a file push: positioning modes, last position and
+    feedrate, temperatures and fan speed.
+
+    Coordinates in absolute mode are kept as the strings found in the file
+    and converted only by :func:`snapshot`, so tracking a move costs no
+    float conversion.
+    """
+
+    MOVE_CODES = ('G0', 'G1', 'G2', 'G3')
+
+    def __init__(self):
+        self.absolute = True    # G90 / G91
+        self.absolute_e = True  # M82 / M83
+        self.position = {'X' : 0.0, 'Y' : 0.0, 'Z' : 0.0, 'E' : 0.0}
+        self.feedrate = None
+        self.extruder = 0.0
+        self.bed = 0.0
+        self.fan = 0
+
+    def __param(self, args, name, default = None):
+        for word in args.split():
+            if word[0] == name:
+                try:
+                    return float(word[1:])
+                except ValueError:
+                    return default
+        return default
+
+    def update(self, line):
+        """
+        Update the state with a GCode line.
+
+        :param line: GCode without comment
+        :type line: string
+        """
+        parts = line.split(None, 1)
+        if not parts:
+            return
+        code = parts[0]
+        args = ''
+        if len(parts) > 1:
+            args = parts[1]
+
+        if code in self.MOVE_CODES:
+            position = self.position
+            for word in args.split():
+                axis = word[0]
+                if axis in position:
+                    if axis == 'E':
+                        relative = not self.absolute or not self.absolute_e
+                    else:
+                        relative = not self.absolute
+                    if relative:
+                        try:
+                            position[axis] = float(position[axis]) + float(word[1:])
+                        except ValueError:
+                            pass
+                    else:
+                        position[axis] = word[1:]
+                elif axis == 'F':
+                    self.feedrate = word[1:]
+        elif code == 'G90':
+            self.absolute = True
+        elif code == 'G91':
+            self.absolute = False
+        elif code == 'G92':
+            for word in args.split():
+                if word[0] in self.position:
+                    self.position[word[0]] = word[1:]
+        elif code == 'M82':
+            self.absolute_e = True
+        elif code == 'M83':
+            self.absolute_e = False
+        elif code == 'M104' or code == 'M109':
+            self.extruder = self.__param(args, 'S', self.extruder)
+        elif code == 'M140' or code == 'M190':
+            self.bed = self.__param(args, 'S', self.bed)
+        elif code == 'M106':
+            self.fan = int( self.__param(args, 'S', 255) )
+        elif code == 'M107':
+            self.fan = 0
+
+    def snapshot(self):
+        """
+        Return the state as a JSON serializable dictionary.
+
+        :rtype: dict
+        """
+        position = {}
+        for axis, value in self.position.items():
+            try:
+                position[axis] = float(value)
+            except ValueError:
+                position[axis] = 0.0
+
+        feedrate = None
+        if self.feedrate is not None:
+            try:
+                feedrate = float(self.feedrate)
+            except ValueError:
+                pass
+
+        return {
+            'absolute'      : self.absolute,
+            'absolute_e'    : self.absolute_e,
+            'position'      : position,
+            'feedrate'      : feedrate,
+            'extruder'      : self.extruder,
+            'bed'           : self.bed,
+            'fan'           : self.fan
+        }
+
+    def restore(self, state):
+        """
+        Set the state from a :func:`snapshot`.
+
+        :param state: State dictionary
+        :type state: dict
+        """
+        self.absolute = state['absolute']
+        self.absolute_e = state['absolute_e']
+        self.position = dict(state['position'])
+        self.feedrate = state['feedrate']
+        self.extruder = state['extruder']
+        self.bed = state['bed']
+        self.fan = state['fan']
+
+def resume_gcode(checkpoint):
+    """
+    Return the commands bringing the machine to the state of a checkpoint
+    after a power cut: heat up, home XY at a lifted Z and move back to the
+    last position with the positioning modes, extruder position and fan
+    speed of the checkpoint. Z is assumed to be where it was when the power
+    was cut.
+
+    :param checkpoint: Checkpoint written by :class:`CheckpointWriter`
+    :type checkpoint: dict
+    :rtype: list
+    """
+    state = checkpoint['state']
+    position = state['position']
+    lines = []
+
+    if state['bed'] > 0:
+        lines.append( 'M140 S{0:.0f}'.format(state['bed']) )
+    if state['extruder'] > 0:
+        lines.append( 'M104 S{0:.0f}'.format(state['extruder']) )
+    if state['bed'] > 0:
+        lines.append( 'M190 S{0:.0f}'.format(state['bed']) )
+    if state['extruder'] > 0:
+        lines.append( 'M109 S{0:.0f}'.format(state['extruder']) )
+
+    lines += [
+        'G90',
+        'G92 Z{0:.3f}'.format(position['Z']),
+        'G0 Z{0:.3f} F{1}'.format(position['Z'] + RESUME_Z_LIFT, RESUME_Z_FEEDRATE),
+        'G28 X Y',
+        'G0 X{0:.3f} Y{1:.3f} F{2}'.format(position['X'], position['Y'], RESUME_XY_FEEDRATE),
+        'G0 Z{0:.3f} F{1}'.format(position['Z'], RESUME_Z_FEEDRATE)
+    ]
+
+    if state['absolute_e']:
+        lines.append('M82')
+        lines.append( 'G92 E{0:.5f}'.format(position['E']) )
+    else:
+        lines.append('M83')
+
+    if state['fan']:
+        lines.append( 'M106 S{0}'.format(state['fan']) )
+    else:
+        lines.append('M107')
+
+    if state['feedrate']:
+        lines.append( 'G1 F{0:.0f}'.format(state['feedrate']) )
+
+    if not state['absolute']:
+        lines.append('G91')
+
+    return lines
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints to a JSON file from a separate thread so that slow
+    storage does not stall the file push. Only the most recent checkpoint
+    waiting to be written is kept. A checkpoint is written to a temporary
+    file that replaces the previous one once it is synced, so there is
+    always a complete checkpoint on disk.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Checkpoint file
+        :type filename: string
+        """
+        self.filename = filename
+        self.cond = Condition()
+        self.pending = None
+        self.pending_clear = False
+        self.running = False
+        self.thread = None
+        self.stats = {
+            'submitted'     : 0, # Checkpoints handed to the writer
+            'written'       : 0, # Checkpoints written to disk
+            'failed'        : 0,
+            'write_time'    : 0.0, # Time spent writing in seconds
+            'last'          : None # Time of the last written checkpoint
+        }
+
+    def __write(self, checkpoint):
+        started = time.time()
+        tmp_file = self.filename + '.tmp'
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_file, 'w') as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync( f.fileno() )
+            os.rename(tmp_file, self.filename)
+        except (IOError, OSError) as e:
+            print "Checkpoint not written:", e
+            self.stats['failed'] += 1
+            return
+
+        self.stats['written'] += 1
+        self.stats['write_time'] += time.time() - started
+        self.stats['last'] = checkpoint.get('time')
+
+    def __remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def __writer_thread(self):
+        while True:
+            with self.cond:
+                while self.running and self.pending is None and not self.pending_clear:
+                    self.cond.wait()
+                checkpoint = self.pending
+                remove = self.pending_clear
+                self.pending = None
+                self.pending_clear = False
+                if checkpoint is None and not remove and not self.running:
+                    break
+
+            if remove:
+                self.__remove()
+            elif checkpoint is not None:
+                self.__write(checkpoint)
+
+    def start(self):
+        """
+        Start the writer thread.
+        """
+        self.running = True
+        self.thread = Thread( target = self.__writer_thread )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write the pending checkpoint and stop the writer thread.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+
+    def write(self, checkpoint):
+        """
+        Queue a checkpoint for writing, replacing a queued one. Never blocks.
+
+        :param checkpoint: JSON serializable checkpoint
+        :type checkpoint: dict
+        """
+        with self.cond:
+            self.pending = checkpoint
+            self.pending_clear = False
+            self.stats['submitted'] += 1
+            self.cond.notify()
+
+    def clear(self):
+        """
+        Drop the queued checkpoint and remove the checkpoint file.
+        """
+        with self.cond:
+            self.pending = None
+            self.pending_clear = True
+            self.cond.notify()
+
+    def load(self):
+        """
+        Return the checkpoint on disk.
+
+        :returns: Checkpoint or ``None`` if there is none
+        :rtype: dict
+        """
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def get_stats(self):
+        """
+        Return writer counters.
+
+        :returns: Dictionary with ``submitted``, ``written``, ``failed``,
+                  ``write_time`` and ``last`` keys.
+        :rtype: dict
+        """
+        with self.cond:
+            return dict(self.stats)
@@ -0,0 +1,176 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import standard python module
+from threading import Condition
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+class CancelledError(Exception):
+    """ The future was cancelled before a result was set. """
+    pass
+
+class TimeoutError(Exception):
+    """ The result was not available within the given timeout. """
+    pass
+
+class Future(object):
+    """
+    Result of an operation that completes in another thread.
+
+    Done callbacks are called with the future as the only argument from the
+    thread that completes the future, or right away if it is already done.
+    They must not block.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        Return ``True`` if the future has a result, an exception or was cancelled.
+        """
+        return self._done
+
+    def cancelled(self):
+        """
+        Return ``True`` if the future was cancelled.
+        """
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancel the future if it is not done yet.
+
+        :returns: ``True`` if the future has been cancelled
+        :rtype: bool
+        """
+        with self._cond:
+            if self._done:
+                return self._cancelled
+            self._cancelled = True
+            self._done = True
+            self._cond.notify_all()
+
+        self.__invoke_callbacks()
+        return True
+
+    def set_result(self, result):
+        """
+        Complete the future with **result**. Ignored if it was cancelled.
+
+        :returns: ``True`` if the result has been set
+        :rtype: bool
+        """
+        with self._cond:
+            if self._done:
+                return False
+            self._result = result
+            self._done = True
+            self._cond.notify_all()
+
+        self.__invoke_callbacks()
+        return True
+
+    def set_exception(self, exception):
+        """
+        Complete the future with **exception**. Ignored if it was cancelled.
+
+        :returns: ``True`` if the exception has been set
+        :rtype: bool
+        """
+        with self._cond:
+            if self._done:
+                return False
+            self._exception = exception
+            self._done = True
+            self._cond.notify_all()
+
+        self.__invoke_callbacks()
+        return True
+
+    def result(self, timeout = None):
+        """
+        Wait until the future is done and return its result.
+
+        :param timeout: Time in seconds to wait, wait forever if ``None``
+        :type timeout: float, None
+        :raises TimeoutError: The future is not done within **timeout**
+        :raises CancelledError: The future was cancelled
+        """
+        self.__wait(timeout)
+
+        if self._cancelled:
+            raise CancelledError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout = None):
+        """
+        Wait until the future is done and return its exception or ``None``.
+
+        :param timeout: Time in seconds to wait, wait forever if ``None``
+        :type timeout: float, None
+        :raises TimeoutError: The future is not done within **timeout**
+        :raises CancelledError: The future was cancelled
+        """
+        self.__wait(timeout)
+
+        if self._cancelled:
+            raise CancelledError()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call **fn** with the future as argument once it is done.
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def __wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise TimeoutError()
+
+    def __invoke_callbacks(self):
+        with self._cond:
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print "Future callback failed:", e
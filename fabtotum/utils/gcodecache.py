@@ -0,0 +1,346 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Persistent cache of gcode file analysis.
+
+Every analysed file has an entry directory named after its key, a hash of
+its path, size, modification time and the md5 of its first bytes. A
+changed file gets a new key, its old entry is never used again and is
+eventually evicted. The entry holds the :class:`GCodeInfo` attributes in
+``info.json`` next to optional index files of the same file.
+
+Entries are evicted least recently used first once all of them take more
+than the size budget. Several processes can share a cache, every file is
+written to a temporary file first and then renamed. A new entry is built
+in a temporary directory, renamed into place when its ``info.json`` is
+stored.
+"""
+
+# Import standard python module
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from threading import Lock
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+# Number of bytes at the start of a file hashed into its key
+HASH_SIZE = 65536
+# Default size budget of the cache in bytes
+BUDGET = 32 * 1024 * 1024
+# Entries written with another version are ignored
+VERSION = 1
+
+INFO_FILE = 'info.json'
+# Extension of entries being written
+TMP_EXT = '.tmp'
+# Entries without info.json younger than GRACE seconds are being written
+# and never evicted, older ones have been left over by a failed writer
+GRACE = 600.0
+
+def file_key(filename):
+    """
+    Return the cache key of a file.
+
+    :param filename: File
+    :type filename: string
+    :returns: Hex digest of the file path, size, modification time and
+              the md5 of its first ``HASH_SIZE`` bytes
+    :rtype: string
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    with open(filename, 'rb') as f:
+        prefix = hashlib.md5( f.read(HASH_SIZE) ).hexdigest()
+    identity = '{0}\0{1}\0{2!r}\0{3}'.format(filename, st.st_size, st.st_mtime, prefix)
+    return hashlib.sha1(identity).hexdigest()
+
+class AnalysisCache(object):
+    """
+    Cache of gcode file analysis in a directory.
+
+    Usage::
+
+        cache = AnalysisCache(ANALYSIS_CACHE_PATH)
+        attribs = cache.load(filename)
+        if attribs is None:
+            attribs = analyse(filename)
+            cache.store(filename, attribs)
+    """
+
+    def __init__(self, path, budget = BUDGET):
+        """
+        :param path: Cache directory, created when the first entry is stored
+        :param budget: Size budget in bytes
+        :type path: string
+        :type budget: int
+        """
+        self.path = path
+        self.budget = budget
+        self.lock = Lock()
+        # Temporary directories of new entries per key, see entry_file()
+        self.staging = {}
+        self.stats = {
+            'hits'      : 0,
+            'misses'    : 0,
+            'stored'    : 0,
+            'evicted'   : 0, # Evicted entries
+            'errors'    : 0  # Entries that could not be read or written
+        }
+
+    def __count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def __entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __write(self, filename, data):
+        tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.rename(tmp_file, filename)
+
+    def key(self, filename):
+        """
+        Return the cache key of **filename**, ``None`` if it cannot be read.
+
+        :rtype: string
+        """
+        try:
+            return file_key(filename)
+        except (IOError, OSError):
+            return None
+
+    def load(self, filename, key = None):
+        """
+        Return the cached analysis of a file and mark its entry as used.
+
+        :param filename: GCode file
+        :param key: Key of the file if already known
+        :type filename: string
+        :type key: string
+        :returns: Stored attributes or ``None`` if the file is not cached
+        :rtype: dict
+        """
+        key = key or self.key(filename)
+        if key is None:
+            self.__count('misses')
+            return None
+
+        info_file = os.path.join( self.__entry(key), INFO_FILE )
+        try:
+            with open(info_file, 'r') as f:
+                data = json.load(f)
+        except IOError:
+            self.__count('misses')
+            return None
+        except ValueError:
+            self.__count('errors')
+            self.__count('misses')
+            return None
+
+        if data.get('version') != VERSION:
+            self.__count('misses')
+            return None
+
+        try:
+            # Modification time orders the entries for eviction
+            os.utime(info_file, None)
+        except OSError:
+            pass
+
+        self.__count('hits')
+        return data['attribs']
+
+    def store(self, filename, attribs, key = None):
+        """
+        Store the analysis of a file and evict entries over the budget.
+
+        :param filename: GCode file
+        :param attribs: JSON serializable attributes
+        :param key: Key of the file if already known
+        :type filename: string
+        :type attribs: dict
+        :type key: string
+        :returns: ``True`` if the entry was written
+        :rtype: bool
+        """
+        key = key or self.key(filename)
+        if key is None:
+            return False
+
+        entry = self.__entry(key)
+        data = {
+            'version'   : VERSION,
+            'filename'  : os.path.abspath(filename),
+            'time'      : time.time(),
+            'attribs'   : attribs
+        }
+        with self.lock:
+            staging = self.staging.pop(key, None)
+        try:
+            stored = False
+            if staging and os.path.isdir(staging):
+                self.__write( os.path.join(staging, INFO_FILE), json.dumps(data) )
+                try:
+                    os.rename(staging, entry)
+                    stored = True
+                except OSError:
+                    # Stored by another writer meanwhile
+                    shutil.rmtree(staging, ignore_errors=True)
+            if not stored:
+                if not os.path.isdir(entry):
+                    os.makedirs(entry)
+                self.__write( os.path.join(entry, INFO_FILE), json.dumps(data) )
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print "Analysis cache entry not written:", e
+            self.__count('errors')
+            return False
+
+        self.__count('stored')
+        self.evict()
+        return True
+
+    def entry_file(self, filename, name, key = None):
+        """
+        Return the path of index file **name** in the entry of a file. A new
+        entry is created as a temporary directory renamed into place by
+        :func:`store`, the index file is not created.
+
+        :param filename: GCode file
+        :param name: Index file name
+        :param key: Key of the file if already known
+        :type filename: string
+        :type name: string
+        :type key: string
+        :returns: Path or ``None`` if the cache is not usable
+        :rtype: string
+        """
+        key = key or self.key(filename)
+        if key is None:
+            return None
+        entry = self.__entry(key)
+        if not os.path.isdir(entry):
+            with self.lock:
+                entry = self.staging.get(key)
+                if entry is None or not os.path.isdir(entry):
+                    try:
+                        if not os.path.isdir(self.path):
+                            os.makedirs(self.path)
+                        entry = tempfile.mkdtemp(prefix=key + '.', suffix=TMP_EXT, dir=self.path)
+                    except OSError:
+                        return None
+                    self.staging[key] = entry
+        return os.path.join(entry, name)
+
+    def __entries(self):
+        """
+        Return ``(last_used, size, path, stored)`` of every entry, **stored**
+        is ``False`` for an entry without ``info.json``. Its last use is the
+        modification time of its directory.
+        """
+        entries = []
+        try:
+            keys = os.listdir(self.path)
+        except OSError:
+            return entries
+
+        for key in keys:
+            entry = self.__entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = 0
+            stored = False
+            try:
+                last_used = os.path.getmtime(entry)
+                for name in os.listdir(entry):
+                    st = os.stat( os.path.join(entry, name) )
+                    size += st.st_size
+                    if name == INFO_FILE:
+                        last_used = st.st_mtime
+                        stored = True
+            except OSError:
+                continue
+            entries.append( (last_used, size, entry, stored) )
+        return entries
+
+    def evict(self, budget = None):
+        """
+        Remove least recently used entries until all entries fit in the
+        size budget. Entries being written are kept, see ``GRACE``.
+
+        :param budget: Size budget in bytes, defaults to the cache budget
+        :type budget: int
+        :returns: Number of removed entries
+        :rtype: int
+        """
+        if budget is None:
+            budget = self.budget
+
+        entries = sorted( self.__entries() )
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        now = time.time()
+        # The most recently used entry is always kept
+        for last_used, size, entry, stored in entries[:-1]:
+            if total <= budget:
+                break
+            if not stored and now - last_used < GRACE:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+
+        with self.lock:
+            self.stats['evicted'] += removed
+        return removed
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        for last_used, size, entry, stored in self.__entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def get_stats(self):
+        """
+        Return cache counters and usage.
+
+        :returns: Dictionary with ``hits``, ``misses``, ``stored``, ``evicted``,
+                  ``errors``, ``entries``, ``size`` and ``budget`` keys, sizes
+                  are in bytes.
+        :rtype: dict
+        """
+        entries = self.__entries()
+        with self.lock:
+            stats = dict(self.stats)
+        stats['entries'] = sum(1 for entry in entries if entry[3])
+        stats['size'] = sum(entry[1] for entry in entries)
+        stats['budget'] = self.budget
+        return stats
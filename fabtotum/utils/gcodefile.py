@@ -19,10 +19,19 @@
 # along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import standard python module
+import os
+import json
+import mmap
+import operator
 
 # Import external modules
 
 # Import internal modules
+from fabtotum.utils import gcodefilter
+from fabtotum.utils import gcodetime
+from fabtotum.utils.gcodecache import file_key
+from fabtotum.utils.gcodeindex import LineIndex, LineIndexWriter, build_line_index, LINE_INDEX_CHUNK, LINE_INDEX_MAX_OFFSET
+from fabtotum.utils.gcodeindex import LayerIndex, build_layer_index
 from fabtotum.utils.slicer import cura_utils
 from fabtotum.utils.slicer import slic3r_utils
 
@@ -32,15 +41,88 @@ EXTERNALS = {
     'SLIC3R'    : slic3r_utils
 }
 
+# Pre-framed gcode cache file extension
+FRAMED_EXT = '.framed'
+# First line of a pre-framed cache file: key of the gcode file, see
+# gcodecache.file_key, and byte size of the frames following it
+FRAMED_HEADER = ';framed {0} {1}\n'
+# Line index file, in the analysis cache entry of a file or next to it
+LINE_INDEX_FILE = 'lines.idx'
+LINE_INDEX_EXT = '.lines'
+# Layer index file, in the analysis cache entry of a file or next to it
+LAYER_INDEX_FILE = 'layers.json'
+LAYER_INDEX_EXT = '.layers'
+# Print time estimate file, in the analysis cache entry of a file or next to it
+TIME_ESTIMATE_FILE = 'time.json'
+TIME_ESTIMATE_EXT = '.time'
+
+# Slicer signatures, searched for in the first and last SNIFF_SIZE bytes
+# of a file. Cura writes its profile at the end, Slic3r its name at the top.
+SLICER_SIGNATURES = (
+    ('SLIC3R',  'generated by Slic3r'),
+    ('CURA',    'CURA_PROFILE_STRING:')
+)
+SNIFF_SIZE = 16384
+
+def sniff_slicer(filename):
+    """
+    Return the slicer that generated a gcode file.
+    
+    :param filename: GCode file
+    :type filename: string
+    :returns: Key of ``EXTERNALS`` or ``None`` if the slicer is not known
+    :rtype: string
+    """
+    with open(filename, 'rb') as file:
+        head = file.read(SNIFF_SIZE)
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        tail = ''
+        if size > SNIFF_SIZE:
+            file.seek( max(SNIFF_SIZE, size - SNIFF_SIZE) )
+            tail = file.read()
+    
+    for slicer, signature in SLICER_SIGNATURES:
+        if signature in head or signature in tail:
+            return slicer
+    return None
+
+def frame_line(data, line_number):
+    """
+    Add line number and checksum to a gcode line.
+    
+    :param data: GCode without comments and line terminator
+    :param line_number: Line number
+    :type data: string
+    :type line_number: int
+    :returns: Framed line ``N<line_number> <data>*<checksum>\\r\\n``
+    :rtype: string
+    """
+    code = "N{0} {1}".format(line_number, data)
+    checksum = reduce(operator.xor, bytearray(code), 0)
+    return "{0}*{1}\r\n".format(code, checksum)
+
 class GCodeFileIter:
     
-    def __init__(self, filename, attr_parser = None):
+    def __init__(self, filename, attr_parser = None, offset = 0, line = None):
         self.fd = open(filename, 'r+')
         self.parser = attr_parser
+        # Byte offset of the next line
+        self.offset = offset
+        # Number of the next line, None if not known
+        self.line = line
+        if offset:
+            self.fd.seek(offset)
+        
+    def __iter__(self):
+        return self
         
     def next(self):
         line = self.fd.readline()
         if line:
+            self.offset += len(line)
+            if self.line is not None:
+                self.line += 1
             
             if self.parser:
                 attrs = self.parser.process_line(line)
@@ -82,44 +164,370 @@ class GCodeInfo:
 
 class GCodeFile:
     
-    def __init__(self, filename):
+    def __init__(self, filename, cache = None):
+        """
+        :param filename: GCode file
+        :param cache: Analysis cache, a cached file is not scanned again
+        :type filename: string
+        :type cache: :class:`fabtotum.utils.gcodecache.AnalysisCache`
+        """
         self.info = GCodeInfo(filename)
-        self.process_file(filename)
+        self.cache = cache
+        self.cache_key = None
+        self.lines = None
+        self.layers = None
+        
+        index_file = None
+        if cache:
+            self.cache_key = cache.key(filename)
+            attribs = cache.load(filename, self.cache_key)
+            if attribs is not None:
+                for key, value in attribs.items():
+                    self.info[key] = value
+                self.info['filename'] = filename
+                return
+            index_file = cache.entry_file(filename, LINE_INDEX_FILE, self.cache_key)
+        
+        self.process_file(filename, index_file)
+        
+        if cache:
+            cache.store(filename, self.info.attribs, self.cache_key)
         
     def __iter__(self):
         """
         Return iterable object used to iterate though gcode.
         """
+        return self.iterate()
+    
+    def iterate(self, offset = 0, line = None):
+        """
+        Return iterable object used to iterate though gcode starting at
+        **offset** or at line number **line**. Its ``offset`` attribute
+        is the byte offset and its ``line`` attribute the number of the
+        next line. The line number is known only if the file has a line
+        index or **line** is given.
+        
+        :param offset: Byte offset of the first line
+        :param line: Number of the first line counted from 0, overrides **offset**
+        :type offset: int
+        :type line: int
+        :rtype: GCodeFileIter
+        :raises IndexError: **line** is beyond the end of the file
+        """
         parser = None
         if 'slicer' in self.info:
             if self.info['slicer'] in EXTERNALS:
                 parser = EXTERNALS[ self.info['slicer'] ]
-        return GCodeFileIter(self.info['filename'], parser)
+        
+        if line is not None:
+            index = self.line_index()
+            if index:
+                offset = index.offset(line)
+            else:
+                # No index, skip the lines
+                offset = 0
+                with open(self.info['filename'], 'rb') as file:
+                    for i in xrange(line):
+                        data = file.readline()
+                        if not data:
+                            raise IndexError("line {0} out of range".format(line))
+                        offset += len(data)
+        elif not offset:
+            line = 0
+        else:
+            index = self.line_index()
+            if index:
+                line = index.line(offset)
+        
+        return GCodeFileIter(self.info['filename'], parser, offset, line)
+    
+    def line_index(self):
+        """
+        Return the line index of the file, built on first use if the
+        analysis did not build one. The index is kept in the analysis cache
+        entry of the file, or next to the file without a cache.
+        
+        :returns: Memory-mapped index or ``None`` if it cannot be stored
+        :rtype: :class:`fabtotum.utils.gcodeindex.LineIndex`
+        """
+        if self.lines is not None:
+            return self.lines
+        
+        index_file, fresh = self.__index_file(LINE_INDEX_FILE, LINE_INDEX_EXT)
+        if index_file is None:
+            return None
+        
+        if not fresh and not build_line_index(self.info['filename'], index_file):
+            return None
+        
+        try:
+            self.lines = LineIndex(index_file)
+        except (IOError, ValueError, mmap.error):
+            return None
+        return self.lines
+    
+    def __index_file(self, name, ext):
+        """
+        Return the path of an index file of the gcode file and whether it is
+        up to date, ``(None, False)`` if it cannot be stored.
+        """
+        filename = self.info['filename']
+        if self.cache:
+            index_file = self.cache.entry_file(filename, name, self.cache_key)
+            if index_file is None:
+                return None, False
+            return index_file, os.path.exists(index_file)
+        
+        index_file = filename + ext
+        try:
+            fresh = os.path.getmtime(index_file) >= os.path.getmtime(filename)
+        except OSError:
+            fresh = False
+        return index_file, fresh
+    
+    def layer_index(self):
+        """
+        Return the layer index of the file, built on first use. Layers are
+        found by the slicer comments, see :class:`fabtotum.utils.gcodeindex.LayerIndex`.
+        The index is kept in the analysis cache entry of the file, or next to
+        the file without a cache.
+        
+        :returns: Layer index, empty if the file has no layer comments
+        :rtype: :class:`fabtotum.utils.gcodeindex.LayerIndex`
+        """
+        if self.layers is not None:
+            return self.layers
+        
+        index_file, fresh = self.__index_file(LAYER_INDEX_FILE, LAYER_INDEX_EXT)
+        if fresh:
+            try:
+                self.layers = LayerIndex.load(index_file)
+                return self.layers
+            except IOError:
+                pass
+        
+        if 'slicer' in self.info and self.info['slicer'] in EXTERNALS:
+            parsers = [ EXTERNALS[ self.info['slicer'] ] ]
+        else:
+            parsers = EXTERNALS.values()
+        
+        try:
+            self.layers = build_layer_index(self.info['filename'], parsers)
+        except IOError:
+            return LayerIndex([])
+        
+        if index_file:
+            self.layers.save(index_file)
+        return self.layers
+    
+    def estimate_time(self, profile = None):
+        """
+        Return the estimated print time of the file, total and per layer of
+        :func:`layer_index`, see :func:`fabtotum.utils.gcodetime.estimate_print_time`.
+        The estimate is kept in the analysis cache entry of the file, or next
+        to the file without a cache, and computed again for another profile.
+        
+        :param profile: Machine profile, see :func:`fabtotum.utils.gcodetime.machine_profile`
+        :type profile: dict
+        :returns: Estimate or ``None`` if NumPy is not available
+        :rtype: dict
+        """
+        if not gcodetime.AVAILABLE:
+            return None
+        
+        profile = gcodetime.machine_profile(profile)
+        index_file, fresh = self.__index_file(TIME_ESTIMATE_FILE, TIME_ESTIMATE_EXT)
+        if fresh:
+            try:
+                with open(index_file, 'r') as f:
+                    data = json.load(f)
+                if data['profile'] == profile:
+                    return data['estimate']
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+        
+        layers = self.layer_index()
+        try:
+            estimate = gcodetime.estimate_print_time(self.info['filename'], layers, profile)
+        except IOError:
+            return None
+        
+        if index_file:
+            tmp_file = '{0}.{1}.tmp'.format(index_file, os.getpid())
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump({'profile' : profile, 'estimate' : estimate}, f)
+                os.rename(tmp_file, index_file)
+            except (IOError, OSError) as e:
+                print "Print time estimate not written:", e
+        return estimate
+
+    def fit_arcs(self, tolerance = gcodefilter.TOLERANCE):
+        """
+        Return an arc fitted copy of the file, runs of short ``G1`` segments
+        are replaced by ``G1`` lines and ``G2``/``G3`` arcs deviating at most
+        **tolerance** mm from them, see :class:`fabtotum.utils.gcodefilter.ArcFitter`.
+        The copy is cached next to the gcode file and rebuilt only if the
+        gcode file is newer than the cache or the tolerance has changed.
+        The fitting report is in ``info['arc_fit']`` of the copy.
+        If the cache location is not writable the file itself is returned.
+        
+        :param tolerance: Maximum deviation in mm
+        :type tolerance: float
+        :rtype: GCodeFile
+        """
+        filename = self.info['filename']
+        cache_file = filename + gcodefilter.ARCS_EXT
+        
+        report = None
+        try:
+            if os.path.getmtime(cache_file) >= os.path.getmtime(filename):
+                report = gcodefilter.read_report(cache_file)
+                if report and report.get('tolerance') != tolerance:
+                    report = None
+        except OSError:
+            pass
+        
+        if report is None:
+            try:
+                report = gcodefilter.fit_arcs(filename, cache_file, tolerance)
+            except (IOError, OSError):
+                return self
+        
+        gfile = GCodeFile(cache_file, self.cache)
+        gfile.info['arc_fit'] = report
+        return gfile
+    
+    def framed(self):
+        """
+        Return an iterable of pre-framed gcode lines. Lines are numbered from 1
+        in the order of non-empty codes returned by the file iterator.
+        The framed lines are cached next to the gcode file and rebuilt unless
+        the cache has been written for the same file (path, size, modification
+        time and md5 of the first bytes, see :func:`fabtotum.utils.gcodecache.file_key`)
+        and has its full size.
+        """
+        filename = self.info['filename']
+        cache_file = filename + FRAMED_EXT
+        
+        key = self.cache_key
+        if key is None:
+            key = file_key(filename)
+        
+        try:
+            file = open(cache_file, 'rb')
+        except IOError:
+            pass
+        else:
+            header = file.readline()
+            fields = header.split()
+            if ( len(fields) == 3 and fields[1] == key and fields[2].isdigit() and
+                 os.fstat(file.fileno()).st_size == len(header) + int(fields[2]) ):
+                return file
+            file.close()
+        
+        frames = self.build_frames(filename)
+        
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as file:
+                file.write( FRAMED_HEADER.format(key, sum(len(frame) for frame in frames)) )
+                file.writelines(frames)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            # Cache location not writable, keep the frames in memory
+            pass
+        
+        return frames
+    
+    def build_frames(self, filename):
+        """
+        Frame all the codes of a gcode file with line numbers and checksums.
+        
+        :param filename: GCode file
+        :type filename: string
+        :rtype: list
+        """
+        frames = []
+        line_number = 0
+        
+        with open(filename, 'r') as file:
+            for line in file:
+                code = line.split(';', 1)[0].strip()
+                if code:
+                    line_number += 1
+                    frames.append( frame_line(code, line_number) )
+        
+        return frames
 
-    def process_file(self, filename):
+    def process_file(self, filename, index_file = None):
         """
         Go threough the whole gcode file and extract usefull information about it.
         This information include gcode type, code count, layer count...
+        
+        The slicer is sniffed from the start and end of the file first so that
+        only its comment parser is used, and only on lines with a comment.
+        
+        :param filename: GCode file
+        :param index_file: Line index file written during the scan
+        :type filename: string
+        :type index_file: string
         """
+        index = None
+        offset = 0
+        if index_file and os.path.getsize(filename) <= LINE_INDEX_MAX_OFFSET:
+            try:
+                index = LineIndexWriter(index_file)
+                index_append = index.offsets.append
+            except IOError:
+                pass
+        
         count = 0
         gcode_count = 0
         max_layer = 0
         layer_count = 0
-        slicer = None
+        slicer = sniff_slicer(filename)
         gcode_type = None
         
+        if slicer:
+            self.info['slicer'] = slicer
+            externals = [ EXTERNALS[slicer] ]
+        else:
+            externals = EXTERNALS.values()
+        
         with open(filename, 'r+') as file:
             for line in file:
                 count += 1
                 
-                head = line[:4]
+                if index:
+                    index_append(offset)
+                    offset += len(line)
+                    if not count % LINE_INDEX_CHUNK:
+                        index.flush()
+                
+                head = line[:1]
                 
-                if head == 'M109':
-                    gcode_type = self.info['type'] = GCodeInfo.PRINT
-                elif head == 'M3 S' or head == 'M4 S':
-                    gcode_type = self.info['type'] = GCodeInfo.MILL
+                if head == 'G':
+                    gcode_count += 1
+                    # Pure moves carry no information
+                    if ';' not in line:
+                        continue
+                elif head == 'M':
+                    gcode_count += 1
+                    head = line[:4]
+                    if head == 'M109':
+                        gcode_type = self.info['type'] = GCodeInfo.PRINT
+                    elif head == 'M3 S' or head == 'M4 S':
+                        gcode_type = self.info['type'] = GCodeInfo.MILL
+                    if ';' not in line:
+                        continue
+                elif head != ';':
+                    if line.split(';', 1)[0].strip():
+                        gcode_count += 1
+                    if ';' not in line:
+                        continue
                 
-                for external in EXTERNALS.values():
+                for external in externals:
                     attrs = external.process_line(line)
                     
                     if 'type' in attrs:
@@ -133,12 +541,11 @@ class GCodeFile:
                         if layer > max_layer:
                             max_layer = layer
         
-                tags = line.strip().split(';')
-                if tags[0]:
-                    gcode_count += 1
-        
         if not layer_count and gcode_type == GCodeInfo.PRINT and max_layer > 0:
             self.info['layer_count'] = max_layer
         
         self.info['line_count'] = count
         self.info['gcode_count'] = gcode_count
+        
+        if index:
+            index.close(offset)
@@ -0,0 +1,961 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+GCode filters reducing the number of lines sent to the Totumduino.
+
+:class:`ArcFitter` replaces runs of short ``G1`` segments approximating
+lines and curves by single ``G1`` and ``G2``/``G3`` moves. It works on raw
+file lines and passes comments through, so the slicer attributes of the
+output are those of the input.
+
+:class:`BandwidthFilter` is a stream stage between the file iterator and
+the serial writer merging collinear segments, dropping modal repeats and
+trimming coordinates to the machine resolution.
+"""
+
+# Import standard python module
+import os
+import math
+import json
+from collections import deque
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+# Maximum distance in mm between the original segments and the fitted move
+TOLERANCE = 0.05
+# Length in mm of the segments the firmware splits arcs into
+# (MM_PER_ARC_SEGMENT in Marlin)
+ARC_SEGMENT = 1.0
+# Arcs with a larger radius in mm are left as segments, the firmware
+# arc interpolation loses precision on them
+MAX_RADIUS = 1000.0
+# Minimum and maximum number of segments replaced by one move
+MIN_SEGMENTS = 3
+MAX_SEGMENTS = 64
+# Maximum relative difference of the extrusion per mm of the segments
+# of one move, the fitted move extrudes uniformly
+E_RATIO_TOLERANCE = 0.25
+
+# Maximum distance in mm between collinear segments and the merged move
+MERGE_TOLERANCE = 0.01
+# Totumduino steps per mm, the extruder (or 4th axis) value is changed
+# with M92 by the print and mill macros
+STEPS_PER_MM = {
+    'X' : 72.58,
+    'Y' : 72.58,
+    'Z' : 2133.33,
+    'E' : 3048.1593
+}
+
+# Arc fitted gcode cache file extension
+ARCS_EXT = '.arcs'
+# First line of an arc fitted file, followed by the fitting report
+ARCS_HEADER = ';ARC_FIT:'
+
+def split_words(code):
+    """
+    Split a gcode into its command and parameter words.
+
+    :param code: GCode without comment
+    :type code: string
+    :returns: Tuple of command and dictionary of parameter letters and values,
+              ``G1 X1.5 E2`` gives ``('G1', {'X' : '1.5', 'E' : '2'})``
+    :rtype: tuple
+    """
+    words = code.split()
+    if not words:
+        return None, {}
+    params = {}
+    for word in words[1:]:
+        params[word[0]] = word[1:]
+    return words[0], params
+
+def _circle(a, b, c):
+    """
+    Return center and radius of the circle through three points,
+    ``None`` if they are collinear.
+    """
+    ax, ay = a
+    bx, by = b
+    cx, cy = c
+    d = 2.0 * ( ax*(by - cy) + bx*(cy - ay) + cx*(ay - by) )
+    if abs(d) < 1e-12:
+        return None
+    a2 = ax*ax + ay*ay
+    b2 = bx*bx + by*by
+    c2 = cx*cx + cy*cy
+    ux = ( a2*(by - cy) + b2*(cy - ay) + c2*(ay - by) ) / d
+    uy = ( a2*(cx - bx) + b2*(ax - cx) + c2*(bx - ax) ) / d
+    return ux, uy, math.hypot(ax - ux, ay - uy)
+
+def _decimals(steps_per_mm):
+    """
+    Return the number of decimals resolving one step, rounding to them
+    moves a coordinate by less than half a step.
+    """
+    if steps_per_mm <= 1:
+        return 0
+    return int( math.ceil( math.log10(steps_per_mm) ) )
+
+def _format(value, decimals):
+    """
+    Format a coordinate with at most **decimals** decimals and no
+    trailing zeros.
+    """
+    text = '{0:.{1}f}'.format(value, decimals)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return text
+
+def _sagitta(radius, chord):
+    """
+    Return the maximum distance between an arc and its chord.
+    """
+    half = chord / 2.0
+    if half >= radius:
+        return radius
+    return radius - math.sqrt(radius*radius - half*half)
+
+class ArcFitter(object):
+    """
+    Replace runs of ``G1`` segments by ``G1`` lines and ``G2``/``G3`` arcs
+    deviating at most ``tolerance`` mm from the original segments.
+
+    Only extruding or only travelling ``G1`` moves in the XY plane with a
+    constant feedrate in absolute positioning are fitted, everything else
+    is passed through unchanged and ends the current run. The extruder
+    position at the end of a fitted move is the one at the end of the
+    replaced segments, so the extrusion total is preserved. In relative
+    extrusion mode the rounding error of the summed extrusion is carried
+    over to the next move.
+
+    Usage::
+
+        fitter = ArcFitter(tolerance=0.05)
+        with open(filename) as f:
+            for line in fitter.process(f):
+                out.write(line)
+        print fitter.stats
+    """
+
+    def __init__(self, tolerance = TOLERANCE, arc_segment = ARC_SEGMENT,
+                 min_segments = MIN_SEGMENTS, max_segments = MAX_SEGMENTS):
+        """
+        :param tolerance: Maximum deviation in mm
+        :param arc_segment: Firmware arc segment length in mm
+        :param min_segments: Minimum number of segments replaced by one move
+        :param max_segments: Maximum number of segments replaced by one move
+        :type tolerance: float
+        :type arc_segment: float
+        :type min_segments: int
+        :type max_segments: int
+        """
+        self.tolerance = tolerance
+        self.arc_segment = arc_segment
+        self.min_segments = max(2, min_segments)
+        self.max_segments = max(self.min_segments, max_segments)
+        # Smallest radius the firmware interpolates within tolerance
+        if tolerance < arc_segment / 2.0:
+            self.min_radius = (arc_segment*arc_segment / 4.0 + tolerance*tolerance) / (2.0 * tolerance)
+        else:
+            self.min_radius = tolerance
+
+        self.absolute = True
+        self.absolute_e = True
+        self.x = 0.0
+        self.y = 0.0
+        self.e = 0.0
+        self.e_carry = 0.0
+        # Segments of the current run, see __segment()
+        self.run = []
+        self.run_feedrate = None
+        self.run_extruding = None
+
+        self.stats = {
+            'lines_in'  : 0,
+            'lines_out' : 0,
+            'bytes_in'  : 0,
+            'bytes_out' : 0,
+            'arcs'      : 0, # G2/G3 moves written
+            'lines'     : 0, # Merged G1 moves written
+            'segments'  : 0  # G1 segments replaced
+        }
+
+    def __output(self, line):
+        self.stats['lines_out'] += 1
+        self.stats['bytes_out'] += len(line)
+        return line
+
+    def __track(self, command, params):
+        """
+        Update the modal state with a line that is not part of a run.
+        """
+        if command in ('G0', 'G1', 'G2', 'G3', 'G00', 'G01', 'G02', 'G03'):
+            try:
+                if 'X' in params:
+                    x = float(params['X'])
+                    if self.absolute:
+                        self.x = x
+                    elif self.x is not None:
+                        self.x += x
+                if 'Y' in params:
+                    y = float(params['Y'])
+                    if self.absolute:
+                        self.y = y
+                    elif self.y is not None:
+                        self.y += y
+                if 'E' in params:
+                    e = float(params['E'])
+                    self.e = e if (self.absolute and self.absolute_e) else self.e + e
+            except ValueError:
+                pass
+        elif command == 'G28':
+            # Position unknown until the next absolute move
+            if 'X' in params or 'Y' not in params:
+                self.x = None
+            if 'Y' in params or 'X' not in params:
+                self.y = None
+        elif command == 'G90':
+            self.absolute = True
+        elif command == 'G91':
+            self.absolute = False
+        elif command == 'M82':
+            self.absolute_e = True
+        elif command == 'M83':
+            self.absolute_e = False
+        elif command == 'G92':
+            try:
+                if 'X' in params:
+                    self.x = float(params['X'])
+                if 'Y' in params:
+                    self.y = float(params['Y'])
+                if 'E' in params:
+                    self.e = float(params['E'])
+            except ValueError:
+                pass
+
+    def __segment(self, line, command, params):
+        """
+        Return the segment of a G1 line that can be part of a run, ``None``
+        if the line ends the run.
+        """
+        if command not in ('G1', 'G01') or not self.absolute:
+            return None
+        if self.x is None or self.y is None:
+            return None
+        for letter in params:
+            if letter not in 'XYEF':
+                return None
+        if 'X' not in params and 'Y' not in params:
+            return None
+
+        try:
+            x = float(params['X']) if 'X' in params else self.x
+            y = float(params['Y']) if 'Y' in params else self.y
+            if 'E' in params:
+                e = float(params['E'])
+                de = e - self.e if self.absolute_e else e
+            else:
+                de = 0.0
+        except ValueError:
+            return None
+
+        length = math.hypot(x - self.x, y - self.y)
+        if length < 1e-6 or de < 0:
+            return None
+
+        return {
+            'line'      : line,
+            'x'         : x,
+            'y'         : y,
+            'de'        : de,
+            'e'         : params.get('E'),
+            'f'         : params.get('F'),
+            'length'    : length
+        }
+
+    def __flush(self):
+        """
+        Fit the current run and return its output lines.
+        """
+        run = self.run
+        self.run = []
+        lines = []
+        if not run:
+            return lines
+
+        points = [ (run[0]['start'][0], run[0]['start'][1]) ]
+        for seg in run:
+            points.append( (seg['x'], seg['y']) )
+
+        i = 0
+        count = len(run)
+        while i < count:
+            best = None
+            j = i + self.min_segments
+            while j <= count and j - i <= self.max_segments:
+                move = self.__fit(points, run, i, j)
+                if move is None:
+                    break
+                best = (j, move)
+                j += 1
+
+            if best is None:
+                lines.append( self.__output(run[i]['line']) )
+                i += 1
+            else:
+                j, move = best
+                lines.append( self.__output( self.__format(run, i, j, move) ) )
+                self.stats['segments'] += j - i
+                i = j
+
+        return lines
+
+    def __fit(self, points, run, i, j):
+        """
+        Fit segments ``i`` to ``j-1`` (points ``i`` to ``j``) of the run.
+
+        :returns: ``('G1',)`` for a line, ``(command, cx, cy)`` for an arc,
+                  ``None`` if the segments cannot be replaced
+        """
+        tolerance = self.tolerance
+
+        # Uniform extrusion along the move
+        if run[i]['de'] > 0:
+            ratio = sum(seg['de'] for seg in run[i:j]) / sum(seg['length'] for seg in run[i:j])
+            for seg in run[i:j]:
+                if abs(seg['de'] / seg['length'] - ratio) > E_RATIO_TOLERANCE * ratio:
+                    return None
+
+        ax, ay = points[i]
+        bx, by = points[j]
+        dx = bx - ax
+        dy = by - ay
+        chord = math.hypot(dx, dy)
+
+        # Straight line through the first and last point
+        if chord > 1e-6:
+            along = -1.0
+            for k in xrange(i+1, j):
+                px, py = points[k]
+                if abs( (px - ax)*dy - (py - ay)*dx ) / chord > tolerance:
+                    break
+                progress = ( (px - ax)*dx + (py - ay)*dy ) / chord
+                if progress <= along or progress >= chord:
+                    break
+                along = progress
+            else:
+                return ('G1',)
+
+        # Circle through the first, middle and last point
+        circle = _circle( points[i], points[(i + j) // 2], points[j] )
+        if circle is None:
+            return None
+        cx, cy, radius = circle
+        if radius > MAX_RADIUS or radius < self.min_radius:
+            return None
+
+        # All points on the circle, all segments turning the same way and
+        # within tolerance of the arc
+        direction = 0
+        sweep = 0.0
+        for k in xrange(i, j):
+            px, py = points[k]
+            qx, qy = points[k+1]
+            if abs( math.hypot(qx - cx, qy - cy) - radius ) > tolerance:
+                return None
+            ux, uy = px - cx, py - cy
+            vx, vy = qx - cx, qy - cy
+            cross = ux*vy - uy*vx
+            turn = 1 if cross > 0 else -1
+            if direction and turn != direction:
+                return None
+            direction = turn
+            sweep += abs( math.atan2(cross, ux*vx + uy*vy) )
+            if _sagitta(radius, run[k]['length']) > tolerance:
+                return None
+
+        if sweep >= 2*math.pi - 1e-3:
+            return None
+
+        if direction > 0:
+            return ('G3', cx, cy)
+        return ('G2', cx, cy)
+
+    def __format(self, run, i, j, move):
+        """
+        Return the line replacing segments ``i`` to ``j-1`` of the run.
+        """
+        first = run[i]
+        last = run[j-1]
+        words = [ move[0] ]
+
+        if last['line_x'] is not None:
+            words.append('X' + last['line_x'])
+        else:
+            words.append('X{0:.3f}'.format(last['x']))
+        if last['line_y'] is not None:
+            words.append('Y' + last['line_y'])
+        else:
+            words.append('Y{0:.3f}'.format(last['y']))
+
+        if len(move) == 3:
+            sx, sy = first['start']
+            words.append('I{0:.3f}'.format(move[1] - sx))
+            words.append('J{0:.3f}'.format(move[2] - sy))
+            self.stats['arcs'] += 1
+        else:
+            self.stats['lines'] += 1
+
+        if first['de'] > 0:
+            if self.absolute_e:
+                words.append('E' + last['e'])
+            else:
+                total = sum(seg['de'] for seg in run[i:j]) + self.e_carry
+                value = round(total, 5)
+                self.e_carry = total - value
+                words.append('E{0:.5f}'.format(value))
+
+        if first['f'] is not None:
+            words.append('F' + first['f'])
+
+        # Keep the comment of the first segment, verbose slicer output
+        # names the feature of every move
+        comment = first['line'].find(';')
+        if comment >= 0:
+            words.append( first['line'][comment:].rstrip() )
+
+        return ' '.join(words) + '\n'
+
+    def process(self, lines):
+        """
+        Filter gcode lines.
+
+        :param lines: Iterable of raw gcode lines, with comments and line terminators
+        :type lines: iterable
+        :returns: Generator of filtered lines
+        :rtype: generator
+        """
+        stats = self.stats
+        for line in lines:
+            stats['lines_in'] += 1
+            stats['bytes_in'] += len(line)
+
+            code = line.split(';', 1)[0].strip()
+            command, params = split_words(code)
+
+            segment = None
+            if command is not None:
+                segment = self.__segment(line, command, params)
+
+            if segment is not None:
+                feedrate = segment['f']
+                extruding = segment['de'] > 0
+                if self.run and ( (feedrate is not None and feedrate != self.run_feedrate) or
+                                  extruding != self.run_extruding ):
+                    for out in self.__flush():
+                        yield out
+                if self.run:
+                    # Feedrate is modal, only the first move needs it
+                    segment['f'] = None
+                else:
+                    self.run_feedrate = feedrate
+                    self.run_extruding = extruding
+                segment['start'] = (self.x, self.y)
+                segment['line_x'] = params.get('X')
+                segment['line_y'] = params.get('Y')
+                self.run.append(segment)
+                self.x = segment['x']
+                self.y = segment['y']
+                self.e += segment['de']
+                if self.absolute_e and segment['e'] is not None:
+                    self.e = float(segment['e'])
+                continue
+
+            for out in self.__flush():
+                yield out
+            if command is not None:
+                self.__track(command, params)
+            yield self.__output(line)
+
+        for out in self.__flush():
+            yield out
+
+    def get_stats(self):
+        """
+        Return the fitting report.
+
+        :returns: Dictionary with ``lines_in``, ``lines_out``, ``bytes_in``,
+                  ``bytes_out``, ``arcs``, ``lines`` and ``segments`` keys
+        :rtype: dict
+        """
+        stats = dict(self.stats)
+        stats['tolerance'] = self.tolerance
+        return stats
+
+class BandwidthFilter(object):
+    """
+    Stream stage shrinking the bytes sent for a file push. Wraps a file
+    iterator returning ``(code, attrs)`` tuples, see :class:`fabtotum.utils.gcodefile.GCodeFileIter`,
+    and returns the same kind of tuples:
+
+    - consecutive ``G1`` XY segments deviating at most ``tolerance`` mm
+      from a straight line are merged into one move,
+    - coordinates are rounded to the resolution of the axis steps per mm,
+    - coordinates and feedrates equal to the last sent ones are dropped,
+      moves left without parameters are not sent at all.
+
+    Every move is held back until the next line is known. The extruder
+    position is written unrounded at the end of every run of moves, so
+    the extrusion total is exact and rounding errors never accumulate. In
+    relative extrusion mode the rounding error is carried over to the next
+    move instead. Steps per mm are updated by M92 lines of the file.
+
+    The ``offset`` attribute is the byte offset after the last file line
+    contained in the returned codes, so a push can be continued from it.
+
+    Usage::
+
+        lines = BandwidthFilter( gfile.iterate() )
+        for code, attrs in lines:
+            send(code)
+        print lines.get_stats()['bytes_saved']
+    """
+
+    MOVE_CODES = ('G0', 'G1', 'G00', 'G01')
+
+    def __init__(self, lines, steps_per_mm = None, tolerance = MERGE_TOLERANCE, state = None):
+        """
+        :param lines: File iterator
+        :param steps_per_mm: Steps per mm of X, Y, Z and E axes, defaults to ``STEPS_PER_MM``
+        :param tolerance: Maximum deviation of merged segments in mm
+        :param state: Modal state the file continues from, see :func:`fabtotum.totumduino.recovery.ModalState.snapshot`
+        :type lines: iterable
+        :type steps_per_mm: dict
+        :type tolerance: float
+        :type state: dict
+        """
+        self.lines = lines
+        self.source = iter(lines)
+        self.offset = getattr(lines, 'offset', 0)
+        self.tolerance = tolerance
+        self.steps = dict(STEPS_PER_MM)
+        if steps_per_mm:
+            self.steps.update(steps_per_mm)
+        self.decimals = {}
+        for axis, steps in self.steps.items():
+            self.decimals[axis] = _decimals(steps)
+
+        self.absolute = True
+        self.absolute_e = True
+        # Position and feedrate of the file
+        self.position = {'X' : None, 'Y' : None, 'Z' : None, 'E' : 0.0}
+        self.feedrate = None
+        # Last sent parameter values
+        self.written = {'X' : None, 'Y' : None, 'Z' : None, 'E' : None, 'F' : None}
+        self.e_carry = 0.0
+        if state:
+            self.absolute = state['absolute']
+            self.absolute_e = state['absolute_e']
+            for axis, value in state['position'].items():
+                self.position[axis] = float(value)
+
+        # Move held back until the next line is known
+        self.pending = None
+        # Output tuples of (code, attrs, offset)
+        self.ready = deque()
+        self.finished = False
+
+        self.stats = {
+            'lines_in'  : 0,
+            'codes_in'  : 0,
+            'codes_out' : 0,
+            'bytes_in'  : 0, # Codes with line terminator
+            'bytes_out' : 0,
+            'merged'    : 0, # Segments merged into the previous move
+            'stripped'  : 0, # Parameters dropped as modal repeats
+            'dropped'   : 0  # Moves dropped without any parameter left
+        }
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.ready:
+            if self.finished:
+                self.offset = getattr(self.lines, 'offset', self.offset)
+                raise StopIteration
+            try:
+                code, attrs = next(self.source)
+            except StopIteration:
+                self.finished = True
+                self.__flush(True)
+                continue
+            self.__process( code, attrs, getattr(self.lines, 'offset', 0) )
+
+        code, attrs, offset = self.ready.popleft()
+        self.offset = offset
+        return code, attrs
+
+    def __process(self, code, attrs, offset):
+        stats = self.stats
+        stats['lines_in'] += 1
+        if code:
+            stats['codes_in'] += 1
+            stats['bytes_in'] += len(code) + 2
+
+        command, params = split_words(code)
+
+        if command in self.MOVE_CODES and self.absolute:
+            move = self.__move(command, params, attrs, offset)
+            if move is not None:
+                if self.pending is not None:
+                    if self.__merge(move):
+                        return
+                    self.__flush(False)
+                self.pending = move
+                return
+
+        if not code and not attrs:
+            # Nothing to send and nothing to report
+            return
+
+        self.__flush(True)
+        if command is not None:
+            self.__track(command, params)
+            stats['codes_out'] += 1
+            stats['bytes_out'] += len(code) + 2
+        self.ready.append( (code, attrs, offset) )
+
+    def __track(self, command, params):
+        """
+        Update the modal state with a line that is passed through.
+        """
+        position = self.position
+        written = self.written
+
+        if command == 'G90':
+            self.absolute = True
+        elif command == 'G91':
+            self.absolute = False
+        elif command == 'M82':
+            self.absolute_e = True
+        elif command == 'M83':
+            self.absolute_e = False
+        elif command == 'G92':
+            axes = [axis for axis in position if axis in params] or position.keys()
+            for axis in axes:
+                try:
+                    position[axis] = float( params.get(axis, 0) )
+                except ValueError:
+                    position[axis] = None
+                written[axis] = None
+        elif command == 'G28':
+            axes = [axis for axis in 'XYZ' if axis in params] or 'XYZ'
+            for axis in axes:
+                position[axis] = None
+                written[axis] = None
+        elif command == 'M92':
+            for axis in self.steps:
+                if axis in params:
+                    try:
+                        self.steps[axis] = float(params[axis])
+                        self.decimals[axis] = _decimals(self.steps[axis])
+                    except ValueError:
+                        pass
+        else:
+            # Anything else with coordinates (arcs, relative moves) leaves
+            # the position to the firmware
+            for axis in params:
+                if axis in position:
+                    value = None
+                    if self.absolute and (axis != 'E' or self.absolute_e):
+                        try:
+                            value = float(params[axis])
+                        except ValueError:
+                            pass
+                    elif axis == 'E' and position['E'] is not None:
+                        try:
+                            value = position['E'] + float(params['E'])
+                        except ValueError:
+                            pass
+                    position[axis] = value
+                    written[axis] = None
+                elif axis == 'F':
+                    self.feedrate = None
+                    written['F'] = None
+
+    def __move(self, command, params, attrs, offset):
+        """
+        Return the move of a G0/G1 line in absolute mode, ``None`` if its
+        parameters cannot be parsed.
+        """
+        position = self.position
+        try:
+            target = {}
+            for axis in 'XYZ':
+                if axis in params:
+                    target[axis] = float(params[axis])
+            e = None
+            if 'E' in params:
+                e = float(params['E'])
+            feedrate = self.feedrate
+            if 'F' in params:
+                feedrate = float(params['F'])
+        except ValueError:
+            return None
+
+        de = 0.0
+        if e is not None:
+            if not self.absolute_e:
+                de = e
+            elif position['E'] is not None:
+                de = e - position['E']
+            else:
+                de = -1.0 # Unknown, cannot be merged
+
+        start = (position['X'], position['Y'])
+        end = ( target.get('X', position['X']), target.get('Y', position['Y']) )
+        length = 0.0
+        mergeable = ( command in ('G1', 'G01') and not attrs and de >= 0 and
+                      'Z' not in params and ('X' in params or 'Y' in params) and
+                      None not in start and None not in end )
+        if mergeable:
+            for letter in params:
+                if letter not in 'XYEF':
+                    mergeable = False
+        if mergeable:
+            length = math.hypot(end[0] - start[0], end[1] - start[1])
+            mergeable = length > 1e-6
+
+        for axis, value in target.items():
+            position[axis] = value
+        if e is not None:
+            if not self.absolute_e:
+                if position['E'] is not None:
+                    position['E'] += e
+            else:
+                position['E'] = e
+        self.feedrate = feedrate
+
+        return {
+            'command'   : command,
+            'params'    : params,
+            'target'    : target,
+            'e'         : e,
+            'de'        : de,
+            'feedrate'  : feedrate,
+            'mergeable' : mergeable,
+            'start'     : start,
+            'end'       : end,
+            'points'    : [],
+            'length'    : length,
+            'attrs'     : attrs,
+            'offset'    : offset
+        }
+
+    def __merge(self, move):
+        """
+        Merge **move** into the pending move if they are collinear.
+
+        :rtype: bool
+        """
+        pending = self.pending
+        if not pending['mergeable'] or not move['mergeable']:
+            return False
+        if move['feedrate'] != pending['feedrate']:
+            return False
+        if (move['de'] > 0) != (pending['de'] > 0):
+            return False
+        if len(pending['points']) >= MAX_SEGMENTS:
+            return False
+        if move['de'] > 0:
+            ratio = pending['de'] / pending['length']
+            if abs(move['de'] / move['length'] - ratio) > E_RATIO_TOLERANCE * ratio:
+                return False
+
+        ax, ay = pending['start']
+        bx, by = move['end']
+        dx = bx - ax
+        dy = by - ay
+        chord = math.hypot(dx, dy)
+        if chord < 1e-6:
+            return False
+
+        along = 0.0
+        for px, py in pending['points'] + [ pending['end'] ]:
+            if abs( (px - ax)*dy - (py - ay)*dx ) / chord > self.tolerance:
+                return False
+            progress = ( (px - ax)*dx + (py - ay)*dy ) / chord
+            if progress <= along or progress >= chord:
+                return False
+            along = progress
+
+        pending['points'].append( pending['end'] )
+        pending['end'] = move['end']
+        pending['target']['X'] = move['end'][0]
+        pending['target']['Y'] = move['end'][1]
+        if move['e'] is not None:
+            pending['e'] = move['e']
+            pending['params']['E'] = move['params']['E']
+        pending['de'] += move['de']
+        pending['length'] += move['length']
+        pending['offset'] = move['offset']
+        self.stats['merged'] += 1
+        return True
+
+    def __flush(self, last):
+        """
+        Send the pending move.
+
+        :param last: The move is the last one of a run, its extruder
+                     position is written unrounded
+        """
+        pending = self.pending
+        if pending is None:
+            return
+        self.pending = None
+
+        stats = self.stats
+        written = self.written
+        decimals = self.decimals
+        params = pending['params']
+        words = [ pending['command'] ]
+
+        for axis in 'XYZ':
+            if axis in pending['target']:
+                text = _format(pending['target'][axis], decimals[axis])
+                if text != written[axis]:
+                    words.append(axis + text)
+                    written[axis] = text
+                else:
+                    stats['stripped'] += 1
+
+        if pending['e'] is not None:
+            if self.absolute_e:
+                if last:
+                    text = params['E']
+                else:
+                    text = _format(pending['e'], decimals['E'])
+            else:
+                value = pending['de'] + self.e_carry
+                if last:
+                    text = _format(value, 9)
+                else:
+                    text = _format(value, decimals['E'])
+                self.e_carry = value - float(text)
+            if text != written['E'] and (self.absolute_e or text != '0'):
+                words.append('E' + text)
+                if self.absolute_e:
+                    written['E'] = text
+            else:
+                stats['stripped'] += 1
+
+        if 'F' in params:
+            text = _format(pending['feedrate'], 3)
+            if text != written['F']:
+                words.append('F' + text)
+                written['F'] = text
+            else:
+                stats['stripped'] += 1
+
+        for letter, value in params.items():
+            if letter not in 'XYZEF':
+                words.append(letter + value)
+
+        if len(words) > 1:
+            code = ' '.join(words)
+            stats['codes_out'] += 1
+            stats['bytes_out'] += len(code) + 2
+            self.ready.append( (code, pending['attrs'], pending['offset']) )
+        else:
+            stats['dropped'] += 1
+            if pending['attrs']:
+                self.ready.append( ('', pending['attrs'], pending['offset']) )
+
+    def get_stats(self):
+        """
+        Return the filter report.
+
+        :returns: Dictionary with ``lines_in``, ``codes_in``, ``codes_out``,
+                  ``bytes_in``, ``bytes_out``, ``bytes_saved``, ``merged``,
+                  ``stripped`` and ``dropped`` keys. Bytes count codes with
+                  their line terminator, without line numbers and checksums.
+        :rtype: dict
+        """
+        stats = dict(self.stats)
+        stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+        return stats
+
+def fit_arcs(filename, output, tolerance = TOLERANCE):
+    """
+    Write an arc fitted copy of a gcode file. The first line of the copy
+    is the fitting report, see :func:`read_report`.
+
+    :param filename: GCode file
+    :param output: Output file
+    :param tolerance: Maximum deviation in mm
+    :type filename: string
+    :type output: string
+    :type tolerance: float
+    :returns: Fitting report, see :func:`ArcFitter.get_stats`
+    :rtype: dict
+    """
+    fitter = ArcFitter(tolerance)
+    tmp_file = output + '.tmp'
+    with open(filename, 'r') as src:
+        with open(tmp_file, 'w') as dst:
+            # Placeholder for the report, rewritten once it is known
+            header = ARCS_HEADER + ' ' * 512 + '\n'
+            dst.write(header)
+            dst.writelines( fitter.process(src) )
+            stats = fitter.get_stats()
+            dst.seek(0)
+            dst.write( (ARCS_HEADER + json.dumps(stats, sort_keys=True)).ljust(len(header) - 1) )
+    os.rename(tmp_file, output)
+    return stats
+
+def read_report(filename):
+    """
+    Return the fitting report of an arc fitted file.
+
+    :param filename: File written by :func:`fit_arcs`
+    :type filename: string
+    :returns: Fitting report or ``None`` if the file is not arc fitted
+    :rtype: dict
+    """
+    try:
+        with open(filename, 'r') as f:
+            line = f.readline()
+    except IOError:
+        return None
+    if not line.startswith(ARCS_HEADER):
+        return None
+    try:
+        return json.loads( line[len(ARCS_HEADER):].strip() )
+    except ValueError:
+        return None
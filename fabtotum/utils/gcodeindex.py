@@ -0,0 +1,574 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Indexes of gcode files for random access.
+
+A line index is a sidecar file with the byte offset of every line of a
+gcode file. It is written while the file is analysed by
+:class:`LineIndexWriter` and memory-mapped by :class:`LineIndex`, so
+looking up a line takes constant time and memory does not grow with the
+file size.
+
+Index file layout, little-endian::
+
+    magic 'GCLI' | item size (1 byte) | 3 pad bytes | line count (8 bytes)
+    offset of line 0 | offset of line 1 | ... | offset after the last line
+
+A layer index lists the layers marked by the slicer comments with their
+byte and line ranges and statistics, see :class:`LayerIndex`. It is small
+and stored as JSON.
+"""
+
+# Import standard python module
+import os
+import sys
+import math
+import json
+import mmap
+import bisect
+import struct
+from array import array
+
+# Import external modules
+
+# Import internal modules
+
+################################################################################
+
+LINE_INDEX_MAGIC = 'GCLI'
+LINE_INDEX_HEADER = struct.Struct('<4sB3xQ')
+LINE_INDEX_ITEM = struct.Struct('<I')
+# Offsets written to the index file at once
+LINE_INDEX_CHUNK = 65536
+# Largest offset of the index format, larger files are not indexed
+LINE_INDEX_MAX_OFFSET = 0xFFFFFFFF
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+class LineIndexWriter(object):
+    """
+    Write a line index while reading a file line by line. Offsets are
+    buffered in chunks of ``LINE_INDEX_CHUNK``, the index file is complete
+    once :func:`close` has renamed it.
+
+    Tight loops can append to the ``offsets`` array directly and call
+    :func:`flush` every ``LINE_INDEX_CHUNK`` lines.
+
+    Usage::
+
+        writer = LineIndexWriter(index_file)
+        offset = 0
+        for line in f:
+            writer.append(offset)
+            offset += len(line)
+        writer.close(offset)
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Index file
+        :type filename: string
+        """
+        self.filename = filename
+        self.tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+        self.fd = open(self.tmp_file, 'wb')
+        self.fd.write( LINE_INDEX_HEADER.pack(LINE_INDEX_MAGIC, LINE_INDEX_ITEM.size, 0) )
+        self.offsets = array('I')
+        self.count = 0 # Offsets written to the file
+        self.failed = False
+
+    def flush(self):
+        """
+        Write the buffered offsets. The ``offsets`` array stays the same
+        object.
+        """
+        if self.offsets:
+            self.count += len(self.offsets)
+            if BIG_ENDIAN:
+                self.offsets.byteswap()
+            self.offsets.tofile(self.fd)
+            del self.offsets[:]
+
+    def append(self, offset):
+        """
+        Add the byte offset of the next line.
+
+        :param offset: Byte offset
+        :type offset: int
+        """
+        self.offsets.append(offset)
+        if len(self.offsets) >= LINE_INDEX_CHUNK:
+            self.flush()
+
+    def close(self, end_offset):
+        """
+        Complete the index file.
+
+        :param end_offset: Byte offset after the last line, the file size
+        :type end_offset: int
+        :returns: ``True`` if the index was written
+        :rtype: bool
+        """
+        try:
+            if not self.failed:
+                self.flush()
+                self.fd.write( LINE_INDEX_ITEM.pack(end_offset) )
+                self.fd.seek(0)
+                self.fd.write( LINE_INDEX_HEADER.pack(LINE_INDEX_MAGIC, LINE_INDEX_ITEM.size, self.count) )
+            self.fd.close()
+            if self.failed:
+                os.remove(self.tmp_file)
+                return False
+            os.rename(self.tmp_file, self.filename)
+        except (IOError, OSError, OverflowError) as e:
+            print "Line index not written:", e
+            try:
+                os.remove(self.tmp_file)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def abort(self):
+        """
+        Discard the index.
+        """
+        self.failed = True
+        self.close(0)
+
+def build_line_index(filename, index_file):
+    """
+    Write the line index of a file.
+
+    :param filename: GCode file
+    :param index_file: Index file
+    :type filename: string
+    :type index_file: string
+    :returns: ``True`` if the index was written
+    :rtype: bool
+    """
+    try:
+        writer = LineIndexWriter(index_file)
+    except IOError:
+        return False
+
+    offset = 0
+    try:
+        if os.path.getsize(filename) > LINE_INDEX_MAX_OFFSET:
+            raise OverflowError("file too large")
+        with open(filename, 'rb') as f:
+            for line in f:
+                writer.append(offset)
+                offset += len(line)
+    except (IOError, OSError, OverflowError):
+        writer.abort()
+        return False
+    return writer.close(offset)
+
+class LineIndex(object):
+    """
+    Memory-mapped line index, see :class:`LineIndexWriter`. Lines are
+    numbered from 0.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Index file
+        :type filename: string
+        :raises IOError: The index file cannot be read or is damaged
+        """
+        with open(filename, 'rb') as f:
+            header = f.read(LINE_INDEX_HEADER.size)
+            if len(header) != LINE_INDEX_HEADER.size:
+                raise IOError("Damaged line index " + filename)
+            magic, item_size, count = LINE_INDEX_HEADER.unpack(header)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if ( magic != LINE_INDEX_MAGIC or item_size != LINE_INDEX_ITEM.size or
+                 size != LINE_INDEX_HEADER.size + (count + 1) * item_size ):
+                raise IOError("Damaged line index " + filename)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, line):
+        """
+        Return the byte offset of a line.
+
+        :param line: Line number, ``len(index)`` gives the file size
+        :type line: int
+        :rtype: int
+        :raises IndexError: No such line
+        """
+        if line < 0 or line > self.count:
+            raise IndexError("line {0} out of range".format(line))
+        return LINE_INDEX_ITEM.unpack_from(self.map, LINE_INDEX_HEADER.size + line * LINE_INDEX_ITEM.size)[0]
+
+    def line(self, offset):
+        """
+        Return the number of the line containing a byte offset.
+
+        :param offset: Byte offset
+        :type offset: int
+        :rtype: int
+        """
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.offset(middle) <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def close(self):
+        """
+        Unmap the index.
+        """
+        self.map.close()
+
+################################################################################
+
+LAYER_INDEX_VERSION = 1
+
+MOVE_CODES = ('G0', 'G1', 'G2', 'G3')
+
+def _round(value, decimals):
+    return round(value, decimals) + 0.0
+
+class LayerIndexBuilder(object):
+    """
+    Collect the layers of a gcode file line by line. A layer starts at the
+    comment line marking it and ends where the next one starts, lines
+    before the first marker belong to no layer.
+
+    Moves are tracked in absolute and relative positioning (G90/G91, M82/M83)
+    with G92 position resets. Arcs are accounted for by their chord.
+
+    Usage::
+
+        builder = LayerIndexBuilder()
+        offset = 0
+        for number, line in enumerate(f):
+            attrs = parser.process_line(line)
+            builder.feed(line, offset, number, attrs.get('layer'))
+            offset += len(line)
+        index = builder.finish(offset, number + 1)
+    """
+
+    def __init__(self):
+        self.layers = []
+        self.layer = None
+        self.absolute = True
+        self.absolute_e = True
+        self.position = [0.0, 0.0, 0.0, 0.0]
+
+    def start_layer(self, number, offset, line):
+        """
+        Start layer **number** at **offset** and line **line**.
+        """
+        self.end_layer(offset, line)
+        self.layer = {
+            'layer'     : number,
+            'offset'    : offset,
+            'line'      : line,
+            'z'         : None,
+            'moves'     : 0,
+            'extrusion' : 0.0,
+            'travel'    : 0.0
+        }
+
+    def end_layer(self, offset, line):
+        """
+        End the current layer before **offset** and line **line**.
+        """
+        layer = self.layer
+        if layer is None:
+            return
+        if layer['z'] is None:
+            # Layer without extrusion
+            layer['z'] = self.position[2]
+        layer['z'] = _round(layer['z'], 3)
+        layer['extrusion'] = _round(layer['extrusion'], 5)
+        layer['travel'] = _round(layer['travel'], 3)
+        layer['end_offset'] = offset
+        layer['lines'] = line - layer['line']
+        self.layers.append(layer)
+        self.layer = None
+
+    def feed(self, line, offset, number, layer = None):
+        """
+        Process a file line.
+
+        :param line: Raw file line
+        :param offset: Byte offset of the line
+        :param number: Line number counted from 0
+        :param layer: Layer number if the line marks the start of a layer
+        :type line: string
+        :type offset: int
+        :type number: int
+        :type layer: int
+        """
+        if layer is not None:
+            self.start_layer(layer, offset, number)
+
+        code = line.split(';', 1)[0]
+        words = code.split()
+        if not words:
+            return
+        cmd = words[0]
+
+        if cmd in MOVE_CODES:
+            self.move(words)
+        elif cmd == 'G90':
+            self.absolute = True
+        elif cmd == 'G91':
+            self.absolute = False
+        elif cmd == 'M82':
+            self.absolute_e = True
+        elif cmd == 'M83':
+            self.absolute_e = False
+        elif cmd == 'G92':
+            position = self.position
+            for word in words[1:]:
+                axis = 'XYZE'.find(word[0])
+                if axis >= 0:
+                    try:
+                        position[axis] = float(word[1:])
+                    except ValueError:
+                        pass
+
+    def move(self, words):
+        """
+        Account for a move given as its words.
+        """
+        old = self.position
+        new = list(old)
+        for word in words[1:]:
+            axis = 'XYZE'.find(word[0])
+            if axis < 0:
+                continue
+            try:
+                value = float(word[1:])
+            except ValueError:
+                continue
+            if axis == 3:
+                relative = not self.absolute or not self.absolute_e
+            else:
+                relative = not self.absolute
+            if relative:
+                new[axis] = old[axis] + value
+            else:
+                new[axis] = value
+        self.position = new
+
+        layer = self.layer
+        if layer is None:
+            return
+
+        layer['moves'] += 1
+        dx = new[0] - old[0]
+        dy = new[1] - old[1]
+        dz = new[2] - old[2]
+        de = new[3] - old[3]
+        if de > 0 and (dx or dy):
+            layer['extrusion'] += de
+            if layer['z'] is None:
+                layer['z'] = new[2]
+        else:
+            layer['travel'] += math.sqrt(dx*dx + dy*dy + dz*dz)
+
+    def finish(self, offset, line):
+        """
+        End the last layer at the end of the file.
+
+        :param offset: File size
+        :param line: Number of lines
+        :rtype: LayerIndex
+        """
+        self.end_layer(offset, line)
+        return LayerIndex(self.layers)
+
+class LayerIndex(object):
+    """
+    Layers of a gcode file in file order. Every layer is a dictionary with
+    the keys:
+
+    - ``layer``: layer number of the slicer
+    - ``offset``, ``end_offset``: byte range of the layer
+    - ``line``, ``lines``: first line counted from 0 and number of lines
+    - ``z``: height of the first extruding move, of the last position if
+      the layer does not extrude
+    - ``moves``: number of moves
+    - ``extrusion``: filament length extruded by printing moves in mm
+    - ``travel``: length of moves not extruding in mm
+    """
+
+    def __init__(self, layers):
+        """
+        :param layers: Layer dictionaries in file order
+        :type layers: list
+        """
+        self.layers = layers
+        self.offsets = [layer['offset'] for layer in layers]
+        self.lines = [layer['line'] for layer in layers]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, index):
+        return self.layers[index]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def find_offset(self, offset):
+        """
+        Return the position of the layer containing a byte offset.
+
+        :param offset: Byte offset
+        :type offset: int
+        :returns: Position in the index, ``-1`` before the first layer
+        :rtype: int
+        """
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    def find_line(self, line):
+        """
+        Return the position of the layer containing a line.
+
+        :param line: Line number counted from 0
+        :type line: int
+        :returns: Position in the index, ``-1`` before the first layer
+        :rtype: int
+        """
+        return bisect.bisect_right(self.lines, line) - 1
+
+    def find_layer(self, number):
+        """
+        Return the position of slicer layer **number**.
+
+        :param number: Layer number
+        :type number: int
+        :returns: Position in the index, ``-1`` if there is no such layer
+        :rtype: int
+        """
+        for i, layer in enumerate(self.layers):
+            if layer['layer'] == number:
+                return i
+        return -1
+
+    def progress(self, offset):
+        """
+        Return the progress at a byte offset counted in layers, the
+        current layer accounting for the part of its bytes before **offset**.
+
+        :param offset: Byte offset
+        :type offset: int
+        :returns: Percentage
+        :rtype: float
+        """
+        i = self.find_offset(offset)
+        if i < 0:
+            return 0.0
+        layer = self.layers[i]
+        size = layer['end_offset'] - layer['offset']
+        done = 1.0
+        if size > 0:
+            done = min(1.0, float(offset - layer['offset']) / size)
+        return 100.0 * (i + done) / len(self.layers)
+
+    def save(self, filename):
+        """
+        Write the index to a JSON file.
+
+        :param filename: Index file
+        :type filename: string
+        :returns: ``True`` if the index was written
+        :rtype: bool
+        """
+        tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'version' : LAYER_INDEX_VERSION, 'layers' : self.layers}, f)
+            os.rename(tmp_file, filename)
+        except (IOError, OSError) as e:
+            print "Layer index not written:", e
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            return False
+        return True
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read an index written by :func:`save`.
+
+        :param filename: Index file
+        :type filename: string
+        :rtype: LayerIndex
+        :raises IOError: The index file cannot be read or is damaged
+        """
+        with open(filename, 'r') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                raise IOError("Damaged layer index " + filename)
+        if not isinstance(data, dict) or data.get('version') != LAYER_INDEX_VERSION:
+            raise IOError("Damaged layer index " + filename)
+        return cls(data['layers'])
+
+def build_layer_index(filename, parsers):
+    """
+    Scan a file for its layers.
+
+    :param filename: GCode file
+    :param parsers: Slicer comment parsers, modules with a ``process_line``
+                    function returning the ``layer`` attribute
+    :type filename: string
+    :type parsers: list
+    :rtype: LayerIndex
+    :raises IOError: The file cannot be read
+    """
+    builder = LayerIndexBuilder()
+    feed = builder.feed
+    offset = 0
+    number = 0
+    with open(filename, 'r') as f:
+        for line in f:
+            layer = None
+            if ';' in line:
+                for parser in parsers:
+                    attrs = parser.process_line(line)
+                    if 'layer' in attrs:
+                        try:
+                            layer = int(attrs['layer'])
+                        except ValueError:
+                            pass
+            feed(line, offset, number, layer)
+            offset += len(line)
+            number += 1
+    return builder.finish(offset, number)
@@ -0,0 +1,404 @@
+#!/bin/env python
+# -*- coding: utf-8; -*-
+#
+# (c) 2016 FABtotum, http://www.fabtotum.com
+#
+# This file is part of FABUI.
+#
+# FABUI is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# FABUI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Print time estimation of gcode files.
+
+The moves of a file are parsed once into arrays and planned the way the
+firmware does: feedrate and acceleration limited per axis, junction speeds
+limited by jerk (or junction deviation), entry speeds reachable by
+accelerating from the previous move and decelerating into the next one,
+and a trapezoidal speed profile per move. The planner passes are computed
+with cumulative sums and minimums over the whole file, so no Python loop
+runs per move after parsing.
+
+Heating waits (M109, M190) and homing cannot be estimated and are not
+included, dwells (G4) are.
+
+NumPy is required, :data:`AVAILABLE` is ``False`` without it.
+"""
+
+# Import standard python module
+import math
+from array import array
+
+# Import external modules
+try:
+    import numpy as np
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+# Import internal modules
+
+################################################################################
+
+# Machine profile, Marlin 1.0 defaults the Totumduino firmware is based on.
+# Feedrates and jerk in mm/s, accelerations in mm/s^2, junction deviation
+# in mm. Junction speeds are limited by jerk if junction_deviation is None.
+MACHINE_PROFILE = {
+    'max_feedrate'          : {'X' : 500.0, 'Y' : 500.0, 'Z' : 5.0, 'E' : 25.0},
+    'max_acceleration'      : {'X' : 9000.0, 'Y' : 9000.0, 'Z' : 100.0, 'E' : 10000.0},
+    'acceleration'          : 3000.0,
+    'retract_acceleration'  : 3000.0,
+    'max_jerk'              : {'XY' : 20.0, 'Z' : 0.4, 'E' : 5.0},
+    'junction_deviation'    : None
+}
+
+# Feedrate in mm/s used until F is specified
+DEFAULT_FEEDRATE = 50.0
+
+MOVE_CODES = ('G0', 'G1', 'G2', 'G3')
+
+def machine_profile(profile = None):
+    """
+    Return ``MACHINE_PROFILE`` updated with the values of **profile**.
+
+    :param profile: Partial machine profile, per axis values are merged
+    :type profile: dict
+    :rtype: dict
+    """
+    result = {}
+    for key, value in MACHINE_PROFILE.items():
+        if isinstance(value, dict):
+            value = dict(value)
+        result[key] = value
+    if profile:
+        for key, value in profile.items():
+            if isinstance(value, dict) and isinstance(result.get(key), dict):
+                result[key].update(value)
+            else:
+                result[key] = value
+    return result
+
+def _arc_length(x, y, i, j, nx, ny, clockwise):
+    """
+    Return the length in the XY plane of an arc from x,y to nx,ny around
+    x+i,y+j.
+    """
+    cx = x + i
+    cy = y + j
+    radius = math.hypot(i, j)
+    start = math.atan2(y - cy, x - cx)
+    end = math.atan2(ny - cy, nx - cx)
+    if clockwise:
+        sweep = start - end
+    else:
+        sweep = end - start
+    if sweep <= 0:
+        # Equal start and end is a full circle
+        sweep += 2 * math.pi
+    return radius * sweep
+
+def parse_moves(filename):
+    """
+    Parse the moves of a gcode file.
+
+    :param filename: GCode file
+    :type filename: string
+    :returns: Dictionary of arrays, ``dx``, ``dy``, ``dz``, ``de`` (move
+              components in mm), ``feedrate`` (mm/s), ``line`` (line number
+              counted from 0), ``length`` (path length of arcs, 0 for
+              straight moves) per move, ``dwell_line`` and ``dwell_time``
+              (seconds) per dwell
+    :rtype: dict
+    :raises IOError: The file cannot be read
+    """
+    dx = array('d')
+    dy = array('d')
+    dz = array('d')
+    de = array('d')
+    feedrates = array('d')
+    lines = array('l')
+    lengths = array('d')
+    dwell_line = array('l')
+    dwell_time = array('d')
+
+    x = y = z = e = 0.0
+    feedrate = DEFAULT_FEEDRATE
+    absolute = True
+    absolute_e = True
+    number = -1
+
+    with open(filename, 'r') as f:
+        for line in f:
+            number += 1
+            head = line[:1]
+            if head != 'G' and head != 'M':
+                continue
+            words = line.split(';', 1)[0].split()
+            cmd = words[0]
+
+            if cmd in MOVE_CODES:
+                nx = x
+                ny = y
+                nz = z
+                ne = e
+                i = j = 0.0
+                for word in words[1:]:
+                    axis = word[0]
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        continue
+                    if axis == 'X':
+                        nx = value if absolute else x + value
+                    elif axis == 'Y':
+                        ny = value if absolute else y + value
+                    elif axis == 'Z':
+                        nz = value if absolute else z + value
+                    elif axis == 'E':
+                        ne = value if absolute and absolute_e else e + value
+                    elif axis == 'F':
+                        if value > 0:
+                            feedrate = value / 60.0
+                    elif axis == 'I':
+                        i = value
+                    elif axis == 'J':
+                        j = value
+
+                if nx == x and ny == y and nz == z and ne == e:
+                    continue
+
+                length = 0.0
+                if cmd == 'G2' or cmd == 'G3':
+                    if i or j:
+                        length = math.hypot( _arc_length(x, y, i, j, nx, ny, cmd == 'G2'), nz - z )
+
+                dx.append(nx - x)
+                dy.append(ny - y)
+                dz.append(nz - z)
+                de.append(ne - e)
+                feedrates.append(feedrate)
+                lines.append(number)
+                lengths.append(length)
+                x = nx
+                y = ny
+                z = nz
+                e = ne
+
+            elif cmd == 'G90':
+                absolute = True
+            elif cmd == 'G91':
+                absolute = False
+            elif cmd == 'M82':
+                absolute_e = True
+            elif cmd == 'M83':
+                absolute_e = False
+            elif cmd == 'G92' or cmd == 'G28':
+                # Homed axes are at 0, without axis words all of them
+                args = words[1:] or ('XYZE' if cmd == 'G92' else 'XYZ')
+                for word in args:
+                    value = 0.0
+                    if cmd == 'G92' and len(word) > 1:
+                        try:
+                            value = float(word[1:])
+                        except ValueError:
+                            continue
+                    axis = word[0]
+                    if axis == 'X':
+                        x = value
+                    elif axis == 'Y':
+                        y = value
+                    elif axis == 'Z':
+                        z = value
+                    elif axis == 'E':
+                        e = value
+            elif cmd == 'G4':
+                seconds = 0.0
+                for word in words[1:]:
+                    try:
+                        if word[0] == 'P':
+                            seconds += float(word[1:]) / 1000.0
+                        elif word[0] == 'S':
+                            seconds += float(word[1:])
+                    except ValueError:
+                        pass
+                dwell_line.append(number)
+                dwell_time.append(seconds)
+
+    return {
+        'dx'            : np.frombuffer(dx, dtype=np.float64),
+        'dy'            : np.frombuffer(dy, dtype=np.float64),
+        'dz'            : np.frombuffer(dz, dtype=np.float64),
+        'de'            : np.frombuffer(de, dtype=np.float64),
+        'feedrate'      : np.frombuffer(feedrates, dtype=np.float64),
+        'line'          : np.array(lines, dtype=np.int64),
+        'length'        : np.frombuffer(lengths, dtype=np.float64),
+        'dwell_line'    : np.array(dwell_line, dtype=np.int64),
+        'dwell_time'    : np.frombuffer(dwell_time, dtype=np.float64)
+    }
+
+def plan_moves(moves, profile = None):
+    """
+    Return the duration of every move.
+
+    :param moves: Moves returned by :func:`parse_moves`
+    :param profile: Machine profile, see :func:`machine_profile`
+    :type moves: dict
+    :type profile: dict
+    :returns: Seconds per move
+    :rtype: numpy.ndarray
+    """
+    profile = machine_profile(profile)
+    count = len(moves['dx'])
+    if not count:
+        return np.zeros(0)
+
+    deltas = {'X' : moves['dx'], 'Y' : moves['dy'], 'Z' : moves['dz'], 'E' : moves['de']}
+    xyz = np.sqrt(moves['dx']**2 + moves['dy']**2 + moves['dz']**2)
+    e_only = xyz == 0
+    length = np.where(moves['length'] > 0, moves['length'], xyz)
+    length = np.where(e_only, np.abs(moves['de']), length)
+
+    # Speed and acceleration limited by every moving axis
+    nominal = moves['feedrate'].copy()
+    acceleration = np.where(e_only, profile['retract_acceleration'], profile['acceleration'])
+    # Move components per mm of path, the unit vector with E added
+    unit = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for axis, delta in deltas.items():
+            unit[axis] = delta / length
+            share = np.abs(unit[axis])
+            nominal = np.minimum(nominal, np.where(share > 0, profile['max_feedrate'][axis] / share, np.inf))
+            acceleration = np.minimum(acceleration, np.where(share > 0, profile['max_acceleration'][axis] / share, np.inf))
+
+    # Squared speed limit at the start of every move and at the end of the
+    # last one, from rest and to rest
+    junction = np.zeros(count + 1)
+    if count > 1:
+        previous = nominal[:-1]
+        current = nominal[1:]
+        deviation = profile['junction_deviation']
+        if deviation:
+            cos_theta = -( unit['X'][:-1] * unit['X'][1:] +
+                           unit['Y'][:-1] * unit['Y'][1:] +
+                           unit['Z'][:-1] * unit['Z'][1:] )
+            sin_half = np.sqrt( np.clip(0.5 * (1.0 - cos_theta), 0.0, 1.0) )
+            with np.errstate(divide='ignore'):
+                speed2 = acceleration[1:] * deviation * sin_half / (1.0 - sin_half)
+            speed2 = np.where(e_only[:-1] | e_only[1:], 0.0, speed2)
+            junction[1:-1] = np.minimum( speed2, np.minimum(previous, current)**2 )
+        else:
+            jerk = profile['max_jerk']
+            factor = np.ones(count - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vx = (current * unit['X'][1:] - previous * unit['X'][:-1])
+                vy = (current * unit['Y'][1:] - previous * unit['Y'][:-1])
+                change = np.sqrt(vx*vx + vy*vy)
+                factor = np.minimum(factor, np.where(change > jerk['XY'], jerk['XY'] / change, 1.0))
+                for axis in 'ZE':
+                    change = np.abs(current * unit[axis][1:] - previous * unit[axis][:-1])
+                    factor = np.minimum(factor, np.where(change > jerk[axis], jerk[axis] / change, 1.0))
+            junction[1:-1] = np.minimum(previous, current * factor)**2
+
+    # Entry speeds reachable by decelerating into the next move (backward
+    # pass) and by accelerating from the previous one (forward pass):
+    #   v[i]^2 <= v[i+1]^2 + 2*a*L   and   v[i+1]^2 <= v[i]^2 + 2*a*L
+    # A pass is a minimum over all later (earlier) limits plus the distance
+    # terms in between, a cumulative minimum with cumulative sums.
+    reach = 2.0 * acceleration * length
+    total = np.zeros(count + 1)
+    np.cumsum(reach, out=total[1:])
+    entry = np.minimum.accumulate( (junction + total)[::-1] )[::-1] - total
+    entry = total + np.minimum.accumulate(entry - total)
+    entry = np.clip(entry, 0.0, None)
+
+    # Trapezoidal speed profile
+    v0 = np.sqrt(entry[:-1])
+    v1 = np.sqrt(entry[1:])
+    nominal = np.maximum(nominal, np.maximum(v0, v1))
+    nominal2 = nominal * nominal
+    accelerate = (nominal2 - entry[:-1]) / (2.0 * acceleration)
+    decelerate = (nominal2 - entry[1:]) / (2.0 * acceleration)
+    cruise = length - accelerate - decelerate
+
+    trapezoid = (2.0 * nominal - v0 - v1) / acceleration + np.clip(cruise, 0.0, None) / nominal
+    peak = np.sqrt( np.maximum(0.5 * (reach + entry[:-1] + entry[1:]), np.maximum(entry[:-1], entry[1:])) )
+    triangle = (2.0 * peak - v0 - v1) / acceleration
+    return np.where(cruise >= 0, trapezoid, triangle)
+
+def estimate_print_time(filename, layers = None, profile = None):
+    """
+    Estimate the duration of a gcode file.
+
+    :param filename: GCode file
+    :param layers: Layer index of the file for per layer times
+    :param profile: Machine profile, see :func:`machine_profile`
+    :type filename: string
+    :type layers: :class:`fabtotum.utils.gcodeindex.LayerIndex`
+    :type profile: dict
+    :returns: Dictionary with ``total`` (seconds), ``start`` (seconds
+              before the first layer), ``layers`` (seconds per layer of
+              **layers**), ``moves`` and ``dwell`` (seconds) keys
+    :rtype: dict
+    :raises IOError: The file cannot be read
+    """
+    moves = parse_moves(filename)
+    times = plan_moves(moves, profile)
+
+    # Position in the layer index of every move and dwell, -1 before
+    # the first layer
+    starts = np.array([layer['line'] for layer in layers or []], dtype=np.int64)
+    move_layer = np.searchsorted(starts, moves['line'], side='right')
+    dwell_layer = np.searchsorted(starts, moves['dwell_line'], side='right')
+    per_layer = ( np.bincount(move_layer, weights=times, minlength=len(starts) + 1) +
+                  np.bincount(dwell_layer, weights=moves['dwell_time'], minlength=len(starts) + 1) )
+
+    return {
+        'total'     : float(per_layer.sum()),
+        'start'     : float(per_layer[0]),
+        'layers'    : [float(t) for t in per_layer[1:]],
+        'moves'     : len(times),
+        'dwell'     : float(moves['dwell_time'].sum())
+    }
+
+def remaining_time(estimate, layers, offset):
+    """
+    Return the estimated time left from a byte offset, the current layer
+    is interpolated by its bytes.
+
+    :param estimate: Estimate returned by :func:`estimate_print_time` with **layers**
+    :param layers: Layer index of the file
+    :param offset: Byte offset of the next line to execute
+    :type estimate: dict
+    :type layers: :class:`fabtotum.utils.gcodeindex.LayerIndex`
+    :type offset: int
+    :returns: Seconds, ``None`` without layers
+    :rtype: float
+    """
+    times = estimate['layers']
+    if not layers or len(times) != len(layers):
+        return None
+
+    i = layers.find_offset(offset)
+    if i < 0:
+        # Start code, interpolated up to the first layer
+        done = 0.0
+        if layers[0]['offset'] > 0:
+            done = min(1.0, float(offset) / layers[0]['offset'])
+        return estimate['start'] * (1.0 - done) + sum(times)
+
+    layer = layers[i]
+    size = layer['end_offset'] - layer['offset']
+    done = 1.0
+    if size > 0:
+        done = min(1.0, float(offset - layer['offset']) / size)
+    return times[i] * (1.0 - done) + sum(times[i+1:])
@@ -41,11 +41,32 @@ class GCodeServiceServerPyroWrapper(object):
         self.client_callback = None
         self.callback_list = []
     
-    def send(self, code, block = True, timeout = None):
-        return self.gcs.send(code.encode('latin-1'), block, timeout)
+    def send(self, code, block = True, timeout = None, adaptive = False):
+        return self.gcs.send(code.encode('latin-1'), block, timeout, adaptive)
         
-    def send_file(self, filename):
-        self.gcs.send_file(filename)
+    def send_many(self, lines, timeout = None):
+        return self.gcs.send_many([code.encode('latin-1') for code in lines], timeout)
+
+    def send_file(self, filename, arc_tolerance = None, compact = False):
+        self.gcs.send_file(filename, arc_tolerance, compact)
+
+    def resume_file(self):
+        return self.gcs.resume_file()
+
+    def get_checkpoint(self):
+        return self.gcs.get_checkpoint()
+
+    def get_recovery_stats(self):
+        return self.gcs.get_recovery_stats()
+
+    def get_analysis_cache_stats(self):
+        return self.gcs.get_analysis_cache_stats()
+
+    def get_layer_progress(self):
+        return self.gcs.get_layer_progress()
+
+    def get_time_estimate(self):
+        return self.gcs.get_time_estimate()
     
     def __callback_handler(self, action, data):
         if self.callback_list:
@@ -72,9 +93,51 @@ class GCodeServiceServerPyroWrapper(object):
         if not self.callback_list:
             self.gcs.unregister_callback()
 
+    def z_modify(self, z):
+        self.gcs.z_modify(z)
+
     def get_progress(self):
         return self.gcs.get_progress()
 
+    def get_stream_stats(self):
+        return self.gcs.get_stream_stats()
+
+    def get_ack_latency(self, clear = False):
+        return self.gcs.get_ack_latency(clear)
+
+    def get_timeout(self, code, default = None):
+        return self.gcs.get_timeout(code, default)
+
+    def get_latency_stats(self):
+        return self.gcs.get_latency_stats()
+
+    def export_latency_stats(self):
+        return self.gcs.export_latency_stats()
+
+    def load_latency_stats(self, data):
+        return self.gcs.load_latency_stats(data)
+
+    def get_z_stats(self):
+        return self.gcs.get_z_stats()
+
+    def get_connection_stats(self):
+        return self.gcs.get_connection_stats()
+
+    def get_resend_stats(self):
+        return self.gcs.get_resend_stats()
+
+    def get_callback_stats(self):
+        return self.gcs.get_callback_stats()
+
+    def get_lane_stats(self):
+        return self.gcs.get_lane_stats()
+
+    def set_trace_level(self, level):
+        self.gcs.set_trace_level(level)
+
+    def get_trace(self, clear = False):
+        return self.gcs.get_trace(clear)
+
     def get_idle_time(self):
         return self.gcs.get_idle_time()
 
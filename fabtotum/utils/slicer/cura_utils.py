@@ -19,7 +19,6 @@
 # along with FABUI.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import standard python module
-import re
 
 def _is_number(s):
     try:
@@ -30,19 +29,23 @@ def _is_number(s):
 
 def process_line(line):
     attrs = {}
-
-    if re.search('CURA_PROFILE_STRING:', line):
+    
+    # All attributes are in comments
+    if ';' not in line:
+        return attrs
+    
+    if 'CURA_PROFILE_STRING:' in line:
        attrs['slicer'] = 'CURA'
     
     tags = line.split(';')
     
     if len(tags) == 2:
-        if re.search('Layer count:', tags[1]):
+        if 'Layer count:' in tags[1]:
             tag, value = tags[1].split(':')
             value = value.strip()
             if _is_number(value):
                 attrs['layer_count'] = value
-        elif re.search('LAYER:', tags[1]):
+        elif 'LAYER:' in tags[1]:
             tag, value = tags[1].split(':')
             attrs['layer'] = value.strip()
     
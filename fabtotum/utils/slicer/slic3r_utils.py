@@ -22,20 +22,25 @@
 import re
 
 
+LAYER_RE = re.compile('\((?P<layer>[0-9]+)\)')
+
 def process_line(line):
     attrs = {}
     
-    if re.search('generated by Slic3r', line):
+    # All attributes are in comments
+    if ';' not in line:
+        return attrs
+    
+    if 'generated by Slic3r' in line:
        attrs['slicer'] = 'SLIC3R'
 
     tags = line.split(';')
 
     if len(tags) == 2:
         # Available only if 'Verbose G-Code [x]' is selected
-        if re.search('move to next layer', tags[1]):
-            m = re.search('\((?P<layer>[0-9]+)\)',tags[1])
+        if 'move to next layer' in tags[1]:
+            m = LAYER_RE.search(tags[1])
             if m:
                 attrs['layer'] = m.group('layer')
 
     return attrs
-